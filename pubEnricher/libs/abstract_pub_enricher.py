@@ -1,10 +1,13 @@
 #!/usr/bin/python
 
 import configparser
+import threading
+import time
 
 from abc import abstractmethod
 
 from typing import overload, Tuple, List, Dict, Any, Iterator
+from urllib import parse
 
 from .skeleton_pub_enricher import SkeletonPubEnricher
 from .pub_cache import PubDBCache
@@ -13,6 +16,11 @@ from .doi_cache import DOIChecker
 class AbstractPubEnricher(SkeletonPubEnricher):
 	DEFAULT_REQUEST_DELAY = 0.25
 	
+	# The next free request slot of each host, shared by all the
+	# instances (and their threads) in the process
+	_host_slots = {}
+	_host_slots_lock = threading.Lock()
+	
 	@overload
 	def __init__(self,cache:str=".",prefix:str=None,config:configparser.ConfigParser=None,debug:bool=False,doi_checker:DOIChecker=None):
 		...
@@ -33,6 +41,25 @@ class AbstractPubEnricher(SkeletonPubEnricher):
 		useragent = self.config.get(section_name,'useragent',fallback='Mozilla/5.0 (X11; Linux x86_64; rv:79.0) Gecko/20100101 Firefox/79.0')
 		self.useragent = useragent
 	
+	def waitRequestSlot(self,url:str) -> None:
+		"""
+			It waits until a request to the host of the url can be issued,
+			so the requests to each host start, at least, request_delay
+			seconds apart, whichever the thread issuing them
+		"""
+		host = parse.urlsplit(url).netloc
+		with self._host_slots_lock:
+			now = time.monotonic()
+			slot = max(now,self._host_slots.get(host,now))
+			self._host_slots[host] = slot + self.request_delay
+		
+		if slot > now:
+			time.sleep(slot - now)
+	
+	def estimateSeconds(self,num_requests:int) -> float:
+		# Each request waits, at least, the delay between requests
+		return num_requests * self.request_delay
+	
 	@classmethod
 	@abstractmethod
 	def Name(cls) -> str:
@@ -0,0 +1,151 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import datetime
+import sqlite3
+import time
+
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, List
+
+class CacheStats(object):
+	"""
+		The counters of a cache database: the lookups of each kind of
+		entry (fresh hits, expired but still present entries, and misses),
+		the decompressed payloads and the time spent in SQLite
+	"""
+	def __init__(self):
+		# kind -> [hits, expired, misses]
+		self.lookups = OrderedDict()
+		self.sql_statements = 0
+		self.sql_seconds = 0.0
+	
+	def count(self,kind:str,hits:int=0,expired:int=0,misses:int=0) -> None:
+		counters = self.lookups.get(kind)
+		if counters is None:
+			self.lookups[kind] = counters = [0, 0, 0]
+		counters[0] += hits
+		counters[1] += expired
+		counters[2] += misses
+	
+	def countTimestamps(self,kind:str,num_lookups:int,timestamps:Iterator[datetime.datetime],ttl:datetime.timedelta,now:datetime.datetime) -> None:
+		"""
+			It counts a bulk lookup, from the timestamps of the found entries
+		"""
+		hits = 0
+		expired = 0
+		for timestamp in timestamps:
+			if (now - timestamp) <= ttl:
+				hits += 1
+			else:
+				expired += 1
+		self.count(kind,hits,expired,num_lookups - hits - expired)
+	
+	def countSQL(self,seconds:float) -> None:
+		self.sql_statements += 1
+		self.sql_seconds += seconds
+	
+	def asDict(self) -> Dict[str,Any]:
+		return {
+			'lookups': OrderedDict(
+				(kind, {'hits': hits, 'expired': expired, 'misses': misses})
+				for kind, (hits, expired, misses) in self.lookups.items()
+			),
+			'sql_statements': self.sql_statements,
+			'sql_seconds': round(self.sql_seconds,3),
+		}
+
+def merge_reports(reports:List[Dict[str,Any]]) -> List[Dict[str,Any]]:
+	"""
+		It adds up the reports of the same cache, which come
+		from the different processes of the meta enricher
+	"""
+	merged = OrderedDict()
+	for report in reports:
+		prev = merged.get(report['cache'])
+		if prev is None:
+			merged[report['cache']] = _json_sum(None,report)
+		else:
+			_json_sum(prev,report)
+	
+	return list(merged.values())
+
+def _json_sum(dest:Any,src:Any) -> Any:
+	if isinstance(src,dict):
+		if dest is None:
+			dest = OrderedDict()
+		for key, val in src.items():
+			dest[key] = _json_sum(dest.get(key),val)
+		return dest
+	
+	if isinstance(src,(int,float)) and not isinstance(src,bool) and dest is not None:
+		return dest + src
+	
+	# Labels are kept
+	return src  if dest is None  else dest
+
+def format_report(report:Dict[str,Any]) -> List[str]:
+	"""
+		The human readable lines of the report of a cache
+	"""
+	lines = [
+		"Cache {}: {} SQL statements in {:.1f}s, {} payloads ({} bytes) decompressed".format(report['cache'],report['sql_statements'],report['sql_seconds'],report['decoded_payloads'],report['decoded_bytes'])
+	]
+	for kind, counters in report['lookups'].items():
+		num_lookups = counters['hits'] + counters['expired'] + counters['misses']
+		if num_lookups == 0:
+			continue
+		lines.append("\t{}: {} lookups, {} hits, {} expired, {} misses (hit rate {})".format(kind,num_lookups,counters['hits'],counters['expired'],counters['misses'],round(counters['hits'] / num_lookups,3)  if num_lookups > 0  else None))
+	
+	return lines
+
+class TimedCursor(sqlite3.Cursor):
+	"""
+		It accounts the time spent executing statements and fetching
+		their results. The rows iterated one by one are not accounted
+	"""
+	def _timed(self,method,*args):
+		start = time.perf_counter()
+		try:
+			return method(self,*args)
+		finally:
+			stats = self.connection.stats
+			if stats is not None:
+				stats.countSQL(time.perf_counter() - start)
+	
+	def execute(self,*args):
+		return self._timed(sqlite3.Cursor.execute,*args)
+	
+	def executemany(self,*args):
+		return self._timed(sqlite3.Cursor.executemany,*args)
+	
+	def executescript(self,*args):
+		return self._timed(sqlite3.Cursor.executescript,*args)
+	
+	def fetchone(self):
+		return self._timed(sqlite3.Cursor.fetchone)
+	
+	def fetchmany(self,*args):
+		return self._timed(sqlite3.Cursor.fetchmany,*args)
+	
+	def fetchall(self):
+		return self._timed(sqlite3.Cursor.fetchall)
+
+class TimedConnection(sqlite3.Connection):
+	"""
+		Connection factory whose cursors account their time
+		in the stats attribute, which must be set after connecting
+	"""
+	stats = None
+	
+	def cursor(self,factory=TimedCursor):
+		return super().cursor(factory)
+	
+	def execute(self,*args):
+		return self.cursor().execute(*args)
+	
+	def executemany(self,*args):
+		return self.cursor().executemany(*args)
+	
+	def executescript(self,*args):
+		return self.cursor().executescript(*args)
@@ -0,0 +1,436 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import datetime
+from typing import Tuple, List, Dict, Any, NewType, Iterator
+
+from . import pub_common
+from .pub_common import Timestamps
+from .payload_codec import PayloadCodec
+from .cache_stats import CacheStats, TimedConnection
+
+# Alias types declaration
+DOIId = NewType('DOIId',str)
+DOIHandle = NewType('DOIHandle',Dict[str,Any])
+
+import json
+import sqlite3
+from collections import OrderedDict
+from urllib import parse
+from urllib import request
+from urllib.error import HTTPError
+
+import re
+
+
+def _schema_tables(conn) -> None:
+	with conn:
+		# Tables for DOI checks
+		conn.execute("""
+CREATE TABLE IF NOT EXISTS doi_check (
+	doi VARCHAR(4096) NOT NULL,
+	payload BLOB NOT NULL,
+	valid_until TIMESTAMP NOT NULL
+)
+""")
+
+def _schema_unique_index(conn) -> None:
+	# Unique index needed by the upserts
+	pub_common.ensure_unique_index(conn,'doi_check_u','doi_check','doi COLLATE NOCASE')
+	with conn:
+		# Superseded by doi_check_u
+		conn.execute("""DROP INDEX IF EXISTS doi_check_doi""")
+
+class DOIChecker(object):
+	"""
+		The DOI caching checker
+		Currently, it stores the check of a DOI against 
+		PMC ids, DOIs and the internal identifier in the
+		original source.
+		Also, it stores the title, etc..
+		Also, it stores the citations fetched from the original source
+	"""
+	POS_CACHE_DAYS = 180
+	NEG_CACHE_DAYS = 7
+	
+	# See https://www.doi.org/factsheets/DOIHandle.html
+	# also https://www.doi.org/factsheets/DOIProxy.html
+	# also https://www.doi.org/doi_handbook/3_Resolution.html
+	# also https://www.doi.org/doi_handbook/5_Applications.html
+	
+	DOI_HANDLE_ENDPOINT='https://doi.org/api/handles/'
+	
+	DOI_METADATA_ENDPOINT='https://doi.org/'
+	DOI_METADATA_ACCEPT='application/vnd.citationstyles.csl+json, application/rdf+xml'
+	DOI_METADATA_AGENT='Mozilla/5.0 (Windows NT 6.1; Win64; x64; rv:59.0) Gecko/20100101 Firefox/82.0'
+	
+	DEFAULT_CHECK_DB_FILE="DOIcheck_CACHE.db"
+	
+	# Each schema version is reached applying its migration
+	# over the previous one. New ones must be appended
+	SCHEMA_MIGRATIONS = (
+		('DOI checks table', _schema_tables),
+		('Unique index for the upserts', _schema_unique_index),
+	)
+	
+	# The shape of the hot queries, checked by explainQueryPlans
+	QUERY_PLAN_AUDIT = (
+		('doi_check by doi', """
+SELECT valid_until, payload
+FROM doi_check
+WHERE doi COLLATE NOCASE IN (:id,:id_alt)
+"""),
+	)
+	
+	def __init__(self,cache_dir:str=".",codec:str=PayloadCodec.DEFAULT_CODEC,codec_level:int=PayloadCodec.DEFAULT_LEVEL,pos_cache_days:float=POS_CACHE_DAYS,neg_cache_days:float=NEG_CACHE_DAYS):
+		self.cache_dir = cache_dir
+		
+		# Time to live of the resolved and the unresolved DOIs
+		self.pos_ttl = datetime.timedelta(days=pos_cache_days)
+		self.neg_ttl = datetime.timedelta(days=neg_cache_days)
+		
+		# How the payloads are serialized and compressed
+		self.codec = PayloadCodec(codec,codec_level)
+		
+		# Lookups and time spent in SQLite
+		self.stats = CacheStats()
+		
+		#self.debug_cache_dir = os.path.join(cache_dir,'debug')
+		#os.makedirs(os.path.abspath(self.debug_cache_dir),exist_ok=True)
+		#self._debug_count = 0
+		
+		self.check_db_file = os.path.join(cache_dir,self.DEFAULT_CHECK_DB_FILE)
+		self.jd = json.JSONDecoder()
+		self.je = json.JSONEncoder()
+	
+	@classmethod
+	def KwargsFromConfig(cls,config,section_name:str) -> Dict[str,Any]:
+		"""
+			The constructor parameters (but the directory), read
+			from the cache_* keys of the configuration section
+		"""
+		return {
+			'codec': config.get(section_name,'cache_codec',fallback=PayloadCodec.DEFAULT_CODEC),
+			'codec_level': config.getint(section_name,'cache_codec_level',fallback=PayloadCodec.DEFAULT_LEVEL),
+			'pos_cache_days': config.getfloat(section_name,'cache_ttl_doi',fallback=cls.POS_CACHE_DAYS),
+			'neg_cache_days': config.getfloat(section_name,'cache_ttl_doi_negative',fallback=cls.NEG_CACHE_DAYS),
+		}
+	
+	def __enter__(self):
+		# Opening / creating the database, with normal locking
+		# and date parsing
+		self.conn = sqlite3.connect(self.check_db_file, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES, check_same_thread = False, factory=TimedConnection)
+		self.conn.stats = self.stats
+		self.conn.execute("""PRAGMA locking_mode = NORMAL""")
+		# Only effective on new databases (before switching to WAL),
+		# so the maintenance can release the freed pages
+		self.conn.execute("""PRAGMA auto_vacuum = INCREMENTAL""")
+		self.conn.execute("""PRAGMA journal_mode = WAL""")
+		
+		# Database structures, created or upgraded in place
+		pub_common.upgrade_schema(self.conn,self.SCHEMA_MIGRATIONS,self.check_db_file)
+		
+		with self.conn:
+			cur = self.conn.cursor()
+			
+			# Preset dictionaries of the payload codec
+			self.codec.initDictionaries_TL(cur)
+			if self.codec.needsDictionary:
+				self.codec.trainDictionary_TL(cur,['doi_check'])
+			
+			cur.close()
+			
+			
+		return self
+	
+	def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+		self.conn.close()
+	
+	def getCacheStats(self) -> Dict[str,Any]:
+		"""
+			The DOI lookups, the decompressed payloads and
+			the time spent in SQLite since the checker was created
+		"""
+		report = OrderedDict([
+			('cache', os.path.basename(self.check_db_file)),
+		])
+		report.update(self.stats.asDict())
+		report['decoded_payloads'] = self.codec.decoded_payloads
+		report['decoded_bytes'] = self.codec.decoded_bytes
+		
+		return report
+	
+	def _maintenanceTables(self) -> List[Tuple[str,str,str]]:
+		"""
+			The (table name, expiry condition, timestamp column) tuples
+			used by the maintenance. Here, the timestamp is the expiry one
+		"""
+		return [
+			('doi_check',"DATETIME('NOW') > valid_until",None),
+		]
+	
+	def sweepExpired(self,batch_size:int=pub_common.DEFAULT_BATCH_SIZE,verbose:bool=False) -> Dict[str,int]:
+		"""
+			It removes the expired rows, in batches.
+			It returns the number of removed rows per table
+		"""
+		return {
+			table_name: pub_common.delete_in_batches(self.conn,table_name,condition,batch_size=batch_size,label=table_name  if verbose  else None)
+			for table_name, condition, _ in self._maintenanceTables()
+		}
+	
+	def getTableReport(self) -> List[Dict[str,Any]]:
+		return pub_common.table_report(self.conn,self._maintenanceTables())
+	
+	def optimize(self,full_vacuum:bool=False) -> bool:
+		return pub_common.optimize_database(self.conn,full_vacuum)
+	
+	# Number of snapshot records imported on each transaction
+	SNAPSHOT_BATCH_SIZE = 1000
+	
+	def _snapshotRecords(self,since:datetime.datetime=None) -> Iterator[Dict[str,Any]]:
+		"""
+			The rows only keep their expiry timestamp, so the ones checked
+			since the given timestamp are a subset of the exported ones
+		"""
+		params = {'since_valid': since + self.neg_ttl  if since is not None  else None}
+		cur = self.conn.cursor()
+		for res in cur.execute("""
+SELECT doi, valid_until, payload
+FROM doi_check
+WHERE :since_valid IS NULL OR valid_until >= :since_valid
+""",params):
+			yield {
+				'table': 'doi_check',
+				'doi': res[0],
+				'valid_until': pub_common.snapshot_timestamp(Timestamps.UTCTimestamp(res[1])),
+				'payload': self.codec.decode(res[2])
+			}
+		
+		cur.close()
+	
+	def exportSnapshot(self,snapshot_file:str,since:datetime.datetime=None) -> Dict[str,int]:
+		"""
+			It writes a snapshot of the DOI checks, or only of the
+			ones done since the given timestamp (for incremental exports).
+			It returns the number of exported rows
+		"""
+		with self.conn:
+			return pub_common.write_snapshot(snapshot_file,'doi',since,self._snapshotRecords(since))
+	
+	def _importRecords_TL(self,cur,records:List[Dict[str,Any]]) -> None:
+		cur.executemany("""
+INSERT INTO doi_check(doi,payload,valid_until) VALUES(:doi,:payload,:valid_until)
+ON CONFLICT(doi COLLATE NOCASE) DO UPDATE SET
+doi = excluded.doi,
+payload = excluded.payload,
+valid_until = excluded.valid_until
+WHERE excluded.valid_until > doi_check.valid_until
+""",[
+			{
+				'doi': record['doi'],
+				'payload': self.codec.encode(record['payload']),
+				'valid_until': pub_common.parse_snapshot_timestamp(record['valid_until'])
+			}
+			for record in records
+		])
+	
+	def importSnapshot(self,snapshot_file:str) -> Dict[str,int]:
+		"""
+			It merges a snapshot into the DOI checks cache, where
+			the check lasting longer wins. It returns the number of read rows
+		"""
+		num_records = 0
+		records = []
+		for record in pub_common.read_snapshot(snapshot_file,'doi'):
+			if record.get('table') != 'doi_check':
+				raise Exception('Unknown table {} in DOI checks snapshot'.format(record.get('table')))
+			
+			records.append(record)
+			num_records += 1
+			if len(records) >= self.SNAPSHOT_BATCH_SIZE:
+				with self.conn:
+					self._importRecords_TL(self.conn.cursor(),records)
+				records = []
+		
+		if records:
+			with self.conn:
+				self._importRecords_TL(self.conn.cursor(),records)
+		
+		return {'doi_check': num_records}
+	
+	def explainQueryPlans(self) -> List[Tuple[str,List[str],bool]]:
+		"""
+			It returns the query plans of the hot queries, telling
+			which ones do a full scan of a cache table
+		"""
+		with self.conn:
+			cur = self.conn.cursor()
+			return pub_common.explain_query_plans(cur,self.QUERY_PLAN_AUDIT)
+	
+	
+	DOI_PATTERN = re.compile('^doi:\s*(.*)',re.I)
+	
+	@classmethod
+	def normalize_doi(cls,doi_id):
+		"""
+		If the method returns None, it means the input
+		is not a valid DOI
+		"""
+		found_pat = cls.DOI_PATTERN.search(doi_id)
+		if found_pat:
+			# It is already a CURI
+			doi_id = found_pat.group(1)
+		elif doi_id.startswith('http'):
+			# It is an URL
+			parsed_doi_id = parse.urlparse(doi_id)
+			if parsed_doi_id.netloc.endswith('doi.org'):
+				# Removing the initial slash
+				doi_id = parsed_doi_id.path[1:]
+		
+		return doi_id.upper()
+	
+	@classmethod
+	def doi2curie(cls,doi_id):
+		return str(doi_id) if doi_id.startswith('doi:') else 'doi:'+doi_id
+	
+	def check_normalize_doi(self,doi_id):
+		"""
+		If the method returns None, it means the input
+		is not a valid DOI
+		"""
+		
+		# First, normalize it
+		doi_id_norm = self.normalize_doi(doi_id)
+		
+		# Cached resolutions of any of both forms are used
+		resolution = self.getCachedResolution(doi_id_norm)
+		if resolution is None:
+			doi_id_alt = doi_id_norm[:-1]  if doi_id_norm[-1] == '.'  else  doi_id_norm+'.'
+			resolution = self.resolveDOI(doi_id_norm)
+			if not self.isResolved(resolution):
+				alt_resolution = self.resolveDOI(doi_id_alt)
+				if self.isResolved(alt_resolution):
+					resolution = alt_resolution
+			
+			self.setCachedResolution(resolution)
+		
+		return resolution['doi']  if self.isResolved(resolution)  else None
+	
+	@classmethod
+	def isResolved(cls,resolution:DOIHandle) -> bool:
+		# See https://www.handle.net/proxy_servlet.html for the response codes
+		return resolution.get('responseCode') == 1
+	
+	def resolveDOI(self,doi:DOIId) -> DOIHandle:
+		"""
+			It asks the DOI proxy for the handle of the DOI. Unknown
+			DOIs are also returned, with their response code
+		"""
+		handle_url = self.DOI_HANDLE_ENDPOINT + parse.quote(doi,safe='/')
+		handleReq = request.Request(handle_url,headers={'User-Agent': self.DOI_METADATA_AGENT})
+		try:
+			with request.urlopen(handleReq,timeout=60) as res:
+				raw_json_handle = pub_common.full_http_read(res)
+		except HTTPError as e:
+			# Unknown handles are answered with 404 and a JSON body
+			if e.code != 404:
+				raise e
+			raw_json_handle = pub_common.full_http_read(e)
+		
+		handle = self.jd.decode(raw_json_handle.decode('utf-8'))
+		
+		return {
+			'doi': doi,
+			'responseCode': handle.get('responseCode'),
+			'handle': handle.get('handle'),
+		}
+	
+	def getRawCachedResolutions_TL(self,doi_list:Iterator[DOIId]) -> Iterator[Tuple[datetime.datetime,DOIHandle]]:
+		"""
+			This method does not invalidate the cache
+		"""
+		
+		cur = self.conn.cursor()
+		for doi in doi_list:
+			doi_alt = doi[:-1]  if doi[-1] == '.'  else  doi+'.'
+			
+			# The comparison must be NOCASE, so the index is used
+			cur.execute("""
+SELECT valid_until, payload
+FROM doi_check
+WHERE
+doi COLLATE NOCASE IN (:id,:id_alt)
+""",{'id': doi,'id_alt': doi_alt})
+			res = cur.fetchone()
+			if res:
+				yield Timestamps.UTCTimestamp(res[0]), self.codec.decode(res[1])
+			else:
+				yield None, None
+	
+	def getRawCachedResolutions(self,doi_list:Iterator[DOIId]) -> Iterator[Tuple[datetime.datetime,DOIHandle]]:
+		"""
+			This method does not invalidate the cache
+		"""
+		
+		with self.conn:
+			for res_timestamp, resolution in self.getRawCachedResolutions_TL(doi_list):
+				yield res_timestamp, resolution
+	
+	def getRawCachedResolution_TL(self,doi:DOIId) -> Tuple[datetime.datetime,DOIHandle]:
+		for res_timestamp, resolution in self.getRawCachedResolutions_TL([doi]):
+			return res_timestamp, resolution
+	
+	def getRawCachedResolution(self,doi:DOIId) -> Tuple[datetime.datetime,DOIHandle]:
+		for res_timestamp, resolution in self.getRawCachedResolutions([doi]):
+			return res_timestamp, resolution
+	
+	def getCachedResolution(self,doi:DOIId) -> DOIHandle:
+		res_timestamp , resolution = self.getRawCachedResolution(doi)
+		
+		# Invalidate cache
+		if res_timestamp is None:
+			self.stats.count('doi',misses=1)
+		elif Timestamps.UTCTimestamp(datetime.datetime.utcnow()) > res_timestamp:
+			self.stats.count('doi',expired=1)
+			resolution = None
+		else:
+			self.stats.count('doi',hits=1)
+		
+		return resolution
+	
+	def validUntil(self,resolved:bool) -> datetime.datetime:
+		"""
+			The expiry timestamp of a resolution stored now
+		"""
+		return Timestamps.UTCTimestamp(datetime.datetime.utcnow()) + (self.pos_ttl  if resolved  else self.neg_ttl)
+	
+	def setCachedResolutions(self,res_iter:Iterator[DOIHandle],valid_timestamp:datetime.datetime = None) -> None:
+		"""
+			Without an explicit expiry timestamp, each resolution
+			expires following the TTL of resolved or unresolved DOIs
+		"""
+		params_list = [
+			{
+				'doi': resolution['doi'],
+				'payload': self.codec.encode(resolution),
+				'valid_until': valid_timestamp  if valid_timestamp is not None  else self.validUntil(self.isResolved(resolution))
+			}
+			for resolution in res_iter
+		]
+		
+		if params_list:
+			# Only one transaction for the whole batch
+			with self.conn:
+				cur = self.conn.cursor()
+				cur.executemany("""
+INSERT INTO doi_check(doi,payload,valid_until) VALUES(:doi,:payload,:valid_until)
+ON CONFLICT(doi COLLATE NOCASE) DO UPDATE SET
+doi = excluded.doi,
+payload = excluded.payload,
+valid_until = excluded.valid_until
+""",params_list)
+	
+	def setCachedResolution(self,resolution:DOIHandle,res_timestamp:datetime.datetime = None) -> None:
+		self.setCachedResolutions([resolution],res_timestamp)
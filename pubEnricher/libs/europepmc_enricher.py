@@ -7,6 +7,7 @@ import math
 import re
 import configparser
 
+from concurrent.futures import Executor, ThreadPoolExecutor
 from urllib import request
 from urllib import parse
 from urllib.error import *
@@ -22,6 +23,7 @@ from . import pub_common
 
 class EuropePMCEnricher(AbstractPubEnricher):
 	DEFAULT_CITREF_PAGESIZE=100
+	DEFAULT_CITREF_WORKERS=4
 	
 	@overload
 	def __init__(self,cache:str=".",prefix:str=None,config:configparser.ConfigParser=None,debug:bool=False,doi_checker:DOIChecker=None):
@@ -42,11 +44,29 @@ class EuropePMCEnricher(AbstractPubEnricher):
 		section_name = self.Name()
 		
 		self.citref_step_size = self.config.getint(section_name,'citref_step_size',fallback=self.DEFAULT_CITREF_PAGESIZE)
+		
+		# Should the expired lists be refreshed fetching only what is new?
+		self.citref_incremental = self.config.getboolean(section_name,'citref_incremental',fallback=True)
+		
+		# Should the metadata in the lists be kept as partial mappings?
+		self.citref_partial_mappings = self.config.getboolean(section_name,'citref_partial_mappings',fallback=True)
+		
+		# How many pages and publications are fetched at once. The
+		# request rate to the server is still bound by request_delay
+		self.citref_workers = max(1,self.config.getint(section_name,'citref_workers',fallback=self.DEFAULT_CITREF_WORKERS))
 	
 	@classmethod
 	def Name(cls) -> str:
 		return 'europepmc'
+	
+	def estimateCitRefsRequests(self,citref_counts:List[Dict[bool,int]]) -> int:
+		# One request per page of each list, and at least one. The
+		# incremental refreshes usually need the first and the last ones
+		if self.citref_incremental:
+			return sum(min(2,max(1,math.ceil(citref_count / self.citref_step_size)))  if citref_count is not None  else 1  for counts in citref_counts  for citref_count in counts.values())
 		
+		return sum(max(1,math.ceil(citref_count / self.citref_step_size))  if citref_count is not None  else 1  for counts in citref_counts  for citref_count in counts.values())
+	
 	# Documentation at: https://europepmc.org/RestfulWebService#search
 	# Documentation at: https://europepmc.org/docs/EBI_Europe_PMC_Web_Service_Reference.pdf
 	OPENPMC_SEARCH_URL = 'https://www.ebi.ac.uk/europepmc/webservices/rest/search'
@@ -76,6 +96,9 @@ class EuropePMCEnricher(AbstractPubEnricher):
 			searchURL = self.OPENPMC_SEARCH_URL+'?'+parse.urlencode(theQuery,encoding='utf-8')
 			#sys.exit(1)
 
+			# Avoiding to hit the server too fast
+			self.waitRequestSlot(searchURL)
+			
 			# Queries with retries
 			searchReq = request.Request(searchURL)
 			raw_json_pubs_mappings = self.retriable_full_http_read(searchReq,debug_url=searchURL)
@@ -87,9 +110,6 @@ class EuropePMCEnricher(AbstractPubEnricher):
 			
 			pubs_mappings = self.jd.decode(raw_json_pubs_mappings.decode('utf-8'))
 			
-			# Avoiding to hit the server too fast
-			time.sleep(self.request_delay)
-			
 			resultList = pubs_mappings.get('resultList')
 			if resultList is not None and 'result' in resultList:
 				internal_ids_dict = { (partial_mapping['id'],partial_mapping['source']): partial_mapping  for partial_mapping in partial_mappings }
@@ -169,6 +189,9 @@ class EuropePMCEnricher(AbstractPubEnricher):
 			}
 			searchURL = self.OPENPMC_SEARCH_URL+'?'+parse.urlencode(theQuery,encoding='utf-8')
 			
+			# Avoiding to hit the server too fast
+			self.waitRequestSlot(searchURL)
+			
 			# Queries with retries
 			searchReq = request.Request(searchURL)
 			raw_json_pubs_mappings = self.retriable_full_http_read(searchReq,debug_url=searchURL)
@@ -180,9 +203,6 @@ class EuropePMCEnricher(AbstractPubEnricher):
 			
 			pubs_mappings = self.jd.decode(raw_json_pubs_mappings.decode('utf-8'))
 			
-			# Avoiding to hit the server too fast
-			time.sleep(self.request_delay)
-			
 			resultList = pubs_mappings.get('resultList')
 			if resultList is not None and 'result' in resultList:
 				# Gathering results
@@ -233,7 +253,39 @@ class EuropePMCEnricher(AbstractPubEnricher):
 	# Documentation at: https://europepmc.org/RestfulWebService#cites
 	#Url used to retrive the citations, i.e MED is publications from PubMed and MEDLINE view https://europepmc.org/RestfulWebService;jsessionid=7AD7C81CF5F041840F59CF49ABB29994#cites
 	CITREF_ENDPOINT_URL = "https://www.ebi.ac.uk/europepmc/webservices/rest/"
-	def querySingleCitRef(self,source_id:str,_id:str,query_mode:bool) -> Tuple[List[Dict[str,Any]],int]:
+	@classmethod
+	def _citRefPartialMapping(cls,citref:Dict[str,Any]) -> Dict[str,Any]:
+		"""
+			The partial mapping of a listed publication, from the metadata
+			in the list. It only has the fields the list tells, so its DOI
+			(and the PMC id of PubMed ones) is missing
+		"""
+		source_id = citref['source']
+		partial_mapping = {
+			'id': citref['id'],
+			'source': source_id,
+			'year': int(citref['pubYear'])
+		}
+		if citref.get('title') is not None:
+			partial_mapping['title'] = citref['title']
+		if citref.get('journalAbbreviation') is not None:
+			partial_mapping['journal'] = citref['journalAbbreviation']
+		if citref.get('authorString') is not None:
+			partial_mapping['authors'] = list(filter(lambda author: len(author) > 0 , re.split(r"[.,]+\s*",citref['authorString'])))
+		if source_id == 'MED':
+			partial_mapping['pmid'] = citref['id']
+		elif source_id == 'PMC':
+			partial_mapping['pmcid'] = citref['id']
+		
+		return partial_mapping
+	
+	def _querySingleCitRefPage(self,source_id:str,_id:str,query_mode:bool,page:int,partials:Dict[Tuple[str,str],Dict[str,Any]]=None) -> Tuple[List[Dict[str,Any]],int]:
+		"""
+			It fetches a page of the citations or references, returning
+			it along with the total count. A missing publication
+			gives None. When partials is given, the partial mappings
+			of the listed publications are stored there
+		"""
 		if query_mode:
 			query = 'citations'
 			citref_list_key = 'citationList'
@@ -243,91 +295,165 @@ class EuropePMCEnricher(AbstractPubEnricher):
 			citref_list_key = 'referenceList'
 			citref_key = 'reference'
 		
-		pageSize = self.citref_step_size
-		page = 1
-		citref_count = None
-		pages = None
+		partialURL = '/'.join(map(lambda elem: parse.quote(str(elem),safe='') , [source_id,_id,query,page,self.citref_step_size,'json']))
+		citref_url = parse.urljoin(self.CITREF_ENDPOINT_URL,partialURL)
+		
+		# Avoiding to hit the server too fast, even from several threads
+		self.waitRequestSlot(citref_url)
+		
+		# Queries with retries
+		citrefReq = request.Request(citref_url)
+		try:
+			raw_json_citrefs = self.retriable_full_http_read(citrefReq,debug_url=citref_url)
+			
+			#debug_cache_filename = os.path.join(self.debug_cache_dir,'cite_' + str(self._debug_count) + '.json')
+			#self._debug_count += 1
+			#with open(debug_cache_filename,mode="wb") as d:
+			#	d.write(raw_json_citrefs)
+			
+			citref_res = self.jd.decode(raw_json_citrefs.decode('utf-8'))
+		except HTTPError as e:
+			if e.code == 404:
+				return None
+			else:
+				raise e
+		
 		citrefs = []
-		while page:
-			partialURL = '/'.join(map(lambda elem: parse.quote(str(elem),safe='') , [source_id,_id,query,page,pageSize,'json']))
-			citref_url = parse.urljoin(self.CITREF_ENDPOINT_URL,partialURL)
+		if citref_list_key in citref_res:
+			if citref_key in citref_res[citref_list_key]:
+				citref_list = citref_res[citref_list_key][citref_key]
+				for citref in citref_list:
+					pubYear = citref['pubYear']
+					filtered_citref = {
+						'id': citref.get('id'),
+						'source': citref.get('source')
+					}
+					if pubYear is not None:
+						filtered_citref['year'] = int(pubYear)
+						if partials is not None and filtered_citref['id'] is not None and filtered_citref['source'] is not None:
+							partials[(filtered_citref['source'],filtered_citref['id'])] = self._citRefPartialMapping(citref)
+					
+					citrefs.append(filtered_citref)
+		
+		return citrefs, citref_res.get('hitCount',0)
+	
+	def querySingleCitRef(self,source_id:str,_id:str,query_mode:bool,cached_citrefs:List[Dict[str,Any]]=None,partials:Dict[Tuple[str,str],Dict[str,Any]]=None,executor:Executor=None) -> Tuple[List[Dict[str,Any]],int]:
+		"""
+			When the previous list is given, only the pages needed to
+			get what is new are fetched. As the lists only grow, an
+			unchanged count means an unchanged list. When an executor
+			is given, the pages after the first one are fetched through it
+		"""
+		first_page = self._querySingleCitRefPage(source_id,_id,query_mode,1,partials)
+		if first_page is None:
+			# Needed to properly cache the negative result
+			return None, 0
+		
+		citrefs, citref_count = first_page
+		pages = math.ceil(citref_count/self.citref_step_size)
+		pages_citrefs = { 1: citrefs }
+		
+		if cached_citrefs is not None and citref_count >= len(cached_citrefs):
+			num_new = citref_count - len(cached_citrefs)
+			if num_new == 0:
+				return cached_citrefs, citref_count
 			
-			# Queries with retries
-			citrefReq = request.Request(citref_url)
-			try:
-				raw_json_citrefs = self.retriable_full_http_read(citrefReq,debug_url=citref_url)
+			# The new ones are either at the head or at the tail of the
+			# list, so the pages are fetched backwards from the last one
+			known = set((citref.get('source'),citref.get('id'))  for citref in cached_citrefs)
+			new_citrefs = []
+			page = 1
+			while True:
+				for citref in pages_citrefs[page]:
+					citref_key = (citref.get('source'),citref.get('id'))
+					if citref_key not in known:
+						known.add(citref_key)
+						new_citrefs.append(citref)
 				
-				#debug_cache_filename = os.path.join(self.debug_cache_dir,'cite_' + str(self._debug_count) + '.json')
-				#self._debug_count += 1
-				#with open(debug_cache_filename,mode="wb") as d:
-				#	d.write(raw_json_citrefs)
+				if len(new_citrefs) >= num_new:
+					if self._debug:
+						print("DEBUG EuropePMC {} {} {}: {} new, {} of {} pages fetched".format(source_id,_id,'citations'  if query_mode  else 'references',len(new_citrefs),len(pages_citrefs),pages),file=sys.stderr)
+					return cached_citrefs + new_citrefs, citref_count
 				
-				citref_res = self.jd.decode(raw_json_citrefs.decode('utf-8'))
-				
-				# Avoiding to hit the server too fast
-				time.sleep(self.request_delay)
-			except HTTPError as e:
-				if e.code == 404:
-					citrefs = None
-					# Needed to properly cache the negative result
-					citref_count = 0
-					# We need to go out the outer loop
+				page = pages  if page == 1  else page - 1
+				if page <= 1:
 					break
-				else:
-					raise e
-			
-			if citref_count is None:
-				citref_count = citref_res.get('hitCount',0)
-				
-				if citref_count == 0 :
-					page = 0
-					pages = 0
-				else:
-					pages = math.ceil(citref_count/pageSize)
 				
-			if citref_list_key in citref_res:
-				if citref_key in citref_res[citref_list_key]:
-					citref_list = citref_res[citref_list_key][citref_key]
-					for citref in citref_list:
-						pubYear = citref['pubYear']
-						filtered_citref = {
-							'id': citref.get('id'),
-							'source': citref.get('source')
-						}
-						if pubYear is not None:
-							filtered_citref['year'] = int(pubYear)
-						
-						citrefs.append(filtered_citref)
-			
-			if page < pages:
-				# Next Page
-				page += 1
-			else:
-				page = None
+				fetched_page = self._querySingleCitRefPage(source_id,_id,query_mode,page,partials)
+				if fetched_page is None:
+					return None, 0
+				pages_citrefs[page] = fetched_page[0]
 		
+		# The whole list, reusing the already fetched pages
+		missing_pages = [ page  for page in range(2,pages+1)  if page not in pages_citrefs ]
+		if executor is not None and len(missing_pages) > 1:
+			fetched_pages = executor.map(lambda page: self._querySingleCitRefPage(source_id,_id,query_mode,page,partials),missing_pages)
+		else:
+			fetched_pages = map(lambda page: self._querySingleCitRefPage(source_id,_id,query_mode,page,partials),missing_pages)
 		
-		return citrefs,citref_count				
+		for page, fetched_page in zip(missing_pages,fetched_pages):
+			if fetched_page is None:
+				return None, 0
+			pages_citrefs[page] = fetched_page[0]
+		
+		citrefs = [ citref  for page in range(1,pages+1)  for citref in pages_citrefs.get(page,[]) ]
+		
+		return citrefs,citref_count
+	
+	def _queryPubCitRefs(self,pub_field:Dict[str,Any],mode:int,cached_citations,cached_references,partials:Dict[Tuple[str,str],Dict[str,Any]],executor:Executor=None) -> Dict[str,Any]:
+		"""
+			It fetches the lists of a single publication
+		"""
+		_id = pub_field['id']
+		source_id = pub_field['source']
+		citref = {
+			'id': _id,
+			'source': source_id,
+		}
+		
+		if (mode & 2) != 0 and (pub_field.get('citations') is None):
+			_, cached_citrefs = cached_citations.get((source_id,_id),(None, None))
+			citations, citation_count = self.querySingleCitRef(source_id,_id,True,cached_citrefs,partials,executor)
+			citref['citations'] = citations
+			citref['citation_count'] = citation_count
+		
+		if (mode & 1) != 0 and (pub_field.get('references') is None):
+			_, cached_citrefs = cached_references.get((source_id,_id),(None, None))
+			references, reference_count = self.querySingleCitRef(source_id,_id,False,cached_citrefs,partials,executor)
+			citref['references'] = references
+			citref['reference_count'] = reference_count
+		
+		return citref
 	
 	# Documentation at: https://europepmc.org/RestfulWebService#cites
 	CITATION_URL = "https://www.ebi.ac.uk/europepmc/webservices/rest/"
 	def queryCitRefsBatch(self,query_citrefs_data:Iterator[Dict[str,Any]],minimal:bool=False,mode:int=3) -> Iterator[Dict[str,Any]]:
-		for pub_field in query_citrefs_data:
-			_id = pub_field.get('id') #11932250
-			if _id is not None:
-				source_id = pub_field['source']
-				citref = {
-					'id': _id,
-					'source': source_id,
-				}
-				
-				if (mode & 2) != 0 and (pub_field.get('citations') is None):
-					citations, citation_count = self.querySingleCitRef(source_id,_id,True)
-					citref['citations'] = citations
-					citref['citation_count'] = citation_count
-				
-				if (mode & 1) != 0 and (pub_field.get('references') is None):
-					references, reference_count = self.querySingleCitRef(source_id,_id,False)
-					citref['references'] = references
-					citref['reference_count'] = reference_count
-				
-				yield citref
+		# The previous lists, even the expired ones, are the base of the
+		# incremental refresh
+		query_citrefs_data = [ pub_field  for pub_field in query_citrefs_data  if pub_field.get('id') is not None ]
+		qual_ids = [ (pub_field['source'],pub_field['id'])  for pub_field in query_citrefs_data ]
+		cached_citations = self.pubC.getRawCitRefsBulk(qual_ids,True)  if self.citref_incremental and qual_ids and (mode & 2) != 0  else {}
+		cached_references = self.pubC.getRawCitRefsBulk(qual_ids,False)  if self.citref_incremental and qual_ids and (mode & 1) != 0  else {}
+		partials = {}  if self.citref_partial_mappings  else None
+		
+		if self.citref_workers > 1:
+			# The publications are fetched concurrently, and their
+			# remaining pages in a pool of their own, so a publication
+			# waiting for its pages never holds the worker they need
+			with ThreadPoolExecutor(max_workers=self.citref_workers) as pub_executor, ThreadPoolExecutor(max_workers=self.citref_workers) as page_executor:
+				futures = [ pub_executor.submit(self._queryPubCitRefs,pub_field,mode,cached_citations,cached_references,partials,page_executor)  for pub_field in query_citrefs_data ]
+				try:
+					# In the same order they were asked
+					for future in futures:
+						yield future.result()
+				finally:
+					for future in futures:
+						future.cancel()
+		else:
+			for pub_field in query_citrefs_data:
+				yield self._queryPubCitRefs(pub_field,mode,cached_citations,cached_references,partials)
+		
+		# The metadata of the listed publications, so populatePubIds
+		# does not search them again when it is enough
+		if partials:
+			self.pubC.setPartialMappings(partials.values())
@@ -1,6 +1,7 @@
 #!/usr/bin/python
 
 import sys
+import os
 import json
 import re
 import configparser
@@ -50,6 +51,14 @@ def _multiprocess_target(qr, qs, enricher_class, *args):
 				method = enricher.cachedQueryPubIds
 			elif command == 'listReconcileCitRefMetricsBatch':
 				method = enricher.listReconcileCitRefMetricsBatch
+			elif command == 'getCacheStats':
+				method = enricher.getCacheStats
+			elif command == 'planCosts':
+				method = enricher.planCosts
+			elif command == 'revalidateStale':
+				method = enricher.revalidateStale
+			elif command == 'refreshCache':
+				method = enricher.refreshCache
 			elif command == 'enter':
 				method = enricher.__enter__
 			elif command == 'exit':
@@ -130,14 +139,14 @@ class MetaEnricher(SkeletonPubEnricher):
 		else:
 			cache_dir = cache.cache_dir
 		
+		# The section name is the symbolic name given to this class
+		section_name = self.Name()
+		
 		if isinstance(cache,PubDBCache):
 			# Try using same checker instance everywhere
 			doi_checker = cache.doi_checker
 		elif doi_checker is None:
-			doi_checker = DOIChecker(cache_dir)
-		
-		# The section name is the symbolic name given to this class
-		section_name = self.Name()
+			doi_checker = DOIChecker(cache_dir,**DOIChecker.KwargsFromConfig(config,section_name))
 		
 		# Create the instances needed by this meta enricher
 		use_enrichers_str = config.get(section_name,'use_enrichers',fallback=None)
@@ -160,13 +169,21 @@ class MetaEnricher(SkeletonPubEnricher):
 		
 		# And the meta-cache
 		if type(cache) is str:
-			pubC = PubDBCache(section_name,cache_dir = cache_dir,prefix=meta_prefix,doi_checker=doi_checker)
+			pubC = PubDBCache(section_name,cache_dir = cache_dir,prefix=meta_prefix,doi_checker=doi_checker,**PubDBCache.KwargsFromConfig(config,section_name))
 		else:
 			pubC = cache
 		
 		super().__init__(pubC,meta_prefix,config,debug,doi_checker)
 		
 		self.enrichers_pool = enrichers_pool
+		
+		# The caches of the subordinated enrichers, which are attached
+		# to the meta cache to resolve their publications with joins
+		self.lower_db_files = OrderedDict()
+		if config.getboolean(section_name,'attach_lower_caches',fallback=True):
+			for enricher_name in enrichers_pool.keys():
+				lower_prefix = prefix + '_' + enricher_name  if prefix  else enricher_name
+				self.lower_db_files[enricher_name] = os.path.join(cache_dir,lower_prefix + '_' + PubDBCache.DEFAULT_CACHE_DB_FILE)
 	
 	def __del__(self):
 		# Try terminating subordinated processes
@@ -193,6 +210,9 @@ class MetaEnricher(SkeletonPubEnricher):
 			self.__del__()
 			raise MetaEnricherException("__enter__ nested exception",exc)
 		
+		# Their databases exist from now on
+		self.pubC.attachLowerCaches(self.lower_db_files)
+		
 		return self
 	
 	def __exit__(self, exc_type, exc_val, exc_tb):
@@ -207,6 +227,127 @@ class MetaEnricher(SkeletonPubEnricher):
 		
 		return self
 	
+	def getCacheStats(self) -> List[Dict[str,Any]]:
+		"""
+			The statistics of the meta cache, along with the ones
+			of the caches of the subordinated enrichers
+		"""
+		reports = super().getCacheStats()
+		for eptuple in self.enrichers_pool.values():
+			eptuple[1].put(('getCacheStats',[]))
+		
+		for eptuple in self.enrichers_pool.values():
+			retval = eptuple[2].get()
+			
+			# Statistics are not worth failing
+			if isinstance(retval,str):
+				print("ERROR: Cache statistics from {} could not be gathered\n{}".format(eptuple[3],retval),file=sys.stderr)
+			else:
+				reports.extend(retval)
+		
+		return reports
+	
+	def _renewMappings(self,qual_ids:List[Tuple[str,str]]) -> None:
+		"""
+			The meta mappings are merged from the ones of the subordinated
+			enrichers, so they are renewed merging them again, through
+			the publish ids of each publication
+		"""
+		query_ids = []
+		for (_, _id), (_, old_mapping) in zip(qual_ids,self.pubC.getRawCachedMappings(qual_ids)):
+			query_id = {}
+			if old_mapping is not None:
+				for key in ('pmid','doi','pmcid'):
+					if old_mapping.get(key) is not None:
+						query_id[key] = old_mapping[key]
+			
+			# The id of a meta mapping is one of its publish ids
+			if not query_id:
+				query_id = self._publishIdQuery(_id)
+			
+			query_ids.append(query_id)
+		
+		self._queryPubIdsInBatches(query_ids)
+	
+	def revalidateStale(self,budget:int=None) -> int:
+		"""
+			The stale entries of the meta cache are revalidated through
+			the subordinated enrichers, which later revalidate their own
+			stale entries, each one within its own budget
+		"""
+		spent = super().revalidateStale(budget)
+		for eptuple in self.enrichers_pool.values():
+			eptuple[1].put(('revalidateStale',[]))
+		
+		for eptuple in self.enrichers_pool.values():
+			retval = eptuple[2].get()
+			
+			# The results were already written
+			if isinstance(retval,str):
+				print("ERROR: Stale entries from {} could not be revalidated\n{}".format(eptuple[3],retval),file=sys.stderr)
+			else:
+				spent += retval
+		
+		return spent
+	
+	def refreshCache(self,budget:int=None) -> int:
+		"""
+			The meta cache is refreshed through the subordinated enrichers,
+			which later refresh their own caches, each one within its
+			own budget
+		"""
+		spent = super().refreshCache(budget)
+		for eptuple in self.enrichers_pool.values():
+			eptuple[1].put(('refreshCache',[]))
+		
+		exc = []
+		for eptuple in self.enrichers_pool.values():
+			retval = eptuple[2].get()
+			
+			if isinstance(retval,str):
+				exc.append((eptuple[3],retval))
+			else:
+				spent += retval
+		
+		if len(exc) > 0:
+			raise MetaEnricherException('refreshCache nested exception',exc)
+		
+		return spent
+	
+	# The requests are issued by the subordinated enrichers
+	PUB_IDS_REQUESTS_PER_BATCH = 0
+	
+	def estimateCitRefsRequests(self,citref_counts:List[Dict[bool,int]]) -> int:
+		return 0
+	
+	def estimatePopulationRequests(self,num_mappings:int) -> int:
+		return 0
+	
+	def planCosts(self,entries:List[Dict[str,Any]],verbosityLevel:float=0,mode:int=3) -> List[Dict[str,Any]]:
+		"""
+			The plan of the meta cache, along with the plans of the
+			subordinated enrichers. These ones are computed over all the
+			entries, so they do not discount what the meta cache holds
+		"""
+		plan = super().planCosts(entries,verbosityLevel,mode)
+		params = [entries,verbosityLevel,mode]
+		for eptuple in self.enrichers_pool.values():
+			eptuple[1].put(('planCosts',params))
+		
+		exc = []
+		for eptuple in self.enrichers_pool.values():
+			retval = eptuple[2].get()
+			
+			if isinstance(retval,str):
+				exc.append((eptuple[3],retval))
+			else:
+				plan.extend(retval)
+		
+		if len(exc) > 0:
+			raise MetaEnricherException('planCosts nested exception',exc)
+		
+		return plan
+	
 	# Do not change this constant!!!
 	META_SOURCE='meta'
 	
@@ -394,9 +535,8 @@ class MetaEnricher(SkeletonPubEnricher):
 		# Now, time to check and update cache
 		partialToBeSearched = []
 		i2e = {}
-		for iPartial, partial_mapping in enumerate(partial_mappings):
-			cached_mappings = self.pubC.getRawCachedMappingsFromPartial(partial_mapping)
-			
+		cached_mappings_list = self.pubC.getRawCachedMappingsFromPartials(partial_mappings)
+		for iPartial, (partial_mapping, cached_mappings) in enumerate(zip(partial_mappings,cached_mappings_list)):
 			if cached_mappings:
 				# Right now, we are not going to deal with conflicts at this level
 				partial_mapping.update(cached_mappings[0])
@@ -458,6 +598,10 @@ class MetaEnricher(SkeletonPubEnricher):
 				# Now, time to check and update cache
 				citRefsToBeSearched = []
 				citRefsBaseHash = {}
+				
+				# All the cache lookups are done in bulk, before the loop
+				lookup_citRefs = list(filter(lambda citRef: citRef.get('id') is not None, merged_temp_citRefs))
+				cached_citRefs_iter = iter(self.pubC.getRawCachedMappingsFromPartials(lookup_citRefs))
 				for citRef in merged_temp_citRefs:
 					# Is it an empty entry?
 					# (should be a redundant mechanism)
@@ -465,7 +609,7 @@ class MetaEnricher(SkeletonPubEnricher):
 						merged_citRefs.append(citRef)
 						continue
 					
-					cached_citRefs = self.pubC.getRawCachedMappingsFromPartial(citRef)
+					cached_citRefs = next(cached_citRefs_iter)
 					
 					if cached_citRefs:
 						# Right now, we are not going to deal with conflicts at this level
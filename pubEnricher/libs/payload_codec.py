@@ -0,0 +1,391 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import datetime
+import json
+import re
+import sys
+import zlib
+
+from array import array
+from collections import Counter, namedtuple
+from itertools import accumulate
+from typing import Any, Dict, Iterator, List, Tuple
+
+from .pub_common import Timestamps, without_rowid_key
+
+# The columns of a binary citation or reference list. source_codes
+# and years are parallel to ids, and each source code is the index
+# of its source in sources. Missing years are YEAR_ABSENT or YEAR_NONE
+CitRefArrays = namedtuple('CitRefArrays',['sources','source_codes','ids','years'])
+
+# Signed array typecodes by item size, for the numeric id deltas
+_DELTA_TYPECODES = { array(typecode).itemsize: typecode  for typecode in ('b','h','i','q') }
+
+def _write_varint(buf:bytearray,value:int) -> None:
+	while value > 0x7F:
+		buf.append((value & 0x7F) | 0x80)
+		value >>= 7
+	buf.append(value)
+
+def _read_varint(data:bytes,pos:int) -> Tuple[int,int]:
+	b = data[pos]
+	pos += 1
+	value = b & 0x7F
+	shift = 7
+	while b & 0x80:
+		b = data[pos]
+		pos += 1
+		value |= (b & 0x7F) << shift
+		shift += 7
+	
+	return value, pos
+
+class PayloadCodec(object):
+	"""
+		The encoder / decoder of the payloads stored in the caches.
+		The first byte of each encoded payload is the codec tag.
+		Payloads written by older versions are plain zlib streams,
+		which always start with 0x78, so they are still readable.
+		Citation and reference lists can be stored in a binary layout,
+		chosen per row, so rows written in any format are still read.
+		Preset dictionaries are stored in the codec_dict table of each
+		database, and they are never removed, as old rows reference them.
+	"""
+	# Codec tags
+	TAG_DEFLATE = 0x01
+	TAG_DEFLATE_ZDICT = 0x02
+	TAG_CITREFS = 0x03
+	
+	# Year codes of the binary citref lists, for the missing
+	# year key and for a null year. Other codes are the years
+	YEAR_ABSENT = 0
+	YEAR_NONE = 1
+	_CITREF_KEYS = frozenset(('id','source','year'))
+	# Numeric ids longer than this are stored as strings
+	_MAX_NUMERIC_ID_LEN = 18
+	# Source codes of the entries whose id is stored as a string
+	_STRING_ID_FLAG = 0x80
+	_SOURCE_CODE_TABLE = bytes(code & 0x7F  for code in range(256))
+	
+	# The symbolic names used in the configuration
+	CODEC_LEGACY = 'zlib-best'
+	CODEC_DEFLATE = 'deflate'
+	CODEC_ZDICT = 'zdict'
+	CODECS = (CODEC_LEGACY, CODEC_DEFLATE, CODEC_ZDICT)
+	
+	DEFAULT_CODEC = CODEC_ZDICT
+	DEFAULT_LEVEL = 6
+	
+	# zlib only uses the last 32KB of a preset dictionary
+	ZDICT_MAX_SIZE = 32768
+	# Number of cached payloads used to train a dictionary
+	ZDICT_TRAIN_SAMPLES = 4000
+	# Below this number of payloads, no dictionary is trained
+	ZDICT_MIN_SAMPLES = 200
+	
+	# JSON keys and short strings, along with their separators,
+	# are the fragments repeated among payloads
+	_FRAGMENT_PATTERN = re.compile(rb'"(?:[^"\\]|\\.){0,48}"\s*[:,]?\s*')
+	
+	def __init__(self,codec:str=DEFAULT_CODEC,level:int=DEFAULT_LEVEL,binary_citrefs:bool=True):
+		if codec not in self.CODECS:
+			raise ValueError("Unknown cache codec {}. Valid ones are {}".format(codec,', '.join(self.CODECS)))
+		
+		self.codec = codec
+		self.level = level
+		self.binary_citrefs = binary_citrefs
+		self.je = json.JSONEncoder(separators=(',',':'))
+		self.jd = json.JSONDecoder()
+		
+		# The preset dictionaries, by id
+		self.zdicts = {}
+		self.zdict_id = None
+		
+		# Instrumentation of the decoded payloads
+		self.decoded_payloads = 0
+		self.decoded_bytes = 0
+	
+	def initDictionaries_TL(self,cur) -> None:
+		"""
+			It creates the dictionaries table, when it does not exist,
+			and it loads all the preset dictionaries
+		"""
+		cur.execute("""
+CREATE TABLE IF NOT EXISTS codec_dict (
+	dict_id INTEGER PRIMARY KEY,
+	payload BLOB NOT NULL,
+	created TIMESTAMP NOT NULL
+)
+""")
+		for res in cur.execute("""
+SELECT dict_id, payload
+FROM codec_dict
+ORDER BY dict_id
+"""):
+			self.zdicts[res[0]] = res[1]
+			# The newest one is used to encode
+			self.zdict_id = res[0]
+	
+	def storeDictionary_TL(self,cur,zdict:bytes) -> int:
+		"""
+			It stores a new preset dictionary, which is used from now on
+		"""
+		cur.execute("""
+INSERT INTO codec_dict(payload,created) VALUES(:payload,:created)
+""",{'payload': zdict,'created': Timestamps.UTCTimestamp(datetime.datetime.utcnow())})
+		dict_id = cur.lastrowid
+		self.zdicts[dict_id] = zdict
+		self.zdict_id = dict_id
+		
+		return dict_id
+	
+	def trainDictionary_TL(self,cur,table_names:Iterator[str]) -> int:
+		"""
+			It trains and stores a new preset dictionary from the newest
+			payloads of the tables. When there are not enough of them,
+			it returns None and the payloads keep being compressed
+			without dictionary
+		"""
+		table_names = list(table_names)
+		samples = []
+		for table_name in table_names:
+			# Clustered tables have no insertion order, but the fetch one
+			newest_first = 'rowid DESC'  if without_rowid_key(cur.connection,table_name) is None  else 'last_fetched DESC'
+			cur.execute("""
+SELECT payload
+FROM {}
+WHERE payload IS NOT NULL
+ORDER BY {}
+LIMIT :limit
+""".format(table_name,newest_first),{'limit': self.ZDICT_TRAIN_SAMPLES // len(table_names)})
+			# Binary citref lists do not benefit from the dictionary
+			samples.extend(self.decodeRaw(res[0])  for res in cur  if res[0][0] != self.TAG_CITREFS)
+		
+		if len(samples) < self.ZDICT_MIN_SAMPLES:
+			return None
+		
+		return self.storeDictionary_TL(cur,self.TrainDictionary(samples))
+	
+	@property
+	def needsDictionary(self) -> bool:
+		return self.codec == self.CODEC_ZDICT and self.zdict_id is None
+	
+	@classmethod
+	def TrainDictionary(cls,samples:Iterator[bytes],max_size:int=ZDICT_MAX_SIZE) -> bytes:
+		"""
+			It builds a preset dictionary from the most repeated fragments
+			of the samples (raw JSON payloads). The most valuable fragments
+			are placed at the end, as they are the cheapest to reference
+		"""
+		counts = Counter()
+		for sample in samples:
+			counts.update(cls._FRAGMENT_PATTERN.findall(sample))
+		
+		scored = sorted(((count*len(fragment),fragment)  for fragment, count in counts.items()  if count > 1), reverse=True)
+		chosen = []
+		size = 0
+		for _, fragment in scored:
+			if size + len(fragment) <= max_size:
+				chosen.append(fragment)
+				size += len(fragment)
+		
+		return b''.join(reversed(chosen))
+	
+	def encodeRaw(self,obj:Any) -> bytes:
+		return self.je.encode(obj).encode("utf-8")
+	
+	def encode(self,obj:Any) -> bytes:
+		raw = self.encodeRaw(obj)
+		if self.codec == self.CODEC_LEGACY:
+			return zlib.compress(raw,zlib.Z_BEST_COMPRESSION)
+		
+		if self.codec == self.CODEC_ZDICT and self.zdict_id is not None:
+			compressor = zlib.compressobj(self.level,zlib.DEFLATED,-zlib.MAX_WBITS,zdict=self.zdicts[self.zdict_id])
+			header = bytes((self.TAG_DEFLATE_ZDICT,)) + self.zdict_id.to_bytes(4,'big')
+		else:
+			compressor = zlib.compressobj(self.level,zlib.DEFLATED,-zlib.MAX_WBITS)
+			header = bytes((self.TAG_DEFLATE,))
+		
+		return header + compressor.compress(raw) + compressor.flush()
+	
+	def encodeCitRefs(self,citrefs:List[Dict[str,Any]]) -> bytes:
+		"""
+			It encodes a citation or reference list in the binary layout,
+			when it is enabled and all the entries fit in it. Otherwise,
+			the list is encoded as any other payload
+		"""
+		if not self.binary_citrefs:
+			return self.encode(citrefs)
+		
+		sources = {}
+		source_codes = bytearray()
+		years = array('H')
+		deltas = []
+		str_ids = []
+		prev_id = 0
+		for citref in citrefs:
+			if not isinstance(citref,dict) or not self._CITREF_KEYS.issuperset(citref.keys()):
+				return self.encode(citrefs)
+			
+			_id = citref.get('id')
+			source = citref.get('source')
+			if not isinstance(_id,str) or not isinstance(source,str) or '\0' in _id:
+				return self.encode(citrefs)
+			
+			source_code = sources.setdefault(source,len(sources))
+			if source_code >= self._STRING_ID_FLAG:
+				return self.encode(citrefs)
+			
+			if 'year' not in citref:
+				years.append(self.YEAR_ABSENT)
+			else:
+				year = citref['year']
+				if year is None:
+					years.append(self.YEAR_NONE)
+				elif type(year) is int and self.YEAR_NONE < year <= 0xFFFF:
+					years.append(year)
+				else:
+					return self.encode(citrefs)
+			
+			# Numeric ids are stored as deltas from the previous numeric id
+			if _id.isdigit() and _id.isascii() and len(_id) <= self._MAX_NUMERIC_ID_LEN and (_id[0] != '0' or _id == '0'):
+				num_id = int(_id)
+				deltas.append(num_id - prev_id)
+				prev_id = num_id
+			else:
+				source_code |= self._STRING_ID_FLAG
+				str_ids.append(_id)
+			source_codes.append(source_code)
+		
+		# All the deltas of a list share the narrowest width fitting them
+		delta_size = 0
+		if deltas:
+			max_delta = max(max(deltas),-min(deltas)-1)
+			for delta_size, typecode in sorted(_DELTA_TYPECODES.items()):
+				if max_delta < 1 << (8*delta_size - 1):
+					break
+			deltas = array(typecode,deltas)
+			if sys.byteorder != 'little':
+				deltas.byteswap()
+		
+		if sys.byteorder != 'little':
+			years.byteswap()
+		
+		buf = bytearray()
+		_write_varint(buf,len(source_codes))
+		_write_varint(buf,len(sources))
+		for source in sources.keys():
+			source_bytes = source.encode("utf-8")
+			_write_varint(buf,len(source_bytes))
+			buf.extend(source_bytes)
+		buf.extend(source_codes)
+		buf.extend(years.tobytes())
+		_write_varint(buf,len(deltas))
+		if deltas:
+			buf.append(delta_size)
+			buf.extend(deltas.tobytes())
+		buf.extend('\0'.join(str_ids).encode("utf-8"))
+		
+		compressor = zlib.compressobj(self.level,zlib.DEFLATED,-zlib.MAX_WBITS)
+		return bytes((self.TAG_CITREFS,)) + compressor.compress(buf) + compressor.flush()
+	
+	def decodeCitRefsArrays(self,payload:bytes) -> CitRefArrays:
+		"""
+			It decodes a binary citation or reference list into its
+			columns, which are cheaper than the dictionaries for statistics
+		"""
+		data = zlib.decompress(payload[1:],-zlib.MAX_WBITS)
+		num_citrefs, pos = _read_varint(data,0)
+		num_sources, pos = _read_varint(data,pos)
+		sources = []
+		for _ in range(num_sources):
+			source_len, pos = _read_varint(data,pos)
+			sources.append(data[pos:pos+source_len].decode("utf-8"))
+			pos += source_len
+		
+		flagged_codes = data[pos:pos+num_citrefs]
+		pos += num_citrefs
+		years = array('H')
+		years.frombytes(data[pos:pos + 2*num_citrefs])
+		pos += 2*num_citrefs
+		if sys.byteorder != 'little':
+			years.byteswap()
+		
+		num_deltas, pos = _read_varint(data,pos)
+		if num_deltas > 0:
+			delta_size = data[pos]
+			deltas = array(_DELTA_TYPECODES[delta_size])
+			deltas.frombytes(data[pos + 1:pos + 1 + num_deltas*delta_size])
+			pos += 1 + num_deltas*delta_size
+			if sys.byteorder != 'little':
+				deltas.byteswap()
+			num_ids = list(map(str,accumulate(deltas)))
+		else:
+			num_ids = []
+		
+		if num_deltas == num_citrefs:
+			ids = num_ids
+			source_codes = flagged_codes
+		else:
+			str_ids = data[pos:].decode("utf-8").split('\0')
+			if num_deltas == 0:
+				ids = str_ids
+			else:
+				num_iter = iter(num_ids)
+				str_iter = iter(str_ids)
+				ids = [ next(str_iter)  if code & self._STRING_ID_FLAG  else next(num_iter)  for code in flagged_codes ]
+			source_codes = flagged_codes.translate(self._SOURCE_CODE_TABLE)
+		
+		self.decoded_payloads += 1
+		self.decoded_bytes += len(data)
+		
+		return CitRefArrays(sources,source_codes,ids,years)
+	
+	def decodeCitRefs(self,payload:bytes) -> List[Dict[str,Any]]:
+		"""
+			It decodes a binary citation or reference list into
+			the list of dictionaries
+		"""
+		arrays = self.decodeCitRefsArrays(payload)
+		citref_sources = map(arrays.sources.__getitem__,arrays.source_codes)
+		num_absent = arrays.years.count(self.YEAR_ABSENT)
+		if num_absent == len(arrays.years):
+			return [ {'id': _id, 'source': source}  for _id, source in zip(arrays.ids,citref_sources) ]
+		
+		if num_absent == 0 and arrays.years.count(self.YEAR_NONE) == 0:
+			return [ {'id': _id, 'source': source, 'year': year}  for _id, source, year in zip(arrays.ids,citref_sources,arrays.years) ]
+		
+		return [
+			{'id': _id, 'source': source}  if year == self.YEAR_ABSENT  else {'id': _id, 'source': source, 'year': year  if year != self.YEAR_NONE  else None}
+			for _id, source, year in zip(arrays.ids,citref_sources,arrays.years)
+		]
+	
+	def decodeRaw(self,payload:bytes) -> bytes:
+		"""
+			It returns the raw JSON of an encoded payload
+		"""
+		tag = payload[0]
+		if tag == self.TAG_CITREFS:
+			return self.encodeRaw(self.decodeCitRefs(payload))
+		
+		if tag == self.TAG_DEFLATE:
+			raw = zlib.decompress(payload[1:],-zlib.MAX_WBITS)
+		elif tag == self.TAG_DEFLATE_ZDICT:
+			dict_id = int.from_bytes(payload[1:5],'big')
+			decompressor = zlib.decompressobj(-zlib.MAX_WBITS,zdict=self.zdicts[dict_id])
+			raw = decompressor.decompress(payload[5:]) + decompressor.flush()
+		else:
+			# Legacy payloads, plain zlib streams
+			raw = zlib.decompress(payload)
+		
+		self.decoded_payloads += 1
+		self.decoded_bytes += len(raw)
+		
+		return raw
+	
+	def decode(self,payload:bytes) -> Any:
+		if payload[0] == self.TAG_CITREFS:
+			return self.decodeCitRefs(payload)
+		
+		return self.jd.decode(self.decodeRaw(payload).decode("utf-8"))
@@ -0,0 +1,3016 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import glob
+import datetime
+import time
+import atexit
+import queue
+import threading
+from typing import Tuple, List, Dict, Set, Any, NewType, Iterator
+
+from . import pub_common
+from .pub_common import Timestamps
+from .doi_cache import DOIChecker
+from .payload_codec import PayloadCodec
+from .cache_stats import CacheStats, TimedConnection
+
+# Alias types declaration
+Citation = NewType('Citation',Dict[str,Any])
+CitationCount = NewType('CitationCount',int)
+Reference = NewType('Reference',Dict[str,Any])
+ReferenceCount = NewType('ReferenceCount',int)
+Mapping = NewType('Mapping',Dict[str,Any])
+UnqualifiedId = NewType('UnqualifiedId',str)
+SourceId = NewType('SourceId',str)
+QualifiedId = NewType('QualifiedId',Tuple[SourceId,UnqualifiedId])
+PublishId = NewType('PublishId',str)
+EnricherId = NewType('EnricherId',str)
+MetaQualifiedId = NewType('MetaQualifiedId',Tuple[EnricherId,SourceId,UnqualifiedId])
+
+import json
+import sqlite3
+from collections import Counter, OrderedDict
+from urllib import parse
+
+# Default time to live (in days) of each kind of cached entry.
+# Reference lists do not change once a paper is published, and
+# its metadata and identifiers rarely do, but citations keep growing
+DEFAULT_TTL_DAYS = OrderedDict([
+	('mapping', 180),
+	('references', 3650),
+	('citations', 28),
+	('idmap', 180),
+	('negative', 7),
+	('year', 365),
+	('partial', 180),
+])
+
+# Number of keys sent on each chunked IN list, below
+# the historical SQLITE_MAX_VARIABLE_NUMBER (999)
+BULK_CHUNK_SIZE = 500
+
+def _chunks(elems:List[Any],chunk_size:int=BULK_CHUNK_SIZE) -> Iterator[List[Any]]:
+	for start in range(0,len(elems),chunk_size):
+		yield elems[start:start+chunk_size]
+
+def citref_year_stats(citrefs:Iterator[Dict[str,Any]]) -> List[Dict[str,Any]]:
+	"""
+		Histogram of the citations or references by year
+	"""
+	citref_stats = {}
+	for citref in citrefs:
+		year = citref.get('year',-1)
+		if year is None:
+			year = -1
+		if year in citref_stats:
+			citref_stats[year] += 1
+		else:
+			citref_stats[year] = 1
+	
+	return [ {'year':year,'count':citref_stats[year]} for year in sorted(citref_stats.keys()) ]
+
+def citref_arrays_year_stats(years:Iterator[int]) -> List[Dict[str,Any]]:
+	"""
+		Histogram of the citations or references by year, from
+		the year column of a binary list
+	"""
+	citref_stats = Counter(years)
+	num_unknown = citref_stats.pop(PayloadCodec.YEAR_ABSENT,0) + citref_stats.pop(PayloadCodec.YEAR_NONE,0)
+	if num_unknown > 0:
+		citref_stats[-1] = num_unknown
+	
+	return [ {'year':year,'count':citref_stats[year]} for year in sorted(citref_stats.keys()) ]
+
+def _json_copy(obj:Any) -> Any:
+	"""
+		Faster than copy.deepcopy, as decoded payloads only have
+		dictionaries, lists and scalars
+	"""
+	if isinstance(obj,list):
+		return [ _json_copy(elem)  if isinstance(elem,(dict,list))  else elem  for elem in obj ]
+	
+	return { key: _json_copy(val)  if isinstance(val,(dict,list))  else val  for key, val in obj.items() }
+
+class DecodedPayloadLRU(object):
+	"""
+		Size-bounded LRU of decoded payloads, so the most popular
+		mappings and citation / reference lists are not decompressed
+		and decoded once and again.
+		The size is measured in decoded elements: one per mapping,
+		and one per entry in a citation or reference list.
+		As callers modify what they get, copies are always returned.
+	"""
+	def __init__(self,max_size:int):
+		self.max_size = max_size
+		self.size = 0
+		self.hits = 0
+		self.misses = 0
+		self._entries = OrderedDict()
+	
+	@staticmethod
+	def _copy(value:Any,flat:bool) -> Any:
+		if value is None:
+			return None
+		
+		# Lists of flat dictionaries (the usual citations) are cheaper to copy
+		return list(map(dict.copy,value))  if flat  else _json_copy(value)
+	
+	def get(self,key:Tuple) -> Tuple[datetime.datetime,Any]:
+		entry = self._entries.get(key)
+		if entry is None:
+			self.misses += 1
+			return None
+		
+		self.hits += 1
+		self._entries.move_to_end(key)
+		timestamp, value, flat, _ = entry
+		return timestamp, self._copy(value,flat)
+	
+	def put(self,key:Tuple,timestamp:datetime.datetime,value:Any) -> Any:
+		"""
+			It stores the value, and it returns a copy of it
+		"""
+		self.discard(key)
+		
+		if isinstance(value,list):
+			weight = max(1,len(value))
+			flat = all(isinstance(elem,dict) and not any(isinstance(val,(dict,list)) for val in elem.values()) for elem in value)
+		else:
+			weight = 1
+			flat = False
+		
+		if weight <= self.max_size:
+			self._entries[key] = (timestamp,value,flat,weight)
+			self.size += weight
+			while self.size > self.max_size:
+				_, (_, _, _, old_weight) = self._entries.popitem(last=False)
+				self.size -= old_weight
+		
+		return self._copy(value,flat)
+	
+	def discard(self,key:Tuple) -> None:
+		entry = self._entries.pop(key,None)
+		if entry is not None:
+			self.size -= entry[3]
+	
+	def stats(self) -> Dict[str,Any]:
+		lookups = self.hits + self.misses
+		return {
+			'hits': self.hits,
+			'misses': self.misses,
+			'hit_rate': self.hits / lookups  if lookups > 0  else None,
+			'entries': len(self._entries),
+			'size': self.size,
+			'max_size': self.max_size
+		}
+
+def _schema_tables(conn) -> None:
+	with conn:
+		# Publication table
+		conn.execute("""
+CREATE TABLE IF NOT EXISTS pub (
+	enricher VARCHAR(32) NOT NULL,
+	id VARCHAR(4096) NOT NULL,
+	source VARCHAR(32) NOT NULL,
+	payload BLOB NOT NULL,
+	last_fetched TIMESTAMP NOT NULL,
+	PRIMARY KEY (enricher,id,source)
+)
+""")
+		# IDMap
+		# pub_id_type VARCHAR(32) NOT NULL,
+		# PRIMARY KEY (pub_id,pub_id_type),
+		conn.execute("""
+CREATE TABLE IF NOT EXISTS idmap (
+	pub_id VARCHAR(4096) NOT NULL,
+	enricher VARCHAR(32) NOT NULL,
+	id VARCHAR(4096) NOT NULL,
+	source VARCHAR(32) NOT NULL,
+	last_fetched TIMESTAMP NOT NULL,
+	PRIMARY KEY (pub_id,id,enricher,source),
+	FOREIGN KEY (enricher,id,source) REFERENCES pub(enricher,id,source)
+)
+""")
+		# Denormalized citations and references
+		# so we can register empty answers,
+		# and get the whole list with a single query
+		conn.execute("""
+CREATE TABLE IF NOT EXISTS citref (
+	enricher VARCHAR(32) NOT NULL,
+	id VARCHAR(4096) NOT NULL,
+	source VARCHAR(32) NOT NULL,
+	is_cit BOOLEAN NOT NULL,
+	payload BLOB,
+	last_fetched TIMESTAMP NOT NULL,
+	FOREIGN KEY (enricher,id,source) REFERENCES pub(enricher,id,source)
+)
+""")
+		# Lower Mappings
+		conn.execute("""
+CREATE TABLE IF NOT EXISTS lower_map (
+	enricher VARCHAR(32) NOT NULL,
+	id VARCHAR(4096) NOT NULL,
+	source VARCHAR(32) NOT NULL,
+	lower_enricher VARCHAR(32) NOT NULL,
+	lower_id VARCHAR(4096) NOT NULL,
+	lower_source VARCHAR(32) NOT NULL,
+	last_fetched TIMESTAMP NOT NULL,
+	FOREIGN KEY (enricher,id,source) REFERENCES pub(enricher,id,source),
+	FOREIGN KEY (lower_enricher,lower_id,lower_source) REFERENCES pub(enricher,id,source)
+)
+""")
+
+def _schema_unique_indexes(conn) -> None:
+	# Unique indexes needed by the upserts
+	pub_common.ensure_unique_index(conn,'citref_u','citref','enricher,id,source,is_cit')
+	pub_common.ensure_unique_index(conn,'lower_map_u','lower_map','enricher,id,source,lower_enricher,lower_id,lower_source')
+
+def _schema_citref_pages(conn) -> None:
+	# Pages of the longest citation and reference lists
+	with conn:
+		conn.execute("""
+CREATE TABLE IF NOT EXISTS citref_page (
+	enricher VARCHAR(32) NOT NULL,
+	id VARCHAR(4096) NOT NULL,
+	source VARCHAR(32) NOT NULL,
+	is_cit BOOLEAN NOT NULL,
+	page INTEGER NOT NULL,
+	payload BLOB NOT NULL,
+	PRIMARY KEY (enricher,id,source,is_cit,page)
+)
+""")
+
+def _schema_covering_indexes(conn) -> None:
+	# Covering indexes for the lookups by publish id, by lower
+	# mapping and for the removal of stale correspondences.
+	# The clustered tables (schema version 7) already are some of them
+	with conn:
+		if pub_common.without_rowid_key(conn,'idmap') is None:
+			conn.execute("""
+CREATE INDEX IF NOT EXISTS idmap_e_p ON idmap(enricher,pub_id,source,id,last_fetched)
+""")
+		conn.execute("""
+CREATE INDEX IF NOT EXISTS idmap_e_i_s_f ON idmap(enricher,id,source,last_fetched)
+""")
+		if pub_common.without_rowid_key(conn,'lower_map') is None:
+			conn.execute("""
+CREATE INDEX IF NOT EXISTS lower_map_e_i_s_f ON lower_map(enricher,id,source,last_fetched)
+""")
+		conn.execute("""
+CREATE INDEX IF NOT EXISTS lower_map_e_l ON lower_map(enricher,lower_enricher,lower_source,lower_id,source,id,last_fetched)
+""")
+		# Superseded by citref_u and lower_map_e_l
+		conn.execute("""DROP INDEX IF EXISTS citref_e_i_s""")
+		conn.execute("""DROP INDEX IF EXISTS lower_map_e_i_s""")
+
+def _schema_negative_ids(conn) -> None:
+	# Publish ids which could not be resolved
+	with conn:
+		conn.execute("""
+CREATE TABLE IF NOT EXISTS negative_id (
+	enricher VARCHAR(32) NOT NULL,
+	pub_id VARCHAR(4096) NOT NULL,
+	last_fetched TIMESTAMP NOT NULL,
+	PRIMARY KEY (enricher,pub_id)
+)
+""")
+
+def _schema_refresh_indexes(conn) -> None:
+	# The entries closest to expiry are renewed first
+	with conn:
+		conn.execute("""
+CREATE INDEX IF NOT EXISTS pub_e_f ON pub(enricher,last_fetched)
+""")
+		conn.execute("""
+CREATE INDEX IF NOT EXISTS citref_e_c_f ON citref(enricher,is_cit,last_fetched)
+""")
+		conn.execute("""
+CREATE INDEX IF NOT EXISTS idmap_e_f ON idmap(enricher,last_fetched)
+""")
+
+def _rebuild_without_rowid(conn,table_name:str,create_sql:str,indexes) -> None:
+	# The rows are copied to the clustered table, which replaces the old one
+	if pub_common.without_rowid_key(conn,table_name) is not None:
+		return
+	
+	with conn:
+		conn.execute("""DROP TABLE IF EXISTS {}_clustered""".format(table_name))
+		conn.execute(create_sql.format(table_name + '_clustered'))
+		conn.execute("""
+INSERT OR IGNORE INTO {0}_clustered
+SELECT *
+FROM {0}
+""".format(table_name))
+		conn.execute("""DROP TABLE {}""".format(table_name))
+		conn.execute("""ALTER TABLE {0}_clustered RENAME TO {0}""".format(table_name))
+		for index_sql in indexes:
+			conn.execute(index_sql)
+
+def _schema_clustered_tables(conn) -> None:
+	# The correspondence tables only hold keys and a timestamp, so they
+	# are stored clustered on the key the lookups use, without rowid.
+	# The former covering indexes become the tables themselves
+	_rebuild_without_rowid(conn,'idmap',"""
+CREATE TABLE {} (
+	pub_id VARCHAR(4096) NOT NULL,
+	enricher VARCHAR(32) NOT NULL,
+	id VARCHAR(4096) NOT NULL,
+	source VARCHAR(32) NOT NULL,
+	last_fetched TIMESTAMP NOT NULL,
+	PRIMARY KEY (enricher,pub_id,source,id),
+	FOREIGN KEY (enricher,id,source) REFERENCES pub(enricher,id,source)
+) WITHOUT ROWID
+""",(
+		"""CREATE INDEX IF NOT EXISTS idmap_e_i_s_f ON idmap(enricher,id,source,last_fetched)""",
+		"""CREATE INDEX IF NOT EXISTS idmap_e_f ON idmap(enricher,last_fetched)""",
+	))
+	_rebuild_without_rowid(conn,'lower_map',"""
+CREATE TABLE {} (
+	enricher VARCHAR(32) NOT NULL,
+	id VARCHAR(4096) NOT NULL,
+	source VARCHAR(32) NOT NULL,
+	lower_enricher VARCHAR(32) NOT NULL,
+	lower_id VARCHAR(4096) NOT NULL,
+	lower_source VARCHAR(32) NOT NULL,
+	last_fetched TIMESTAMP NOT NULL,
+	PRIMARY KEY (enricher,id,source,lower_enricher,lower_id,lower_source),
+	FOREIGN KEY (enricher,id,source) REFERENCES pub(enricher,id,source),
+	FOREIGN KEY (lower_enricher,lower_id,lower_source) REFERENCES pub(enricher,id,source)
+) WITHOUT ROWID
+""",(
+		"""CREATE INDEX IF NOT EXISTS lower_map_e_l ON lower_map(enricher,lower_enricher,lower_source,lower_id,source,id,last_fetched)""",
+	))
+	_rebuild_without_rowid(conn,'negative_id',"""
+CREATE TABLE {} (
+	enricher VARCHAR(32) NOT NULL,
+	pub_id VARCHAR(4096) NOT NULL,
+	last_fetched TIMESTAMP NOT NULL,
+	PRIMARY KEY (enricher,pub_id)
+) WITHOUT ROWID
+""",())
+
+def _schema_pub_years(conn) -> None:
+	# Publication years known without the whole mapping, gathered
+	# from the mappings and from the citation and reference lists
+	with conn:
+		conn.execute("""
+CREATE TABLE IF NOT EXISTS pub_year (
+	enricher VARCHAR(32) NOT NULL,
+	id VARCHAR(4096) NOT NULL,
+	source VARCHAR(32) NOT NULL,
+	year INTEGER NOT NULL,
+	last_fetched TIMESTAMP NOT NULL,
+	PRIMARY KEY (enricher,id,source)
+) WITHOUT ROWID
+""")
+
+def _schema_clustered_payload_tables(conn) -> None:
+	# Most mappings and citref headers are small, so they are also
+	# stored clustered on their lookup key. The pages of the longest
+	# lists are far larger, so citref_page keeps its rowid layout
+	_rebuild_without_rowid(conn,'pub',"""
+CREATE TABLE {} (
+	enricher VARCHAR(32) NOT NULL,
+	id VARCHAR(4096) NOT NULL,
+	source VARCHAR(32) NOT NULL,
+	payload BLOB NOT NULL,
+	last_fetched TIMESTAMP NOT NULL,
+	PRIMARY KEY (enricher,id,source)
+) WITHOUT ROWID
+""",(
+		"""CREATE INDEX IF NOT EXISTS pub_e_f ON pub(enricher,last_fetched)""",
+	))
+	_rebuild_without_rowid(conn,'citref',"""
+CREATE TABLE {} (
+	enricher VARCHAR(32) NOT NULL,
+	id VARCHAR(4096) NOT NULL,
+	source VARCHAR(32) NOT NULL,
+	is_cit BOOLEAN NOT NULL,
+	payload BLOB,
+	last_fetched TIMESTAMP NOT NULL,
+	PRIMARY KEY (enricher,id,source,is_cit),
+	FOREIGN KEY (enricher,id,source) REFERENCES pub(enricher,id,source)
+) WITHOUT ROWID
+""",(
+		"""CREATE INDEX IF NOT EXISTS citref_e_c_f ON citref(enricher,is_cit,last_fetched)""",
+	))
+
+def _schema_pub_partials(conn) -> None:
+	# Partial metadata of the publications (title, authors, journal...)
+	# learnt from the citation and reference lists. As their other
+	# fields (like the DOI) are unknown, they are kept apart from pub
+	with conn:
+		conn.execute("""
+CREATE TABLE IF NOT EXISTS pub_partial (
+	enricher VARCHAR(32) NOT NULL,
+	id VARCHAR(4096) NOT NULL,
+	source VARCHAR(32) NOT NULL,
+	payload BLOB NOT NULL,
+	last_fetched TIMESTAMP NOT NULL,
+	PRIMARY KEY (enricher,id,source)
+) WITHOUT ROWID
+""")
+
+class PubDBCache(object):
+	"""
+		The publications cache management code
+		Currently, it stores the correspondence among PMIDs,
+		PMC ids, DOIs and the internal identifier in the
+		original source.
+		Also, it stores the title, etc..
+		Also, it stores the citations fetched from the original source
+	"""
+	DEFAULT_CACHE_DB_FILE="pubEnricher_CACHE.db"
+	
+	# Max number of decoded elements kept in memory
+	DEFAULT_LRU_SIZE = 100000
+	
+	# Memory mapped bytes of the frozen snapshot, in snapshot mode
+	DEFAULT_MMAP_SIZE = 1 << 30
+	
+	# Write-behind defaults: max number of queued batches, number of
+	# entries which trigger a group commit, and max seconds an entry waits
+	DEFAULT_WRITE_BEHIND_QUEUE_SIZE = 64
+	DEFAULT_WRITE_BEHIND_GROUP_SIZE = 5000
+	DEFAULT_WRITE_BEHIND_INTERVAL = 2.0
+	
+	# Kinds of queued writes
+	WRITE_MAPPINGS = 'pub'
+	WRITE_CITREFS = 'citref'
+	WRITE_NEGATIVES = 'negative_id'
+	WRITE_YEARS = 'pub_year'
+	WRITE_PARTIALS = 'pub_partial'
+	
+	# Suffix (followed by the process id) of the delta databases,
+	# and the schema name of the frozen snapshot attached to them
+	DELTA_SUFFIX = '.delta-'
+	FROZEN_SCHEMA = 'frozen'
+	
+	# Deltas in use by the instances of this process
+	_live_deltas = set()
+	
+	# Prefix of the schema names of the attached lower caches
+	LOWER_SCHEMA_PREFIX = 'lower_'
+	
+	# Citation and reference lists longer than this are stored
+	# in pages of this size, and the citref row keeps only a header
+	CITREF_PAGE_SIZE = 1000
+	
+	# Tables whose payloads are sampled to train the codec dictionaries
+	CODEC_TABLES = ('pub','citref','citref_page')
+	
+	# Each schema version is reached applying its migration
+	# over the previous one. New ones must be appended
+	SCHEMA_MIGRATIONS = (
+		('Cache tables', _schema_tables),
+		('Unique indexes for the upserts', _schema_unique_indexes),
+		('Paged citation and reference lists', _schema_citref_pages),
+		('Covering indexes', _schema_covering_indexes),
+		('Unresolved publish ids', _schema_negative_ids),
+		('Refresh order indexes', _schema_refresh_indexes),
+		('Clustered correspondence tables', _schema_clustered_tables),
+		('Publication years', _schema_pub_years),
+		('Clustered publication and list tables', _schema_clustered_payload_tables),
+		('Partial publication metadata', _schema_pub_partials),
+	)
+	
+	# The entries of each kind ordered by age, for the refresher
+	REFRESH_QUERIES = {
+		'mapping': """
+SELECT source, id, last_fetched
+FROM {}.pub
+WHERE enricher = :enricher AND last_fetched > DATETIME('NOW',:oldest) AND last_fetched <= DATETIME('NOW',:newest)
+ORDER BY last_fetched
+LIMIT :limit
+""",
+		'citref': """
+SELECT source, id, last_fetched
+FROM {}.citref
+WHERE enricher = :enricher AND is_cit = :is_cit AND last_fetched > DATETIME('NOW',:oldest) AND last_fetched <= DATETIME('NOW',:newest)
+ORDER BY last_fetched
+LIMIT :limit
+""",
+		'idmap': """
+SELECT pub_id, last_fetched
+FROM {}.idmap
+WHERE enricher = :enricher AND last_fetched > DATETIME('NOW',:oldest) AND last_fetched <= DATETIME('NOW',:newest)
+ORDER BY last_fetched
+LIMIT :limit
+""",
+	}
+	
+	# The shape of the hot queries, checked by explainQueryPlans
+	QUERY_PLAN_AUDIT = (
+		('pub by qualified ids', """
+SELECT p.source, p.id, p.last_fetched, p.payload
+FROM temp.bulk_qual q CROSS JOIN pub p
+WHERE p.enricher = :enricher AND p.id = q.id AND p.source = q.source
+"""),
+		('citref by qualified ids', """
+SELECT c.source, c.id, c.last_fetched, c.payload
+FROM temp.bulk_qual q CROSS JOIN citref c
+WHERE c.enricher = :enricher AND c.id = q.id AND c.source = q.source AND c.is_cit = :is_cit
+"""),
+		('citref_page by qualified ids', """
+SELECT p.source, p.id, p.payload
+FROM temp.bulk_qual q CROSS JOIN citref_page p
+WHERE p.enricher = :enricher AND p.id = q.id AND p.source = q.source AND p.is_cit = :is_cit
+ORDER BY q.source, q.id, p.page
+"""),
+		('citref_page single page', """
+SELECT payload FROM citref_page
+WHERE enricher = :enricher AND id = :id AND source = :source AND is_cit = :is_cit AND page = :page
+"""),
+		('citref_page trimming', """
+DELETE FROM citref_page
+WHERE enricher = :enricher AND id = :id AND source = :source AND is_cit = :is_cit AND page >= :num_pages
+"""),
+		('idmap by publish ids', """
+SELECT pub_id, last_fetched, source, id
+FROM idmap
+WHERE enricher = :enricher AND pub_id IN (:pub_id1,:pub_id2)
+"""),
+		('idmap and pub by publish ids', """
+SELECT i.pub_id, i.last_fetched, i.source, i.id, p.last_fetched, p.payload
+FROM idmap i LEFT JOIN pub p
+ON p.enricher = i.enricher AND p.id = i.id AND p.source = i.source
+WHERE i.enricher = :enricher AND i.pub_id IN (:pub_id1,:pub_id2)
+"""),
+		('idmap stale removal', """
+DELETE FROM idmap
+WHERE enricher = :enricher AND id = :id AND source = :source AND DATETIME('NOW',:oldest) > last_fetched
+"""),
+		('idmap removal', """
+DELETE FROM idmap
+WHERE enricher = :enricher AND id = :id AND source = :source AND pub_id = :pub_id
+"""),
+		('pub_year by qualified ids', """
+SELECT y.source, y.id, y.year, y.last_fetched
+FROM temp.bulk_qual q CROSS JOIN pub_year y
+WHERE y.enricher = :enricher AND y.id = q.id AND y.source = q.source
+"""),
+		('pub_partial by qualified ids', """
+SELECT p.source, p.id, p.last_fetched, p.payload
+FROM temp.bulk_qual q CROSS JOIN pub_partial p
+WHERE p.enricher = :enricher AND p.id = q.id AND p.source = q.source
+"""),
+		('negative_id by publish ids', """
+SELECT pub_id, last_fetched
+FROM negative_id
+WHERE enricher = :enricher AND pub_id IN (:pub_id1,:pub_id2)
+"""),
+		('lower_map by lower ids', """
+SELECT l.lower_enricher, l.lower_source, l.lower_id, l.last_fetched, l.source, l.id
+FROM temp.bulk_lower q CROSS JOIN lower_map l
+WHERE l.enricher = :enricher AND l.lower_enricher = q.lower_enricher AND l.lower_source = q.lower_source AND l.lower_id = q.lower_id
+"""),
+		('lower_map stale removal', """
+DELETE FROM lower_map
+WHERE enricher = :enricher AND id = :id AND source = :source AND DATETIME('NOW',:oldest) > last_fetched
+"""),
+		('lower_map removal', """
+DELETE FROM lower_map
+WHERE enricher = :enricher AND id = :id AND source = :source AND lower_enricher = :lower_enricher AND lower_id = :lower_id AND lower_source = :lower_source
+"""),
+		('pub refresh order', REFRESH_QUERIES['mapping'].format('main')),
+		('citref refresh order', REFRESH_QUERIES['citref'].format('main')),
+		('idmap refresh order', REFRESH_QUERIES['idmap'].format('main')),
+	)
+	
+	def __init__(self,enricher_name:str, cache_dir:str=".", prefix:str=None,doi_checker:DOIChecker=None,lru_size:int=DEFAULT_LRU_SIZE,codec:str=PayloadCodec.DEFAULT_CODEC,codec_level:int=PayloadCodec.DEFAULT_LEVEL,binary_citrefs:bool=True,ttl_days:Dict[str,float]=None,stale_grace_days:float=0,snapshot_mode:bool=False,mmap_size:int=DEFAULT_MMAP_SIZE,write_behind:bool=False,write_behind_queue_size:int=DEFAULT_WRITE_BEHIND_QUEUE_SIZE,write_behind_group_size:int=DEFAULT_WRITE_BEHIND_GROUP_SIZE,write_behind_interval:float=DEFAULT_WRITE_BEHIND_INTERVAL):
+		# The enricher name, used as default for all the queries
+		self.enricher_name = enricher_name
+		self.cache_dir = cache_dir
+		
+		# In snapshot mode the cache is read as a frozen snapshot,
+		# and the writes go to a delta database merged on exit
+		self.snapshot_mode = snapshot_mode
+		self.mmap_size = mmap_size
+		self.delta_db_file = None
+		
+		# Lower enricher -> schema name of its attached cache
+		self.lower_schemas = OrderedDict()
+		
+		# All the database accesses are serialized, as the
+		# write-behind thread shares the connection
+		self._lock = threading.RLock()
+		
+		# The write-behind queue, its thread, and the entries still
+		# not committed (by kind), which are overlaid on the reads
+		self.write_behind = write_behind
+		self.write_behind_queue_size = write_behind_queue_size
+		self.write_behind_group_size = write_behind_group_size
+		self.write_behind_interval = write_behind_interval
+		self._write_queue = None
+		self._writer_thread = None
+		self._writer_error = None
+		self._write_seq = 0
+		self._pending = {
+			self.WRITE_MAPPINGS: {},
+			self.WRITE_CITREFS: {},
+			self.WRITE_NEGATIVES: {},
+			self.WRITE_YEARS: {},
+			self.WRITE_PARTIALS: {},
+		}
+		
+		# Time to live of each kind of entry, where the
+		# missing ones get their default value
+		self.ttl = OrderedDict()
+		for kind, days in DEFAULT_TTL_DAYS.items():
+			if ttl_days is not None and ttl_days.get(kind) is not None:
+				days = ttl_days[kind]
+			self.ttl[kind] = datetime.timedelta(days=days)
+		
+		# Expired entries within this grace window are still served,
+		# and they are remembered (by kind) to be revalidated later
+		self.stale_grace = datetime.timedelta(days=stale_grace_days)
+		self.stale = { kind: set()  for kind in DEFAULT_TTL_DAYS.keys() }
+		
+		# The in-memory layer of decoded payloads (disabled with 0)
+		self.lru = DecodedPayloadLRU(lru_size)  if lru_size > 0  else None
+		
+		# How the payloads are serialized and compressed
+		self.codec = PayloadCodec(codec,codec_level,binary_citrefs)
+		
+		# Lookups and time spent in SQLite
+		self.stats = CacheStats()
+		
+		if doi_checker is None:
+			doi_checker = DOIChecker(cache_dir,codec=codec,codec_level=codec_level)
+		
+		self.doi_checker = doi_checker
+		
+		#self.debug_cache_dir = os.path.join(cache_dir,'debug')
+		#os.makedirs(os.path.abspath(self.debug_cache_dir),exist_ok=True)
+		#self._debug_count = 0
+		
+		# Should we set a prefix for the shelves?
+		if prefix is None:
+			cache_db_file = self.DEFAULT_CACHE_DB_FILE
+		else:
+			cache_db_file = prefix + self.DEFAULT_CACHE_DB_FILE
+		
+		self.cache_db_file = os.path.join(cache_dir,cache_db_file)
+		self.jd = json.JSONDecoder()
+		self.je = json.JSONEncoder()
+	
+	@classmethod
+	def TTLDaysFromConfig(cls,config,section_name:str) -> Dict[str,float]:
+		"""
+			The time to live (in days) of each kind of entry, read from
+			the cache_ttl_<kind> keys of the configuration section
+		"""
+		return { kind: config.getfloat(section_name,'cache_ttl_' + kind,fallback=None)  for kind in DEFAULT_TTL_DAYS.keys() }
+	
+	@classmethod
+	def WriteBehindFromConfig(cls,config,section_name:str) -> Dict[str,Any]:
+		"""
+			The write-behind parameters, read from the
+			cache_write_behind* keys of the configuration section
+		"""
+		return {
+			'write_behind': config.getboolean(section_name,'cache_write_behind',fallback=False),
+			'write_behind_queue_size': config.getint(section_name,'cache_write_behind_queue',fallback=cls.DEFAULT_WRITE_BEHIND_QUEUE_SIZE),
+			'write_behind_group_size': config.getint(section_name,'cache_write_behind_group',fallback=cls.DEFAULT_WRITE_BEHIND_GROUP_SIZE),
+			'write_behind_interval': config.getfloat(section_name,'cache_write_behind_interval',fallback=cls.DEFAULT_WRITE_BEHIND_INTERVAL),
+		}
+	
+	@classmethod
+	def KwargsFromConfig(cls,config,section_name:str) -> Dict[str,Any]:
+		"""
+			The constructor parameters which come from the cache_*
+			keys of the configuration section
+		"""
+		kwargs = {
+			# The in-memory layer of decoded payloads
+			'lru_size': config.getint(section_name,'cache_lru_size',fallback=cls.DEFAULT_LRU_SIZE),
+			# How the cache payloads are serialized and compressed
+			'codec': config.get(section_name,'cache_codec',fallback=PayloadCodec.DEFAULT_CODEC),
+			'codec_level': config.getint(section_name,'cache_codec_level',fallback=PayloadCodec.DEFAULT_LEVEL),
+			'binary_citrefs': config.getboolean(section_name,'cache_binary_citrefs',fallback=True),
+			# How long each kind of cached entry is kept
+			'ttl_days': cls.TTLDaysFromConfig(config,section_name),
+			'stale_grace_days': config.getfloat(section_name,'cache_stale_grace_days',fallback=0),
+			# Reads from a frozen snapshot of the cache, and writes to a delta
+			'snapshot_mode': config.getboolean(section_name,'cache_snapshot_mode',fallback=False),
+			'mmap_size': config.getint(section_name,'cache_mmap_size',fallback=cls.DEFAULT_MMAP_SIZE),
+		}
+		# Cache updates committed in groups by a background thread
+		kwargs.update(cls.WriteBehindFromConfig(config,section_name))
+		
+		return kwargs
+	
+	def _connect(self,db_file:str) -> sqlite3.Connection:
+		# Opening / creating the database, with normal locking
+		# and date parsing
+		# URI file names are enabled, so snapshots can be attached
+		conn = sqlite3.connect('file:' + parse.quote(os.path.abspath(db_file)), uri=True, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES, check_same_thread = False, factory=TimedConnection)
+		conn.stats = self.stats
+		conn.execute("""PRAGMA locking_mode = NORMAL""")
+		# Only effective on new databases (before switching to WAL),
+		# so the maintenance can release the freed pages
+		conn.execute("""PRAGMA auto_vacuum = INCREMENTAL""")
+		conn.execute("""PRAGMA journal_mode = WAL""")
+		
+		# Database structures, created or upgraded in place
+		pub_common.upgrade_schema(conn,self.SCHEMA_MIGRATIONS,db_file)
+		
+		return conn
+	
+	def __enter__(self):
+		self.conn = self._connect(self.cache_db_file)
+		
+		with self._lock, self.conn:
+			cur = self.conn.cursor()
+			
+			# Preset dictionaries of the payload codec
+			self.codec.initDictionaries_TL(cur)
+			if self.codec.needsDictionary:
+				self.codec.trainDictionary_TL(cur,self.CODEC_TABLES)
+			
+			cur.close()
+		
+		# Deltas left behind by interrupted snapshot mode runs
+		for delta_db_file in self._claimOrphanDeltas():
+			print("INFO: Merging pending cache delta {}".format(delta_db_file),file=sys.stderr)
+			self._mergeDelta(self.conn,delta_db_file)
+		
+		if self.snapshot_mode:
+			self.conn.close()
+			
+			# The writes of this run go to its own delta database.
+			# It always uses the codec dictionaries of the snapshot,
+			# so its payloads can be merged as they are
+			self.delta_db_file = self.cache_db_file + self.DELTA_SUFFIX + str(os.getpid())
+			self._live_deltas.add(self.delta_db_file)
+			self.conn = self._connect(self.delta_db_file)
+			# The cache is attached read-only, but not immutable, as
+			# other processes can still merge their deltas into it
+			self.conn.execute("""ATTACH DATABASE ? AS {}""".format(self.FROZEN_SCHEMA),('file:{}?mode=ro'.format(parse.quote(os.path.abspath(self.cache_db_file))),))
+			self.conn.execute("""PRAGMA {}.mmap_size = {}""".format(self.FROZEN_SCHEMA,int(self.mmap_size)))
+		
+		with self._lock, self.conn:
+			cur = self.conn.cursor()
+			
+			# Temporary tables used by the bulk lookups, so the keys
+			# are joined against the cache tables in a single statement
+			cur.execute("""
+CREATE TEMP TABLE IF NOT EXISTS bulk_qual (
+	source VARCHAR(32),
+	id VARCHAR(4096),
+	PRIMARY KEY (source,id)
+)
+""")
+			cur.execute("""
+CREATE TEMP TABLE IF NOT EXISTS bulk_lower (
+	lower_enricher VARCHAR(32),
+	lower_source VARCHAR(32),
+	lower_id VARCHAR(4096),
+	PRIMARY KEY (lower_enricher,lower_source,lower_id)
+)
+""")
+			cur.close()
+			
+		
+		if self.write_behind:
+			self._startWriteBehind()
+		
+		return self
+	
+	def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+		# Pending writes are always committed, even on errors
+		try:
+			self._stopWriteBehind()
+		except Exception as e:
+			if exc_type is None:
+				raise
+			print("ERROR: Pending cache writes could not be committed: {}".format(e),file=sys.stderr)
+		finally:
+			self.conn.close()
+		self.lower_schemas = OrderedDict()
+		
+		if self.snapshot_mode:
+			# The writes of this run are merged into the cache
+			conn = self._connect(self.cache_db_file)
+			try:
+				self._mergeDelta(conn,self.delta_db_file)
+			finally:
+				conn.close()
+				self._live_deltas.discard(self.delta_db_file)
+	
+	def attachLowerCaches(self,lower_db_files:Dict[str,str]) -> None:
+		"""
+			It attaches read-only the caches of the lower enrichers, so the
+			publications they found are resolved joining their publish
+			ids with the correspondences of this cache
+		"""
+		with self._lock:
+			for lower_enricher, lower_db_file in lower_db_files.items():
+				if lower_enricher in self.lower_schemas or not os.path.exists(lower_db_file):
+					continue
+				
+				schema = self.LOWER_SCHEMA_PREFIX + str(len(self.lower_schemas))
+				self.conn.execute("""ATTACH DATABASE ? AS {}""".format(schema),('file:{}?mode=ro'.format(parse.quote(os.path.abspath(lower_db_file))),))
+				self.lower_schemas[lower_enricher] = schema
+	
+	@staticmethod
+	def _isProcessAlive(pid:int) -> bool:
+		try:
+			os.kill(pid,0)
+		except ProcessLookupError:
+			return False
+		except PermissionError:
+			# It exists, but it belongs to other user
+			pass
+		return True
+	
+	def _claimOrphanDeltas(self) -> List[str]:
+		"""
+			It returns the deltas whose owning process is dead, renamed
+			after this process, so no other process merges them at the
+			same time. Deltas of live processes are left untouched
+		"""
+		delta_prefix = self.cache_db_file + self.DELTA_SUFFIX
+		my_pid = os.getpid()
+		claimed = []
+		for delta_db_file in glob.glob(glob.escape(delta_prefix) + '*[0-9]'):
+			# Suffixes are either the owning pid or, once claimed,
+			# the claiming pid followed by the original one
+			delta_pids = delta_db_file[len(delta_prefix):].split('-')
+			if not all(map(str.isdigit,delta_pids)):
+				continue
+			
+			# Other deltas with this pid come from a former process
+			owner_pid = int(delta_pids[0])
+			if delta_db_file in self._live_deltas or (owner_pid != my_pid and self._isProcessAlive(owner_pid)):
+				continue
+			
+			claimed_db_file = delta_prefix + str(my_pid) + '-' + delta_pids[-1]
+			if claimed_db_file != delta_db_file:
+				try:
+					os.rename(delta_db_file,claimed_db_file)
+				except FileNotFoundError:
+					# Other process claimed it first
+					continue
+				
+				# The committed transactions not checkpointed yet
+				if os.path.exists(delta_db_file + '-wal'):
+					os.rename(delta_db_file + '-wal',claimed_db_file + '-wal')
+				if os.path.exists(delta_db_file + '-shm'):
+					os.unlink(delta_db_file + '-shm')
+			
+			claimed.append(claimed_db_file)
+		
+		return claimed
+	
+	def _mergeDelta(self,conn:sqlite3.Connection,delta_db_file:str) -> None:
+		"""
+			It merges a delta database into the cache, and then it is
+			removed. Delta entries always win, and the correspondences
+			of the mappings found in the delta replace the former ones
+		"""
+		conn.execute("""ATTACH DATABASE ? AS delta""",(delta_db_file,))
+		try:
+			with conn:
+				# The publish ids resolved in the delta are no longer negative
+				conn.execute("""
+DELETE FROM main.negative_id
+WHERE EXISTS (
+SELECT 1
+FROM delta.idmap d
+WHERE
+d.enricher = negative_id.enricher
+AND
+d.pub_id = negative_id.pub_id
+)
+""")
+				for table_name in ('idmap','lower_map'):
+					conn.execute("""
+DELETE FROM main.{0}
+WHERE EXISTS (
+SELECT 1
+FROM delta.pub d
+WHERE
+d.enricher = {0}.enricher
+AND
+d.id = {0}.id
+AND
+d.source = {0}.source
+)
+""".format(table_name))
+				conn.execute("""
+DELETE FROM main.citref_page
+WHERE EXISTS (
+SELECT 1
+FROM delta.citref d
+WHERE
+d.enricher = citref_page.enricher
+AND
+d.id = citref_page.id
+AND
+d.source = citref_page.source
+AND
+d.is_cit = citref_page.is_cit
+)
+""")
+				# WHERE true avoids the parsing ambiguity of the upserts
+				conn.execute("""
+INSERT INTO main.pub(enricher,id,source,payload,last_fetched)
+SELECT enricher,id,source,payload,last_fetched FROM delta.pub WHERE true
+ON CONFLICT(enricher,id,source) DO UPDATE SET
+payload = excluded.payload,
+last_fetched = excluded.last_fetched
+""")
+				conn.execute("""
+INSERT INTO main.citref(enricher,id,source,is_cit,payload,last_fetched)
+SELECT enricher,id,source,is_cit,payload,last_fetched FROM delta.citref WHERE true
+ON CONFLICT(enricher,id,source,is_cit) DO UPDATE SET
+payload = excluded.payload,
+last_fetched = excluded.last_fetched
+""")
+				conn.execute("""
+INSERT INTO main.citref_page(enricher,id,source,is_cit,page,payload)
+SELECT enricher,id,source,is_cit,page,payload FROM delta.citref_page
+""")
+				conn.execute("""
+INSERT INTO main.idmap(pub_id,enricher,id,source,last_fetched)
+SELECT pub_id,enricher,id,source,last_fetched FROM delta.idmap WHERE true
+ON CONFLICT(pub_id,id,enricher,source) DO UPDATE SET
+last_fetched = excluded.last_fetched
+""")
+				conn.execute("""
+INSERT INTO main.lower_map(enricher,id,source,lower_enricher,lower_id,lower_source,last_fetched)
+SELECT enricher,id,source,lower_enricher,lower_id,lower_source,last_fetched FROM delta.lower_map WHERE true
+ON CONFLICT(enricher,id,source,lower_enricher,lower_id,lower_source) DO UPDATE SET
+last_fetched = excluded.last_fetched
+""")
+				conn.execute("""
+INSERT INTO main.negative_id(enricher,pub_id,last_fetched)
+SELECT enricher,pub_id,last_fetched FROM delta.negative_id WHERE true
+ON CONFLICT(enricher,pub_id) DO UPDATE SET
+last_fetched = excluded.last_fetched
+""")
+				conn.execute("""
+INSERT INTO main.pub_year(enricher,id,source,year,last_fetched)
+SELECT enricher,id,source,year,last_fetched FROM delta.pub_year WHERE true
+ON CONFLICT(enricher,id,source) DO UPDATE SET
+year = excluded.year,
+last_fetched = excluded.last_fetched
+""")
+				conn.execute("""
+INSERT INTO main.pub_partial(enricher,id,source,payload,last_fetched)
+SELECT enricher,id,source,payload,last_fetched FROM delta.pub_partial WHERE true
+ON CONFLICT(enricher,id,source) DO UPDATE SET
+payload = excluded.payload,
+last_fetched = excluded.last_fetched
+""")
+		finally:
+			conn.execute("""DETACH DATABASE delta""")
+		
+		for delta_file in (delta_db_file, delta_db_file + '-wal', delta_db_file + '-shm'):
+			if os.path.exists(delta_file):
+				os.unlink(delta_file)
+	
+	def _readSchemas(self,alias:str=None) -> List[Tuple[str,str]]:
+		"""
+			The schemas to read from, by increasing precedence. When
+			an alias is given, each schema comes with the condition which
+			hides the correspondences from the frozen snapshot superseded
+			by the mappings stored in this run
+		"""
+		if not self.snapshot_mode:
+			return [('main','')]
+		
+		shadow_cond = """
+AND
+NOT EXISTS (
+SELECT 1
+FROM main.pub d
+WHERE
+d.enricher = {0}.enricher
+AND
+d.id = {0}.id
+AND
+d.source = {0}.source
+)""".format(alias)  if alias is not None  else ''
+		
+		return [(self.FROZEN_SCHEMA,shadow_cond),('main','')]
+	
+	def sync(self) -> None:
+		# It waits for the pending writes to be committed
+		self.flush()
+	
+	def _startWriteBehind(self) -> None:
+		self._write_queue = queue.Queue(self.write_behind_queue_size)
+		self._writer_error = None
+		self._writer_thread = threading.Thread(target=self._writeBehindLoop,name='write-behind ' + os.path.basename(self.cache_db_file),daemon=True)
+		self._writer_thread.start()
+		# Last resort, when the cache is not properly closed
+		atexit.register(self._stopWriteBehind)
+	
+	def _stopWriteBehind(self) -> None:
+		if self._writer_thread is None:
+			return
+		
+		atexit.unregister(self._stopWriteBehind)
+		self._write_queue.put(None)
+		self._writer_thread.join()
+		self._writer_thread = None
+		self._write_queue = None
+		
+		self._raiseWriterError()
+	
+	def _raiseWriterError(self) -> None:
+		if self._writer_error is not None:
+			writer_error = self._writer_error
+			self._writer_error = None
+			raise Exception('Cache write-behind failed on {}'.format(self.cache_db_file)) from writer_error
+	
+	def flush(self) -> None:
+		"""
+			It waits until all the queued writes are committed
+		"""
+		if self._write_queue is not None:
+			self._write_queue.join()
+			self._raiseWriterError()
+	
+	def _enqueueWrite(self,kind:str,entries:List[Any],timestamp:datetime.datetime) -> None:
+		"""
+			It queues a batch of writes, which are visible to the reads
+			from now on. It blocks when the queue is full.
+			As callers keep modifying what they stored, copies are queued
+		"""
+		self._raiseWriterError()
+		
+		if kind in (self.WRITE_MAPPINGS,self.WRITE_PARTIALS):
+			entries = [ _json_copy(mapping)  for mapping in entries ]
+		elif kind == self.WRITE_CITREFS:
+			entries = [ (tuple(qual_id), _json_copy(citrefs)  if citrefs is not None  else None, is_cit)  for qual_id, citrefs, is_cit in entries ]
+		else:
+			entries = list(entries)
+		
+		with self._lock:
+			self._write_seq += 1
+			seq = self._write_seq
+			pending = self._pending[kind]
+			for key, value in self._pendingEntries(kind,entries):
+				pending[key] = (seq, timestamp, value)
+				# Keeping the decoded payloads coherent
+				if self.lru is not None and kind in (self.WRITE_MAPPINGS,self.WRITE_CITREFS):
+					self.lru.discard((kind,) + key)
+		
+		self._write_queue.put((seq,kind,entries,timestamp))
+	
+	def _pendingEntries(self,kind:str,entries:List[Any]) -> Iterator[Tuple[Any,Any]]:
+		"""
+			The (key, value) pairs of the overlay of pending writes
+		"""
+		if kind in (self.WRITE_MAPPINGS,self.WRITE_PARTIALS):
+			for mapping in entries:
+				yield (mapping['source'],mapping['id']), mapping
+		elif kind == self.WRITE_CITREFS:
+			for qual_id, citrefs, is_cit in entries:
+				yield (is_cit,) + qual_id, citrefs
+		elif kind == self.WRITE_YEARS:
+			for qual_id, year in entries:
+				yield qual_id, year
+		else:
+			for publish_id in entries:
+				yield publish_id, None
+	
+	def _writeBehindLoop(self) -> None:
+		"""
+			It commits the queued writes in groups, when enough entries
+			have been gathered or the oldest one has waited long enough
+		"""
+		stop = False
+		while not stop:
+			batch = [ self._write_queue.get() ]
+			num_entries = len(batch[0][2])  if batch[0] is not None  else 0
+			stop = batch[0] is None
+			deadline = time.monotonic() + self.write_behind_interval
+			while not stop and num_entries < self.write_behind_group_size:
+				timeout = deadline - time.monotonic()
+				if timeout <= 0:
+					break
+				try:
+					write = self._write_queue.get(timeout=timeout)
+				except queue.Empty:
+					break
+				batch.append(write)
+				if write is None:
+					stop = True
+				else:
+					num_entries += len(write[2])
+			
+			writes = [ write  for write in batch  if write is not None ]
+			try:
+				if writes and self._writer_error is None:
+					self._commitWrites(writes)
+			except BaseException as e:
+				print("ERROR: Cache write-behind on {} failed: {}".format(self.cache_db_file,e),file=sys.stderr)
+				self._writer_error = e
+			finally:
+				for _ in batch:
+					self._write_queue.task_done()
+	
+	def _commitWrites(self,writes:List[Tuple[int,str,List[Any],datetime.datetime]]) -> None:
+		with self._lock:
+			# Only one transaction for the whole group
+			with self.conn:
+				for seq, kind, entries, timestamp in writes:
+					if kind == self.WRITE_MAPPINGS:
+						self._setCachedMappings_TL(OrderedDict(((mapping['source'],mapping['id']),mapping)  for mapping in entries),timestamp)
+					elif kind == self.WRITE_CITREFS:
+						self._setCitRefs_TL(entries,timestamp)
+					elif kind == self.WRITE_YEARS:
+						self._setYears_TL(entries,timestamp)
+					elif kind == self.WRITE_PARTIALS:
+						self._setPartialMappings_TL(entries,timestamp)
+					else:
+						self._setNegativeIds_TL(entries,timestamp)
+			
+			# Committed entries are not overlaid any more,
+			# unless they were queued again meanwhile
+			for seq, kind, entries, timestamp in writes:
+				pending = self._pending[kind]
+				for key, _ in self._pendingEntries(kind,entries):
+					pending_entry = pending.get(key)
+					if pending_entry is not None and pending_entry[0] == seq:
+						del pending[key]
+	
+	def _pendingOverlay(self,kind:str) -> Dict[Any,Tuple[int,datetime.datetime,Any]]:
+		"""
+			The pending writes of this kind to be overlaid on the reads.
+			The write-behind thread itself reads the committed state
+		"""
+		if self._writer_thread is None or threading.current_thread() is self._writer_thread:
+			return None
+		
+		pending = self._pending[kind]
+		return pending  if pending  else None
+	
+	def _mappingPublishIds(self,mapping:Mapping) -> List[PublishId]:
+		publish_ids = []
+		pubmed_id = mapping.get('pmid')
+		if pubmed_id is not None:
+			publish_ids.append(pubmed_id)
+		doi_id = mapping.get('doi')
+		if doi_id:
+			publish_ids.append(self.doi_checker.normalize_doi(doi_id))
+		pmc_id = mapping.get('pmcid')
+		if pmc_id:
+			publish_ids.append(pub_common.normalize_pmcid(pmc_id))
+		
+		return publish_ids
+	
+	def _pendingSourceIds(self,key_fn) -> Tuple[Set[QualifiedId],Dict[Any,List[Tuple[datetime.datetime,QualifiedId,Mapping]]]]:
+		"""
+			It returns the qualified ids with pending mappings, whose
+			stored source ids are outdated, and the source ids derived
+			from those pending mappings, indexed by the keys given by key_fn
+		"""
+		pending = self._pendingOverlay(self.WRITE_MAPPINGS)
+		if pending is None:
+			return set(), {}
+		
+		derived = {}
+		for qual_id, (_, mapping_timestamp, mapping) in pending.items():
+			for key in key_fn(mapping):
+				derived.setdefault(key,[]).append((mapping_timestamp,qual_id,mapping))
+		
+		return set(pending.keys()), derived
+	
+	@staticmethod
+	def _mappingLowerIds(mapping:Mapping) -> List[MetaQualifiedId]:
+		return [ (lower['enricher'],lower['source'],lower['id'])  for lower in mapping.get('base_pubs',[])  if lower.get('id') ]
+	
+	def _decodePayload(self,payload:bytes) -> Any:
+		return self.codec.decode(payload)
+	
+	def trainCodecDictionary(self) -> int:
+		"""
+			It trains a new preset dictionary, used from now on
+			for the new payloads
+		"""
+		if self.snapshot_mode:
+			raise Exception('Codec dictionaries cannot be trained in snapshot mode')
+		
+		with self._lock, self.conn:
+			cur = self.conn.cursor()
+			dict_id = self.codec.trainDictionary_TL(cur,self.CODEC_TABLES)
+			cur.close()
+		
+		return dict_id
+	
+	def _lruLookup(self,prefix:Tuple,qual_list:Iterator[QualifiedId],retval:Dict[QualifiedId,Tuple[datetime.datetime,Any]]) -> List[QualifiedId]:
+		"""
+			It fills retval with the entries found in the LRU,
+			and it returns the list of the ones to be fetched from SQLite
+		"""
+		if self.lru is None:
+			return list(qual_list)
+		
+		missing = []
+		for qual_id in qual_list:
+			qual_id = tuple(qual_id)
+			entry = self.lru.get(prefix + qual_id)
+			if entry is not None:
+				retval[qual_id] = entry
+			else:
+				missing.append(qual_id)
+		
+		return missing
+	
+	def _lruStore(self,key:Tuple,timestamp:datetime.datetime,value:Any) -> Any:
+		if self.lru is None:
+			return value
+		
+		return self.lru.put(key,timestamp,value)
+	
+	def _lruDecode(self,key:Tuple,timestamp:datetime.datetime,payload:bytes,empty:Any=None) -> Any:
+		return self._lruStore(key,timestamp,self._decodePayload(payload)  if payload is not None  else empty)
+	
+	def explainQueryPlans(self) -> List[Tuple[str,List[str],bool]]:
+		"""
+			It returns the query plans of the hot queries, telling
+			which ones do a full scan of a cache table
+		"""
+		with self._lock, self.conn:
+			cur = self.conn.cursor()
+			return pub_common.explain_query_plans(cur,self.QUERY_PLAN_AUDIT)
+	
+	@classmethod
+	def _citrefKind(cls,is_cit:bool) -> str:
+		return 'citations'  if is_cit  else 'references'
+	
+	def _ttlModifier(self,kind:str) -> str:
+		"""
+			The SQLite date modifier giving the oldest valid
+			timestamp of this kind of entries
+		"""
+		return '-{} SECONDS'.format(int(self.ttl[kind].total_seconds()))
+	
+	def _isServable(self,kind:str,timestamp:datetime.datetime,now:datetime.datetime,stale_key:Any) -> bool:
+		"""
+			Whether an entry can be served. Expired entries inside the
+			grace window are served too, marked as stale
+		"""
+		age = now - timestamp
+		if age <= self.ttl[kind]:
+			return True
+		
+		if age <= self.ttl[kind] + self.stale_grace:
+			self.stale[kind].add(stale_key)
+			return True
+		
+		return False
+	
+	def popStaleEntries(self) -> Dict[str,Set[Any]]:
+		"""
+			The keys of the stale entries served since the last call, by
+			kind: publish ids for idmap and negative, qualified ids
+			for the rest
+		"""
+		stale = self.stale
+		self.stale = { kind: set()  for kind in DEFAULT_TTL_DAYS.keys() }
+		
+		return stale
+	
+	def _expiredCondition(self,kind:str) -> str:
+		return "DATETIME('NOW','{}') > last_fetched".format(self._ttlModifier(kind))
+	
+	def _maintenanceTables(self) -> List[Tuple[str,str,str]]:
+		"""
+			The (table name, expiry condition, timestamp column) tuples
+			used by the maintenance, in sweeping order
+		"""
+		return [
+			('pub',self._expiredCondition('mapping'),'last_fetched'),
+			('idmap',self._expiredCondition('idmap'),'last_fetched'),
+			('citref',"(CASE WHEN is_cit THEN {} ELSE {} END)".format(self._expiredCondition('citations'),self._expiredCondition('references')),'last_fetched'),
+			# Pages whose header is gone
+			('citref_page',"""NOT EXISTS (
+SELECT 1
+FROM citref c
+WHERE
+c.enricher = citref_page.enricher
+AND
+c.id = citref_page.id
+AND
+c.source = citref_page.source
+AND
+c.is_cit = citref_page.is_cit
+)""",None),
+			('lower_map',self._expiredCondition('idmap'),'last_fetched'),
+			('negative_id',self._expiredCondition('negative'),'last_fetched'),
+			('pub_year',self._expiredCondition('year'),'last_fetched'),
+			('pub_partial',self._expiredCondition('partial'),'last_fetched'),
+		]
+	
+	def sweepExpired(self,batch_size:int=pub_common.DEFAULT_BATCH_SIZE,verbose:bool=False) -> Dict[str,int]:
+		"""
+			It removes the expired rows of all the tables, in batches.
+			The queued writes are committed before, and the connection
+			is locked on each batch, as the write-behind thread shares it.
+			It returns the number of removed rows per table
+		"""
+		self.sync()
+		deleted = OrderedDict()
+		for table_name, condition, _ in self._maintenanceTables():
+			deleted[table_name] = pub_common.delete_in_batches(self.conn,table_name,condition,batch_size=batch_size,label=table_name  if verbose  else None,lock=self._lock)
+		
+		# Decoded payloads of removed rows are not kept
+		if self.lru is not None:
+			with self._lock:
+				self.lru = DecodedPayloadLRU(self.lru.max_size)
+		
+		return deleted
+	
+	def getTableReport(self) -> List[Dict[str,Any]]:
+		with self._lock:
+			return pub_common.table_report(self.conn,self._maintenanceTables())
+	
+	def optimize(self,full_vacuum:bool=False) -> bool:
+		self.sync()
+		with self._lock:
+			return pub_common.optimize_database(self.conn,full_vacuum)
+	
+	# Number of snapshot records imported on each transaction
+	SNAPSHOT_BATCH_SIZE = 1000
+	
+	def _snapshotRecords(self,since:datetime.datetime=None) -> Iterator[Dict[str,Any]]:
+		"""
+			It yields the rows of all the tables fetched since the given
+			timestamp (all of them when it is None), with their payloads
+			decoded. Paged lists are exported as a whole
+		"""
+		params = {'since': since}
+		cur = self.conn.cursor()
+		page_cur = self.conn.cursor()
+		for res in cur.execute("""
+SELECT enricher, source, id, last_fetched, payload
+FROM pub
+WHERE :since IS NULL OR last_fetched >= :since
+""",params):
+			yield {
+				'table': 'pub',
+				'enricher': res[0],
+				'source': res[1],
+				'id': res[2],
+				'last_fetched': pub_common.snapshot_timestamp(Timestamps.UTCTimestamp(res[3])),
+				'payload': self._decodePayload(res[4])  if res[4] is not None  else None
+			}
+		
+		for res in cur.execute("""
+SELECT enricher, source, id, is_cit, last_fetched, payload
+FROM citref
+WHERE :since IS NULL OR last_fetched >= :since
+""",params):
+			citrefs = self._decodePayload(res[5])  if res[5] is not None  else None
+			if isinstance(citrefs,dict):
+				citrefs = []
+				for page_res in page_cur.execute("""
+SELECT payload
+FROM citref_page
+WHERE
+enricher = :enricher
+AND
+id = :id
+AND
+source = :source
+AND
+is_cit = :is_cit
+ORDER BY page
+""",{'enricher': res[0],'source': res[1],'id': res[2],'is_cit': res[3]}):
+					citrefs.extend(self._decodePayload(page_res[0]))
+			
+			yield {
+				'table': 'citref',
+				'enricher': res[0],
+				'source': res[1],
+				'id': res[2],
+				'is_cit': bool(res[3]),
+				'last_fetched': pub_common.snapshot_timestamp(Timestamps.UTCTimestamp(res[4])),
+				'payload': citrefs
+			}
+		
+		for res in cur.execute("""
+SELECT enricher, pub_id, source, id, last_fetched
+FROM idmap
+WHERE :since IS NULL OR last_fetched >= :since
+""",params):
+			yield {
+				'table': 'idmap',
+				'enricher': res[0],
+				'pub_id': res[1],
+				'source': res[2],
+				'id': res[3],
+				'last_fetched': pub_common.snapshot_timestamp(Timestamps.UTCTimestamp(res[4]))
+			}
+		
+		for res in cur.execute("""
+SELECT enricher, source, id, lower_enricher, lower_source, lower_id, last_fetched
+FROM lower_map
+WHERE :since IS NULL OR last_fetched >= :since
+""",params):
+			yield {
+				'table': 'lower_map',
+				'enricher': res[0],
+				'source': res[1],
+				'id': res[2],
+				'lower_enricher': res[3],
+				'lower_source': res[4],
+				'lower_id': res[5],
+				'last_fetched': pub_common.snapshot_timestamp(Timestamps.UTCTimestamp(res[6]))
+			}
+		
+		for res in cur.execute("""
+SELECT enricher, pub_id, last_fetched
+FROM negative_id
+WHERE :since IS NULL OR last_fetched >= :since
+""",params):
+			yield {
+				'table': 'negative_id',
+				'enricher': res[0],
+				'pub_id': res[1],
+				'last_fetched': pub_common.snapshot_timestamp(Timestamps.UTCTimestamp(res[2]))
+			}
+		
+		for res in cur.execute("""
+SELECT enricher, source, id, year, last_fetched
+FROM pub_year
+WHERE :since IS NULL OR last_fetched >= :since
+""",params):
+			yield {
+				'table': 'pub_year',
+				'enricher': res[0],
+				'source': res[1],
+				'id': res[2],
+				'year': res[3],
+				'last_fetched': pub_common.snapshot_timestamp(Timestamps.UTCTimestamp(res[4]))
+			}
+		
+		for res in cur.execute("""
+SELECT enricher, source, id, last_fetched, payload
+FROM pub_partial
+WHERE :since IS NULL OR last_fetched >= :since
+""",params):
+			yield {
+				'table': 'pub_partial',
+				'enricher': res[0],
+				'source': res[1],
+				'id': res[2],
+				'last_fetched': pub_common.snapshot_timestamp(Timestamps.UTCTimestamp(res[3])),
+				'payload': self._decodePayload(res[4])
+			}
+		
+		page_cur.close()
+		cur.close()
+	
+	def exportSnapshot(self,snapshot_file:str,since:datetime.datetime=None) -> Dict[str,int]:
+		"""
+			It writes a snapshot of the cache, or only of the entries
+			fetched since the given timestamp (for incremental exports).
+			It returns the number of exported rows per table
+		"""
+		self.flush()
+		with self._lock, self.conn:
+			return pub_common.write_snapshot(snapshot_file,'pub',since,self._snapshotRecords(since))
+	
+	def _importRecords_TL(self,cur,table_name:str,records:List[Dict[str,Any]]) -> None:
+		"""
+			It stores the snapshot records, unless the cache
+			already has a newer version of them
+		"""
+		for record in records:
+			record['last_fetched'] = pub_common.parse_snapshot_timestamp(record['last_fetched'])
+		
+		if table_name == 'pub':
+			cur.executemany("""
+INSERT INTO pub(enricher,id,source,payload,last_fetched) VALUES(:enricher,:id,:source,:payload,:last_fetched)
+ON CONFLICT(enricher,id,source) DO UPDATE SET
+payload = excluded.payload,
+last_fetched = excluded.last_fetched
+WHERE excluded.last_fetched > pub.last_fetched
+""",[
+				dict(record,payload=self.codec.encode(record['payload'])  if record['payload'] is not None  else None)
+				for record in records
+			])
+		elif table_name == 'citref':
+			# Paged lists are rewritten along with their pages,
+			# so the newest ones are chosen beforehand
+			params_list = []
+			pages_params_list = []
+			for record in records:
+				cur.execute("""
+SELECT last_fetched
+FROM citref
+WHERE
+enricher = :enricher
+AND
+id = :id
+AND
+source = :source
+AND
+is_cit = :is_cit
+""",record)
+				res = cur.fetchone()
+				if res is None or record['last_fetched'] > Timestamps.UTCTimestamp(res[0]):
+					params_list.append(self._citRefsParams(record['enricher'],(record['source'],record['id']),record['payload'],record['is_cit'],record['last_fetched'],pages_params_list))
+			
+			self._storeCitRefs_TL(cur,params_list,pages_params_list)
+		elif table_name == 'idmap':
+			cur.executemany("""
+INSERT INTO idmap(pub_id,enricher,id,source,last_fetched) VALUES(:pub_id,:enricher,:id,:source,:last_fetched)
+ON CONFLICT(pub_id,id,enricher,source) DO UPDATE SET
+last_fetched = excluded.last_fetched
+WHERE excluded.last_fetched > idmap.last_fetched
+""",records)
+		elif table_name == 'lower_map':
+			cur.executemany("""
+INSERT INTO lower_map(enricher,id,source,lower_enricher,lower_id,lower_source,last_fetched) VALUES(:enricher,:id,:source,:lower_enricher,:lower_id,:lower_source,:last_fetched)
+ON CONFLICT(enricher,id,source,lower_enricher,lower_id,lower_source) DO UPDATE SET
+last_fetched = excluded.last_fetched
+WHERE excluded.last_fetched > lower_map.last_fetched
+""",records)
+		elif table_name == 'negative_id':
+			cur.executemany("""
+INSERT INTO negative_id(enricher,pub_id,last_fetched) VALUES(:enricher,:pub_id,:last_fetched)
+ON CONFLICT(enricher,pub_id) DO UPDATE SET
+last_fetched = excluded.last_fetched
+WHERE excluded.last_fetched > negative_id.last_fetched
+""",records)
+		elif table_name == 'pub_year':
+			cur.executemany("""
+INSERT INTO pub_year(enricher,id,source,year,last_fetched) VALUES(:enricher,:id,:source,:year,:last_fetched)
+ON CONFLICT(enricher,id,source) DO UPDATE SET
+year = excluded.year,
+last_fetched = excluded.last_fetched
+WHERE excluded.last_fetched > pub_year.last_fetched
+""",records)
+		elif table_name == 'pub_partial':
+			cur.executemany("""
+INSERT INTO pub_partial(enricher,id,source,payload,last_fetched) VALUES(:enricher,:id,:source,:payload,:last_fetched)
+ON CONFLICT(enricher,id,source) DO UPDATE SET
+payload = excluded.payload,
+last_fetched = excluded.last_fetched
+WHERE excluded.last_fetched > pub_partial.last_fetched
+""",[
+				dict(record,payload=self.codec.encode(record['payload']))
+				for record in records
+			])
+		else:
+			raise Exception('Unknown table {} in cache snapshot'.format(table_name))
+	
+	def importSnapshot(self,snapshot_file:str) -> Dict[str,int]:
+		"""
+			It merges a snapshot into the cache. On each entry, the newest
+			last_fetched wins, so snapshots from several nodes can be
+			imported in any order. It returns the number of read rows per table
+		"""
+		counts = OrderedDict()
+		pending = OrderedDict()
+		for record in pub_common.read_snapshot(snapshot_file,'pub'):
+			table_name = record.pop('table')
+			counts[table_name] = counts.get(table_name,0) + 1
+			records = pending.setdefault(table_name,[])
+			records.append(record)
+			if len(records) >= self.SNAPSHOT_BATCH_SIZE:
+				with self._lock, self.conn:
+					self._importRecords_TL(self.conn.cursor(),table_name,pending.pop(table_name))
+		
+		with self._lock, self.conn:
+			cur = self.conn.cursor()
+			for table_name, records in pending.items():
+				self._importRecords_TL(cur,table_name,records)
+		
+		# Decoded payloads of replaced rows are not kept
+		if self.lru is not None:
+			self.lru = DecodedPayloadLRU(self.lru.max_size)
+		
+		return counts
+	
+	def getLRUStats(self) -> Dict[str,Any]:
+		return self.lru.stats()  if self.lru is not None  else None
+	
+	def getCacheStats(self) -> Dict[str,Any]:
+		"""
+			The lookups by kind of entry, the decompressed payloads
+			and the time spent in SQLite since the cache was created
+		"""
+		report = OrderedDict([
+			('cache', os.path.basename(self.cache_db_file)),
+			('enricher', self.enricher_name),
+		])
+		report.update(self.stats.asDict())
+		report['decoded_payloads'] = self.codec.decoded_payloads
+		report['decoded_bytes'] = self.codec.decoded_bytes
+		report['lru'] = self.getLRUStats()
+		
+		return report
+	
+	def planPublishIdsBulk(self,publish_id_iter:Iterator[PublishId]) -> Tuple[Dict[PublishId,List[QualifiedId]],Set[PublishId],Set[PublishId]]:
+		"""
+			Used by the dry runs, it tells which publish ids are resolved
+			by the cache (along with their source ids, which are none for
+			the known unresolvable ones), which ones expired, and which
+			ones are missing
+		"""
+		publish_id_set = set(publish_id_iter)
+		with self._lock, self.conn:
+			raw_mappings = self.getRawCachedMappingsFromPublishIdsBulk_TL(publish_id_set)
+			raw_negatives = self.getRawNegativeIdsBulk_TL(publish_id_set - raw_mappings.keys())
+		
+		now = Timestamps.UTCTimestamp(datetime.datetime.utcnow())
+		cached = {}
+		expired = set()
+		for publish_id, raw_list in raw_mappings.items():
+			internal_ids = [ internal_id  for timestamp_internal_id, internal_id, mapping_timestamp, _ in raw_list  if (now - timestamp_internal_id) <= self.ttl['idmap'] and mapping_timestamp is not None and (now - mapping_timestamp) <= self.ttl['mapping'] ]
+			if internal_ids:
+				cached[publish_id] = internal_ids
+			else:
+				expired.add(publish_id)
+		
+		for publish_id, negative_timestamp in raw_negatives.items():
+			if (now - negative_timestamp) <= self.ttl['negative']:
+				cached[publish_id] = []
+			else:
+				expired.add(publish_id)
+		
+		return cached, expired, publish_id_set - cached.keys() - expired
+	
+	def planCitRefsBulk(self,qual_list:Iterator[QualifiedId],is_cit:bool) -> Tuple[Dict[QualifiedId,List[Tuple]],Dict[QualifiedId,List[Tuple]],Set[QualifiedId]]:
+		"""
+			Used by the dry runs, it returns the cached and the expired
+			citations or references, and the set of missing ones
+		"""
+		qual_set = set(map(tuple,qual_list))
+		with self._lock, self.conn:
+			raw_citrefs = self.getRawCitRefsBulk_TL(qual_set,is_cit)
+		
+		now = Timestamps.UTCTimestamp(datetime.datetime.utcnow())
+		ttl = self.ttl[self._citrefKind(is_cit)]
+		cached = {}
+		expired = {}
+		for qual_id, (citrefs_timestamp, citrefs) in raw_citrefs.items():
+			if (now - citrefs_timestamp) <= ttl:
+				cached[qual_id] = citrefs
+			else:
+				expired[qual_id] = citrefs
+		
+		return cached, expired, qual_set - raw_citrefs.keys()
+	
+	def planMappingsBulk(self,qual_list:Iterator[QualifiedId]) -> Tuple[Set[QualifiedId],Set[QualifiedId],Set[QualifiedId]]:
+		"""
+			Used by the dry runs, it returns the sets of cached,
+			expired and missing mappings
+		"""
+		qual_set = set(map(tuple,qual_list))
+		with self._lock, self.conn:
+			raw_mappings = self.getRawCachedMappingsBulk_TL(qual_set)
+		
+		now = Timestamps.UTCTimestamp(datetime.datetime.utcnow())
+		cached = set(qual_id  for qual_id, (mapping_timestamp, _) in raw_mappings.items()  if (now - mapping_timestamp) <= self.ttl['mapping'])
+		
+		return cached, raw_mappings.keys() - cached, qual_set - raw_mappings.keys()
+	
+	def getRefreshCandidates(self,kind:str,horizon:datetime.timedelta,limit:int) -> List[Tuple[datetime.datetime,Any]]:
+		"""
+			Up to limit entries of the kind (mapping, citations, references
+			or idmap) expiring within the horizon, with their expiry and
+			closest to it first. The ones out of the grace window are
+			left to be fetched on demand. The keys are publish ids
+			for idmap, and qualified ids for the rest
+		"""
+		ttl = self.ttl[kind]
+		params = {
+			'enricher': self.enricher_name,
+			'oldest': '-{} SECONDS'.format(int((ttl + self.stale_grace).total_seconds())),
+			'newest': '{:+d} SECONDS'.format(int((horizon - ttl).total_seconds())),
+			'limit': limit,
+		}
+		if kind == 'idmap':
+			query = self.REFRESH_QUERIES['idmap']
+		elif kind == 'mapping':
+			query = self.REFRESH_QUERIES['mapping']
+		else:
+			query = self.REFRESH_QUERIES['citref']
+			params['is_cit'] = kind == 'citations'
+		
+		candidates = {}
+		with self._lock, self.conn:
+			cur = self.conn.cursor()
+			for schema, _ in self._readSchemas():
+				for res in cur.execute(query.format(schema),params).fetchall():
+					if kind == 'idmap':
+						key = res[0]
+					else:
+						key = (res[0],res[1])
+					# The publish ids expire with their oldest correspondence
+					last_fetched = Timestamps.UTCTimestamp(res[-1])
+					if key not in candidates or candidates[key] > last_fetched:
+						candidates[key] = last_fetched
+		
+		return sorted((last_fetched + ttl, key)  for key, last_fetched in candidates.items())[0:limit]
+	
+	def _loadBulkQual_TL(self,cur,qual_list:Iterator[QualifiedId]) -> None:
+		"""
+			It fills the temporary table used to join the qualified ids
+		"""
+		cur.execute("""DELETE FROM temp.bulk_qual""")
+		cur.executemany("""
+INSERT OR IGNORE INTO temp.bulk_qual(source,id) VALUES(?,?)
+""",qual_list)
+	
+	def _getRawCitRefsHeadersBulk_TL(self,cur,qual_list:Iterator[QualifiedId],is_cit:bool,summary:bool=False) -> Dict[QualifiedId,Tuple[str,datetime.datetime,Any]]:
+		"""
+			It returns the decoded citref rows, which are either the whole
+			list or the header of a paged one, along with the schema
+			where their pages are. On summary, binary lists are given as
+			headers with their count and histogram by year
+		"""
+		self._loadBulkQual_TL(cur,qual_list)
+		headers = {}
+		for schema, _ in self._readSchemas():
+			for res in cur.execute("""
+SELECT c.source, c.id, c.last_fetched, c.payload
+FROM temp.bulk_qual q CROSS JOIN {}.citref c
+WHERE
+c.enricher = :enricher
+AND
+c.id = q.id
+AND
+c.source = q.source
+AND
+c.is_cit = :is_cit
+""".format(schema),{'enricher': self.enricher_name,'is_cit': is_cit}).fetchall():
+				payload = res[3]
+				if payload is None:
+					citrefs = []
+				elif summary and payload[0] == PayloadCodec.TAG_CITREFS:
+					years = self.codec.decodeCitRefsArrays(payload).years
+					citrefs = {'count': len(years), 'year_stats': citref_arrays_year_stats(years)}
+				else:
+					citrefs = self._decodePayload(payload)
+				headers[(res[0],res[1])] = (schema, Timestamps.UTCTimestamp(res[2]), citrefs)
+		
+		return headers
+	
+	def _pendingCitRefsLookup(self,qual_list:Iterator[QualifiedId],is_cit:bool,retval:Dict[QualifiedId,Tuple[datetime.datetime,List[Tuple]]]) -> List[QualifiedId]:
+		"""
+			It fills retval with the pending citrefs, and it returns
+			the list of the ones to be looked up elsewhere
+		"""
+		pending = self._pendingOverlay(self.WRITE_CITREFS)
+		if pending is None:
+			return qual_list
+		
+		missing = []
+		for qual_id in qual_list:
+			qual_id = tuple(qual_id)
+			pending_entry = pending.get((is_cit,) + qual_id)
+			if pending_entry is not None:
+				retval[qual_id] = (pending_entry[1], _json_copy(pending_entry[2]))
+			else:
+				missing.append(qual_id)
+		
+		return missing
+	
+	def getRawCitRefsBulk_TL(self,qual_list:Iterator[QualifiedId],is_cit:bool) -> Dict[QualifiedId,Tuple[datetime.datetime,List[Tuple]]]:
+		"""
+			Bulk version of getCitRefs, answered with a constant number
+			of SQL statements. This method does not invalidate the cache
+		"""
+		retval = {}
+		qual_list = self._pendingCitRefsLookup(qual_list,is_cit,retval)
+		qual_list = self._lruLookup(('citref',is_cit),qual_list,retval)
+		if not qual_list:
+			return retval
+		
+		cur = self.conn.cursor()
+		decoded = {}
+		paged = {}
+		for qual_id, (schema, citrefs_timestamp, citrefs) in self._getRawCitRefsHeadersBulk_TL(cur,qual_list,is_cit).items():
+			# Paged lists are rebuilt from their pages
+			if isinstance(citrefs,dict):
+				paged.setdefault(schema,set()).add(qual_id)
+				citrefs = []
+			decoded[qual_id] = (citrefs_timestamp, citrefs)
+		
+		for schema, paged_ids in paged.items():
+			for res in cur.execute("""
+SELECT p.source, p.id, p.payload
+FROM temp.bulk_qual q CROSS JOIN {}.citref_page p
+WHERE
+p.enricher = :enricher
+AND
+p.id = q.id
+AND
+p.source = q.source
+AND
+p.is_cit = :is_cit
+ORDER BY q.source, q.id, p.page
+""".format(schema),{'enricher': self.enricher_name,'is_cit': is_cit}):
+				qual_id = (res[0],res[1])
+				if qual_id in paged_ids:
+					decoded[qual_id][1].extend(self._decodePayload(res[2]))
+		
+		for qual_id, (citrefs_timestamp, citrefs) in decoded.items():
+			retval[qual_id] = (citrefs_timestamp, self._lruStore(('citref',is_cit) + qual_id,citrefs_timestamp,citrefs))
+		
+		return retval
+	
+	def getRawCitRefsBulk(self,qual_list:Iterator[QualifiedId],is_cit:bool) -> Dict[QualifiedId,Tuple[datetime.datetime,List[Tuple]]]:
+		"""
+			This method does not invalidate the cache
+		"""
+		with self._lock, self.conn:
+			return self.getRawCitRefsBulk_TL(qual_list,is_cit)
+	
+	def getRawCitRefsSummaryBulk_TL(self,qual_list:Iterator[QualifiedId],is_cit:bool) -> Dict[QualifiedId,Tuple[datetime.datetime,int,List[Dict[str,Any]]]]:
+		"""
+			It returns the count and the histogram by year of the citations
+			or references, without fetching the pages of the paged lists.
+			This method does not invalidate the cache
+		"""
+		cached = {}
+		qual_list = self._pendingCitRefsLookup(qual_list,is_cit,cached)
+		qual_list = self._lruLookup(('citref',is_cit),qual_list,cached)
+		retval = {
+			qual_id: (citrefs_timestamp, len(citrefs), citref_year_stats(citrefs))
+			for qual_id, (citrefs_timestamp, citrefs) in cached.items()
+		}
+		if qual_list:
+			cur = self.conn.cursor()
+			for qual_id, (_, citrefs_timestamp, citrefs) in self._getRawCitRefsHeadersBulk_TL(cur,qual_list,is_cit,summary=True).items():
+				if isinstance(citrefs,dict):
+					retval[qual_id] = (citrefs_timestamp, citrefs['count'], citrefs['year_stats'])
+				else:
+					retval[qual_id] = (citrefs_timestamp, len(citrefs), citref_year_stats(citrefs))
+		
+		return retval
+	
+	def getCitRefsSummaryBulk(self,qual_list:Iterator[QualifiedId],is_cit:bool) -> Dict[QualifiedId,Tuple[int,List[Dict[str,Any]]]]:
+		"""
+			Summary version of getCitRefsBulk, giving the count and
+			the histogram by year. Missing or expired entries
+			are not included in the returned dictionary
+		"""
+		qual_list = list(qual_list)
+		with self._lock, self.conn:
+			raw_summaries = self.getRawCitRefsSummaryBulk_TL(qual_list,is_cit)
+		
+		now = Timestamps.UTCTimestamp(datetime.datetime.utcnow())
+		kind = self._citrefKind(is_cit)
+		self.stats.countTimestamps(kind,len(qual_list),(citrefs_timestamp  for citrefs_timestamp, _, _ in raw_summaries.values()),self.ttl[kind],now)
+		return { qual_id: (count, year_stats)  for qual_id, (citrefs_timestamp, count, year_stats) in raw_summaries.items()  if self._isServable(kind,citrefs_timestamp,now,qual_id) }
+	
+	def getCitRefsPages(self,qual_id:QualifiedId,is_cit:bool) -> Iterator[List[Tuple]]:
+		"""
+			It streams the citations or references page by page, so the
+			longest lists are never fully decoded in memory. Lists which
+			are not paged are yielded as a single page. Nothing is yielded
+			for missing or expired (and not stale) entries
+		"""
+		qual_id = tuple(qual_id)
+		with self._lock, self.conn:
+			pending = {}
+			if not self._pendingCitRefsLookup([qual_id],is_cit,pending):
+				headers = { qual_id: (None,) + pending[qual_id] }
+			else:
+				cur = self.conn.cursor()
+				headers = self._getRawCitRefsHeadersBulk_TL(cur,[qual_id],is_cit)
+		
+		kind = self._citrefKind(is_cit)
+		if qual_id not in headers:
+			self.stats.count(kind,misses=1)
+			return
+		
+		schema, citrefs_timestamp, citrefs = headers[qual_id]
+		now = Timestamps.UTCTimestamp(datetime.datetime.utcnow())
+		self.stats.countTimestamps(kind,1,[citrefs_timestamp],self.ttl[kind],now)
+		if not self._isServable(kind,citrefs_timestamp,now,qual_id):
+			return
+		
+		if not isinstance(citrefs,dict):
+			yield citrefs
+			return
+		
+		for page in range(citrefs['pages']):
+			# The connection may be shared with the write-behind thread
+			with self._lock:
+				res = cur.execute("""
+SELECT payload
+FROM {}.citref_page
+WHERE
+enricher = :enricher
+AND
+id = :id
+AND
+source = :source
+AND
+is_cit = :is_cit
+AND
+page = :page
+""".format(schema),{'enricher': self.enricher_name,'source': qual_id[0],'id': qual_id[1],'is_cit': is_cit,'page': page}).fetchone()
+			if res is not None:
+				yield self._decodePayload(res[0])
+	
+	def getCitRefsBulk(self,qual_list:Iterator[QualifiedId],is_cit:bool) -> Dict[QualifiedId,List[Tuple]]:
+		"""
+			Bulk version of getCitRefs. Missing or expired entries
+			are not included in the returned dictionary
+		"""
+		qual_list = list(qual_list)
+		with self._lock, self.conn:
+			raw_citrefs = self.getRawCitRefsBulk_TL(qual_list,is_cit)
+		
+		now = Timestamps.UTCTimestamp(datetime.datetime.utcnow())
+		kind = self._citrefKind(is_cit)
+		self.stats.countTimestamps(kind,len(qual_list),(citrefs_timestamp  for citrefs_timestamp, _ in raw_citrefs.values()),self.ttl[kind],now)
+		return { qual_id: citrefs  for qual_id, (citrefs_timestamp, citrefs) in raw_citrefs.items()  if self._isServable(kind,citrefs_timestamp,now,qual_id) }
+	
+	def getCitRefs(self,qual_list:Iterator[QualifiedId],is_cit:bool) -> Iterator[Tuple]:
+		qual_list = list(qual_list)
+		citrefs_hash = self.getCitRefsBulk(qual_list,is_cit)
+		for qual_id in qual_list:
+			yield citrefs_hash.get(tuple(qual_id))
+	
+	def _citRefsParams(self,enricher:str,qual_id:QualifiedId,citrefs:List[Tuple],is_cit:bool,timestamp:datetime.datetime,pages_params_list:List[Dict[str,Any]]) -> Dict[str,Any]:
+		"""
+			It returns the parameters of the citref row, appending the
+			ones of its pages (if the list is paged) to pages_params_list
+		"""
+		params = {
+			'enricher': enricher,
+			'source': qual_id[0],
+			'id': qual_id[1],
+			'is_cit': is_cit,
+			'last_fetched': timestamp,
+			'num_pages': 0
+		}
+		
+		if citrefs is not None and len(citrefs) > self.CITREF_PAGE_SIZE:
+			for page, citrefs_page in enumerate(_chunks(citrefs,self.CITREF_PAGE_SIZE)):
+				pages_params_list.append({
+					'enricher': enricher,
+					'source': qual_id[0],
+					'id': qual_id[1],
+					'is_cit': is_cit,
+					'page': page,
+					'payload': self.codec.encodeCitRefs(citrefs_page)
+				})
+				params['num_pages'] = page + 1
+			
+			# The header of the paged list
+			params['payload'] = self.codec.encode({
+				'count': len(citrefs),
+				'pages': params['num_pages'],
+				'year_stats': citref_year_stats(citrefs)
+			})
+		else:
+			params['payload'] = self.codec.encodeCitRefs(citrefs)  if citrefs is not None  else  None
+		
+		return params
+	
+	def _storeCitRefs_TL(self,cur,params_list:List[Dict[str,Any]],pages_params_list:List[Dict[str,Any]]) -> None:
+		cur.executemany("""
+INSERT INTO citref(enricher,id,source,is_cit,payload,last_fetched) VALUES(:enricher,:id,:source,:is_cit,:payload,:last_fetched)
+ON CONFLICT(enricher,id,source,is_cit) DO UPDATE SET
+payload = excluded.payload,
+last_fetched = excluded.last_fetched
+""",params_list)
+		# Pages from longer former lists
+		cur.executemany("""
+DELETE FROM citref_page
+WHERE
+enricher = :enricher
+AND
+id = :id
+AND
+source = :source
+AND
+is_cit = :is_cit
+AND
+page >= :num_pages
+""",params_list)
+		# Unchanged pages are not rewritten
+		cur.executemany("""
+INSERT INTO citref_page(enricher,id,source,is_cit,page,payload) VALUES(:enricher,:id,:source,:is_cit,:page,:payload)
+ON CONFLICT(enricher,id,source,is_cit,page) DO UPDATE SET
+payload = excluded.payload
+WHERE payload IS NOT excluded.payload
+""",pages_params_list)
+	
+	def _setCitRefs_TL(self,citref_list:Iterator[Tuple[QualifiedId,List[Tuple],bool]],timestamp:datetime.datetime) -> None:
+		pages_params_list = []
+		params_list = [
+			self._citRefsParams(self.enricher_name,qual_id,citrefs,is_cit,timestamp,pages_params_list)
+			for qual_id,citrefs,is_cit in citref_list
+		]
+		
+		if params_list:
+			# Keeping the decoded payloads coherent
+			if self.lru is not None:
+				for params in params_list:
+					self.lru.discard(('citref',params['is_cit'],params['source'],params['id']))
+			
+			cur = self.conn.cursor()
+			self._storeCitRefs_TL(cur,params_list,pages_params_list)
+			
+			# The listings also tell the years of the citing or cited publications
+			self._setYears_TL(self._citRefsYears(citref_list),timestamp)
+	
+	def setCitRefs(self,citref_list:Iterator[Tuple[QualifiedId,List[Tuple],bool]],timestamp:datetime.datetime = Timestamps.UTCTimestamp()) -> None:
+		citref_list = [ (tuple(qual_id),citrefs,is_cit)  for qual_id,citrefs,is_cit in citref_list ]
+		if not citref_list:
+			return
+		
+		if self._write_queue is not None:
+			self._enqueueWrite(self.WRITE_CITREFS,citref_list,timestamp)
+		else:
+			# Only one transaction for the whole batch
+			with self._lock, self.conn:
+				self._setCitRefs_TL(citref_list,timestamp)
+	
+	@classmethod
+	def _citRefsYears(cls,citref_list:Iterator[Tuple[QualifiedId,List[Tuple],bool]]) -> Iterator[Tuple[QualifiedId,int]]:
+		for _, citrefs, _ in citref_list:
+			if citrefs is not None:
+				for citref in citrefs:
+					year = citref.get('year')
+					if isinstance(year,int) and citref.get('id') is not None and citref.get('source') is not None:
+						yield (citref['source'],citref['id']), year
+	
+	def getRawYearsBulk_TL(self,qual_list:Iterator[QualifiedId]) -> Dict[QualifiedId,Tuple[datetime.datetime,int]]:
+		"""
+			It returns the known publication years, along with
+			when they were fetched.
+			This method does not invalidate the cache
+		"""
+		retval = {}
+		qual_list = [ tuple(qual_id)  for qual_id in qual_list ]
+		cur = self.conn.cursor()
+		self._loadBulkQual_TL(cur,qual_list)
+		for schema, _ in self._readSchemas():
+			for res in cur.execute("""
+SELECT y.source, y.id, y.year, y.last_fetched
+FROM temp.bulk_qual q CROSS JOIN {}.pub_year y
+WHERE
+y.enricher = :enricher
+AND
+y.id = q.id
+AND
+y.source = q.source
+""".format(schema),{'enricher': self.enricher_name}).fetchall():
+				retval[(res[0],res[1])] = (Timestamps.UTCTimestamp(res[3]), res[2])
+		
+		pending = self._pendingOverlay(self.WRITE_YEARS)
+		if pending is not None:
+			for qual_id in pending.keys() & set(qual_list):
+				pending_entry = pending[qual_id]
+				retval[qual_id] = (pending_entry[1], pending_entry[2])
+		
+		return retval
+	
+	def getYearsBulk(self,qual_list:Iterator[QualifiedId]) -> Dict[QualifiedId,int]:
+		"""
+			The publication years known for the qualified ids.
+			Missing or expired entries are not included
+		"""
+		qual_list = list(qual_list)
+		with self._lock, self.conn:
+			raw_years = self.getRawYearsBulk_TL(qual_list)
+		
+		now = Timestamps.UTCTimestamp(datetime.datetime.utcnow())
+		self.stats.countTimestamps('year',len(qual_list),(year_timestamp  for year_timestamp, _ in raw_years.values()),self.ttl['year'],now)
+		return { qual_id: year  for qual_id, (year_timestamp, year) in raw_years.items()  if self._isServable('year',year_timestamp,now,qual_id) }
+	
+	def _setYears_TL(self,years_iter:Iterator[Tuple[QualifiedId,int]],timestamp:datetime.datetime) -> None:
+		# Unchanged years are only refreshed past half their time to live,
+		# so storing long lists again does not rewrite all their years
+		refresh_before = timestamp - self.ttl['year'] / 2
+		cur = self.conn.cursor()
+		cur.executemany("""
+INSERT INTO pub_year(enricher,id,source,year,last_fetched) VALUES(:enricher,:id,:source,:year,:last_fetched)
+ON CONFLICT(enricher,id,source) DO UPDATE SET
+year = excluded.year,
+last_fetched = excluded.last_fetched
+WHERE pub_year.year <> excluded.year OR pub_year.last_fetched < :refresh_before
+""",[
+			{
+				'enricher': self.enricher_name,
+				'source': qual_id[0],
+				'id': qual_id[1],
+				'year': year,
+				'last_fetched': timestamp,
+				'refresh_before': refresh_before
+			}
+			for qual_id, year in dict(years_iter).items()
+		])
+	
+	def setYears(self,years_iter:Iterator[Tuple[QualifiedId,int]],timestamp:datetime.datetime = Timestamps.UTCTimestamp()) -> None:
+		"""
+			It records (or refreshes) the publication years
+			of the qualified ids, in a single batch
+		"""
+		years = list(dict((tuple(qual_id),year)  for qual_id, year in years_iter  if year is not None).items())
+		if not years:
+			return
+		
+		if self._write_queue is not None:
+			self._enqueueWrite(self.WRITE_YEARS,years,timestamp)
+		else:
+			with self._lock, self.conn:
+				self._setYears_TL(years,timestamp)
+	
+	def getRawPartialMappingsBulk_TL(self,qual_list:Iterator[QualifiedId]) -> Dict[QualifiedId,Tuple[datetime.datetime,Mapping]]:
+		"""
+			It returns the known partial mappings, along with
+			when they were fetched.
+			This method does not invalidate the cache
+		"""
+		retval = {}
+		qual_list = [ tuple(qual_id)  for qual_id in qual_list ]
+		cur = self.conn.cursor()
+		self._loadBulkQual_TL(cur,qual_list)
+		for schema, _ in self._readSchemas():
+			for res in cur.execute("""
+SELECT p.source, p.id, p.last_fetched, p.payload
+FROM temp.bulk_qual q CROSS JOIN {}.pub_partial p
+WHERE
+p.enricher = :enricher
+AND
+p.id = q.id
+AND
+p.source = q.source
+""".format(schema),{'enricher': self.enricher_name}).fetchall():
+				retval[(res[0],res[1])] = (Timestamps.UTCTimestamp(res[2]), self._decodePayload(res[3]))
+		
+		pending = self._pendingOverlay(self.WRITE_PARTIALS)
+		if pending is not None:
+			for qual_id in pending.keys() & set(qual_list):
+				pending_entry = pending[qual_id]
+				retval[qual_id] = (pending_entry[1], _json_copy(pending_entry[2]))
+		
+		return retval
+	
+	def getPartialMappingsBulk(self,qual_list:Iterator[QualifiedId]) -> Dict[QualifiedId,Mapping]:
+		"""
+			The partial mappings known for the qualified ids, which only
+			have the fields their source told. Missing or expired
+			entries are not included
+		"""
+		qual_list = list(qual_list)
+		with self._lock, self.conn:
+			raw_partials = self.getRawPartialMappingsBulk_TL(qual_list)
+		
+		now = Timestamps.UTCTimestamp(datetime.datetime.utcnow())
+		self.stats.countTimestamps('partial',len(qual_list),(partial_timestamp  for partial_timestamp, _ in raw_partials.values()),self.ttl['partial'],now)
+		return { qual_id: partial_mapping  for qual_id, (partial_timestamp, partial_mapping) in raw_partials.items()  if self._isServable('partial',partial_timestamp,now,qual_id) }
+	
+	def _setPartialMappings_TL(self,partial_mappings:List[Mapping],timestamp:datetime.datetime) -> None:
+		# As the same publications are listed again and again, unchanged
+		# entries are only refreshed past half their time to live
+		refresh_before = timestamp - self.ttl['partial'] / 2
+		cur = self.conn.cursor()
+		cur.executemany("""
+INSERT INTO pub_partial(enricher,id,source,payload,last_fetched) VALUES(:enricher,:id,:source,:payload,:last_fetched)
+ON CONFLICT(enricher,id,source) DO UPDATE SET
+payload = excluded.payload,
+last_fetched = excluded.last_fetched
+WHERE pub_partial.payload <> excluded.payload OR pub_partial.last_fetched < :refresh_before
+""",[
+			{
+				'enricher': self.enricher_name,
+				'source': partial_mapping['source'],
+				'id': partial_mapping['id'],
+				'payload': self.codec.encode(partial_mapping),
+				'last_fetched': timestamp,
+				'refresh_before': refresh_before
+			}
+			for partial_mapping in partial_mappings
+		])
+	
+	def setPartialMappings(self,partial_mapping_iter:Iterator[Mapping],timestamp:datetime.datetime = Timestamps.UTCTimestamp()) -> None:
+		"""
+			It records (or refreshes) the partial mappings, whose
+			missing fields are unknown, in a single batch.
+			They are never served as mappings
+		"""
+		partial_mappings = list(OrderedDict(((partial_mapping['source'],partial_mapping['id']),partial_mapping)  for partial_mapping in partial_mapping_iter).values())
+		if not partial_mappings:
+			return
+		
+		if self._write_queue is not None:
+			self._enqueueWrite(self.WRITE_PARTIALS,partial_mappings,timestamp)
+		else:
+			with self._lock, self.conn:
+				self._setPartialMappings_TL(partial_mappings,timestamp)
+	
+	def getCitationsAndCount(self, source_id:SourceId, _id:UnqualifiedId) -> Tuple[List[Citation],CitationCount]:
+		for citations in self.getCitRefs([(source_id,_id)], True):
+			if citations is not None:
+				return citations,len(citations)
+			else:
+				break
+		
+		return None, None
+	
+	def setCitationsAndCount(self,source_id:SourceId,_id:UnqualifiedId,citations:List[Citation],citation_count:CitationCount,timestamp:datetime.datetime = Timestamps.UTCTimestamp()) -> None:
+		self.setCitRefs([((source_id,_id),citations,True)],timestamp)
+	
+	def getReferencesAndCount(self, source_id:SourceId, _id:UnqualifiedId) -> Tuple[List[Citation],CitationCount]:
+		for references in self.getCitRefs([(source_id,_id)], False):
+			if references is not None:
+				return references,len(references)
+			else:
+				break
+		
+		return None, None
+	
+	def setReferencesAndCount(self,source_id:SourceId,_id:UnqualifiedId,references:List[Reference],reference_count:ReferenceCount,timestamp:datetime.datetime = Timestamps.UTCTimestamp()) -> None:
+		self.setCitRefs([((source_id,_id),references,False)],timestamp)
+	
+	def getRawCachedMappingsBulk_TL(self,qual_list:Iterator[QualifiedId]) -> Dict[QualifiedId,Tuple[datetime.datetime,Mapping]]:
+		"""
+			Bulk version of getRawCachedMappings_TL, answered with
+			a constant number of SQL statements.
+			This method does not invalidate the cache
+		"""
+		retval = {}
+		pending = self._pendingOverlay(self.WRITE_MAPPINGS)
+		if pending is not None:
+			qual_list = list(map(tuple,qual_list))
+			for qual_id in qual_list:
+				pending_entry = pending.get(qual_id)
+				if pending_entry is not None:
+					retval[qual_id] = (pending_entry[1], _json_copy(pending_entry[2]))
+			qual_list = [ qual_id  for qual_id in qual_list  if qual_id not in retval ]
+		
+		qual_list = self._lruLookup(('pub',),qual_list,retval)
+		if not qual_list:
+			return retval
+		
+		cur = self.conn.cursor()
+		self._loadBulkQual_TL(cur,qual_list)
+		for schema, _ in self._readSchemas():
+			for res in cur.execute("""
+SELECT p.source, p.id, p.last_fetched, p.payload
+FROM temp.bulk_qual q CROSS JOIN {}.pub p
+WHERE
+p.enricher = :enricher
+AND
+p.id = q.id
+AND
+p.source = q.source
+""".format(schema),{'enricher': self.enricher_name}).fetchall():
+				mapping_timestamp = Timestamps.UTCTimestamp(res[2])
+				retval[(res[0],res[1])] = (mapping_timestamp, self._lruDecode(('pub',res[0],res[1]),mapping_timestamp,res[3]))
+		
+		return retval
+	
+	def getCachedMappingsBulk(self,qual_list:Iterator[QualifiedId]) -> Dict[QualifiedId,Mapping]:
+		"""
+			Bulk version of getCachedMapping. Missing or expired
+			mappings are not included in the returned dictionary
+		"""
+		qual_list = set(map(tuple,qual_list))
+		with self._lock, self.conn:
+			raw_mappings = self.getRawCachedMappingsBulk_TL(qual_list)
+		
+		now = Timestamps.UTCTimestamp(datetime.datetime.utcnow())
+		self.stats.countTimestamps('mapping',len(qual_list),(mapping_timestamp  for mapping_timestamp, _ in raw_mappings.values()),self.ttl['mapping'],now)
+		return { qual_id: mapping  for qual_id, (mapping_timestamp, mapping) in raw_mappings.items()  if self._isServable('mapping',mapping_timestamp,now,qual_id) }
+	
+	def getRawCachedMappings_TL(self,qual_list:Iterator[QualifiedId]) -> Iterator[Tuple[datetime.datetime,Mapping]]:
+		"""
+			This method does not invalidate the cache
+		"""
+		
+		qual_list = list(qual_list)
+		mappings_hash = self.getRawCachedMappingsBulk_TL(qual_list)
+		for qual_id in qual_list:
+			yield mappings_hash.get(tuple(qual_id),(None, None))
+	
+	def getRawCachedMappings(self,qual_list:Iterator[QualifiedId]) -> Iterator[Tuple[datetime.datetime,Mapping]]:
+		"""
+			This method does not invalidate the cache
+		"""
+		
+		with self._lock, self.conn:
+			raw_mappings = list(self.getRawCachedMappings_TL(qual_list))
+		
+		for mapping_timestamp, mapping in raw_mappings:
+			yield mapping_timestamp, mapping
+	
+	def getRawCachedMapping_TL(self,source_id:SourceId,_id:UnqualifiedId) -> Tuple[datetime.datetime,Mapping]:
+		for mapping_timestamp, mapping in self.getRawCachedMappings_TL([(source_id,_id)]):
+			return mapping_timestamp, mapping
+	
+	def getRawCachedMapping(self,source_id:SourceId,_id:UnqualifiedId) -> Tuple[datetime.datetime,Mapping]:
+		for mapping_timestamp, mapping in self.getRawCachedMappings([(source_id,_id)]):
+			return mapping_timestamp, mapping
+	
+	def getCachedMapping(self,source_id:SourceId,_id:UnqualifiedId) -> Mapping:
+		mapping_timestamp , mapping = self.getRawCachedMapping(source_id,_id)
+		now = Timestamps.UTCTimestamp(datetime.datetime.utcnow())
+		self.stats.countTimestamps('mapping',1,[mapping_timestamp]  if mapping_timestamp is not None  else [],self.ttl['mapping'],now)
+		
+		# Invalidate cache
+		if mapping_timestamp is not None and not self._isServable('mapping',mapping_timestamp,now,(source_id,_id)):
+			mapping = None
+		
+		return mapping
+	
+	def getRawSourceIdsBulk_TL(self,publish_id_iter:Iterator[PublishId]) -> Dict[PublishId,List[Tuple[datetime.datetime,QualifiedId]]]:
+		"""
+			Bulk version of getRawSourceIds_TL, using chunked IN lists.
+			This method does not invalidate the cache
+		"""
+		cur = self.conn.cursor()
+		retval = {}
+		publish_id_set = set(publish_id_iter)
+		# Pending mappings supersede their stored source ids
+		pending_ids, pending_source_ids = self._pendingSourceIds(self._mappingPublishIds)
+		for publish_ids in _chunks(list(publish_id_set)):
+			for schema, shadow_cond in self._readSchemas('idmap'):
+				for res in cur.execute("""
+SELECT pub_id, last_fetched, source, id
+FROM {}.idmap
+WHERE
+enricher = ?
+AND
+pub_id IN ({}){}
+""".format(schema,','.join('?' * len(publish_ids)),shadow_cond),[self.enricher_name,*publish_ids]).fetchall():
+					if (res[2],res[3]) not in pending_ids:
+						retval.setdefault(res[0],[]).append((Timestamps.UTCTimestamp(res[1]),(res[2],res[3])))
+		
+		for publish_id in publish_id_set & pending_source_ids.keys():
+			retval.setdefault(publish_id,[]).extend((mapping_timestamp,qual_id)  for mapping_timestamp, qual_id, _ in pending_source_ids[publish_id])
+		
+		return retval
+	
+	def getRawSourceIds_TL(self,publish_id_iter:Iterator[PublishId]) -> Iterator[List[Tuple[datetime.datetime,QualifiedId]]]:
+		"""
+			This method does not invalidate the cache
+		"""
+		publish_id_list = list(publish_id_iter)
+		source_ids_hash = self.getRawSourceIdsBulk_TL(publish_id_list)
+		for publish_id in publish_id_list:
+			yield source_ids_hash.get(publish_id,[])
+	
+	def getRawCachedMappingsFromPublishIdsBulk_TL(self,publish_id_iter:Iterator[PublishId]) -> Dict[PublishId,List[Tuple[datetime.datetime,QualifiedId,datetime.datetime,Mapping]]]:
+		"""
+			It resolves the publish ids to their mappings, joining idmap
+			and pub in the same statement. Source ids whose mapping is not
+			cached get None as mapping timestamp and mapping.
+			This method does not invalidate the cache
+		"""
+		cur = self.conn.cursor()
+		retval = {}
+		publish_id_set = set(publish_id_iter)
+		# Pending mappings supersede their stored source ids
+		pending_ids, pending_source_ids = self._pendingSourceIds(self._mappingPublishIds)
+		for publish_ids in _chunks(list(publish_id_set)):
+			for schema, shadow_cond in self._readSchemas('i'):
+				for res in cur.execute("""
+SELECT i.pub_id, i.last_fetched, i.source, i.id, p.last_fetched, p.payload
+FROM {0}.idmap i LEFT JOIN {0}.pub p
+ON
+p.enricher = i.enricher
+AND
+p.id = i.id
+AND
+p.source = i.source
+WHERE
+i.enricher = ?
+AND
+i.pub_id IN ({1}){2}
+""".format(schema,','.join('?' * len(publish_ids)),shadow_cond),[self.enricher_name,*publish_ids]).fetchall():
+					if (res[2],res[3]) in pending_ids:
+						continue
+					if res[5] is not None:
+						mapping_timestamp = Timestamps.UTCTimestamp(res[4])
+						entry = self.lru.get(('pub',res[2],res[3]))  if self.lru is not None  else None
+						if entry is not None and entry[0] == mapping_timestamp:
+							mapping = entry[1]
+						else:
+							mapping = self._lruDecode(('pub',res[2],res[3]),mapping_timestamp,res[5])
+					else:
+						mapping_timestamp = None
+						mapping = None
+					retval.setdefault(res[0],[]).append((Timestamps.UTCTimestamp(res[1]),(res[2],res[3]),mapping_timestamp,mapping))
+		
+		for publish_id in publish_id_set & pending_source_ids.keys():
+			retval.setdefault(publish_id,[]).extend((mapping_timestamp,qual_id,mapping_timestamp,_json_copy(mapping))  for mapping_timestamp, qual_id, mapping in pending_source_ids[publish_id])
+		
+		return retval
+	
+	def getCachedMappingsFromPublishIdsBulk(self,publish_id_iter:Iterator[PublishId]) -> Dict[PublishId,List[Tuple[QualifiedId,Mapping]]]:
+		"""
+			For each publish id with non-expired source ids, it returns
+			the list of source ids along with their mappings. The mapping
+			is None when it is not cached or it has expired
+		"""
+		publish_id_set = set(publish_id_iter)
+		with self._lock, self.conn:
+			raw_mappings = self.getRawCachedMappingsFromPublishIdsBulk_TL(publish_id_set)
+		
+		now = Timestamps.UTCTimestamp(datetime.datetime.utcnow())
+		retval = {}
+		expired_ids = 0
+		mapping_timestamps = []
+		for publish_id, raw_list in raw_mappings.items():
+			for timestamp_internal_id, internal_id, mapping_timestamp, mapping in raw_list:
+				# Invalidate cache
+				if self._isServable('idmap',timestamp_internal_id,now,publish_id):
+					if mapping_timestamp is not None:
+						mapping_timestamps.append(mapping_timestamp)
+					if mapping_timestamp is None or not self._isServable('mapping',mapping_timestamp,now,internal_id):
+						mapping = None
+					retval.setdefault(publish_id,[]).append((internal_id,mapping))
+			
+			if publish_id not in retval:
+				expired_ids += 1
+		
+		self.stats.count('idmap',len(retval),expired_ids,len(publish_id_set) - len(raw_mappings))
+		self.stats.countTimestamps('mapping',sum(map(len,retval.values())),mapping_timestamps,self.ttl['mapping'],now)
+		
+		return retval
+	
+	def getRawSourceIds(self,publish_id:PublishId) -> List[Tuple[datetime.datetime,QualifiedId]]:
+		"""
+			This method does not invalidate the cache
+		"""
+		with self._lock, self.conn:
+			for listRes in self.getRawSourceIds_TL([publish_id]):
+				return listRes
+	
+	def getSourceIds(self,publish_id:PublishId) -> List[QualifiedId]:
+		internal_ids = []
+		
+		# Invalidate cache
+		raw_internal_ids = self.getRawSourceIds(publish_id)
+		now = Timestamps.UTCTimestamp(datetime.datetime.utcnow())
+		for timestamp_internal_id , internal_id in raw_internal_ids:
+			if timestamp_internal_id is not None and self._isServable('idmap',timestamp_internal_id,now,publish_id):
+				internal_ids.append(internal_id)
+		
+		self._countIds(raw_internal_ids,internal_ids)
+		return internal_ids
+	
+	def _countIds(self,raw_ids:List[Tuple[datetime.datetime,QualifiedId]],ids:List[QualifiedId]) -> None:
+		if ids:
+			self.stats.count('idmap',hits=1)
+		elif raw_ids:
+			self.stats.count('idmap',expired=1)
+		else:
+			self.stats.count('idmap',misses=1)
+	
+	def appendSourceIdsBulk_TL(self,source_ids_iter:Iterator[Tuple[PublishId,QualifiedId]],timestamp:datetime.datetime = Timestamps.UTCTimestamp()) -> None:
+		"""
+			It stores (or refreshes) the correspondences in a single batch
+		"""
+		params_list = [
+			{
+				'enricher': self.enricher_name,
+				'pub_id': publish_id,
+				'source': qual_id[0],
+				'id': qual_id[1],
+				'last_fetched': timestamp
+			}
+			for publish_id, qual_id in source_ids_iter
+		]
+		
+		cur = self.conn.cursor()
+		
+		# In case of stale cache, remove all
+		oldest = self._ttlModifier('idmap')
+		cur.executemany("""
+DELETE FROM idmap
+WHERE enricher = :enricher
+AND id = :id
+AND source = :source
+AND DATETIME('NOW',:oldest) > last_fetched
+""",[ {'enricher': self.enricher_name,'source': source_id,'id': _id,'oldest': oldest}  for source_id, _id in set((params['source'],params['id'])  for params in params_list) ])
+		
+		# Now, try storing specifically these
+		cur.executemany("""
+INSERT INTO idmap(pub_id,enricher,id,source,last_fetched) VALUES(:pub_id,:enricher,:id,:source,:last_fetched)
+ON CONFLICT(pub_id,id,enricher,source) DO UPDATE SET
+last_fetched = excluded.last_fetched
+""",params_list)
+	
+	def appendSourceIds_TL(self,publish_id_iter:Iterator[PublishId],source_id:SourceId,_id:UnqualifiedId,timestamp:datetime.datetime = Timestamps.UTCTimestamp()) -> None:
+		self.appendSourceIdsBulk_TL(map(lambda publish_id: (publish_id,(source_id,_id)), publish_id_iter),timestamp)
+	
+	def removeSourceIdsBulk_TL(self,source_ids_iter:Iterator[Tuple[PublishId,QualifiedId]]) -> None:
+		"""
+			It removes the correspondences in a single batch
+		"""
+		params_list = [
+			{
+				'enricher': self.enricher_name,
+				'pub_id': publish_id,
+				'source': qual_id[0],
+				'id': qual_id[1]
+			}
+			for publish_id, qual_id in source_ids_iter
+		]
+		
+		cur = self.conn.cursor()
+		
+		# In case of stale cache, remove all
+		oldest = self._ttlModifier('idmap')
+		cur.executemany("""
+DELETE FROM idmap
+WHERE enricher = :enricher
+AND id = :id
+AND source = :source
+AND DATETIME('NOW',:oldest) > last_fetched
+""",[ {'enricher': self.enricher_name,'source': source_id,'id': _id,'oldest': oldest}  for source_id, _id in set((params['source'],params['id'])  for params in params_list) ])
+		
+		# Now, try removing specifically these
+		cur.executemany("""
+DELETE FROM idmap
+WHERE enricher = :enricher
+AND id = :id
+AND source = :source
+AND pub_id = :pub_id
+""",params_list)
+	
+	def removeSourceIds_TL(self,publish_id_iter:Iterator[PublishId],source_id:SourceId,_id:UnqualifiedId) -> None:
+		self.removeSourceIdsBulk_TL(map(lambda publish_id: (publish_id,(source_id,_id)), publish_id_iter))
+	
+	def getRawNegativeIdsBulk_TL(self,publish_id_iter:Iterator[PublishId]) -> Dict[PublishId,datetime.datetime]:
+		"""
+			It returns when each one of the publish ids was last found
+			unresolvable, using chunked IN lists.
+			This method does not invalidate the cache
+		"""
+		cur = self.conn.cursor()
+		retval = {}
+		publish_id_set = set(publish_id_iter)
+		for publish_ids in _chunks(list(publish_id_set)):
+			for schema, _ in self._readSchemas():
+				for res in cur.execute("""
+SELECT pub_id, last_fetched
+FROM {}.negative_id
+WHERE
+enricher = ?
+AND
+pub_id IN ({})
+""".format(schema,','.join('?' * len(publish_ids))),[self.enricher_name,*publish_ids]).fetchall():
+					retval[res[0]] = Timestamps.UTCTimestamp(res[1])
+		
+		pending = self._pendingOverlay(self.WRITE_NEGATIVES)
+		if pending is not None:
+			for publish_id in publish_id_set & pending.keys():
+				retval[publish_id] = pending[publish_id][1]
+		
+		# Pending mappings make them resolvable
+		_, pending_source_ids = self._pendingSourceIds(self._mappingPublishIds)
+		for publish_id in pending_source_ids.keys():
+			retval.pop(publish_id,None)
+		
+		return retval
+	
+	def getNegativeIdsBulk(self,publish_id_iter:Iterator[PublishId]) -> Set[PublishId]:
+		"""
+			The publish ids which are known to be unresolvable,
+			and whose negative result has not expired
+		"""
+		publish_id_set = set(publish_id_iter)
+		with self._lock, self.conn:
+			raw_negatives = self.getRawNegativeIdsBulk_TL(publish_id_set)
+		
+		now = Timestamps.UTCTimestamp(datetime.datetime.utcnow())
+		self.stats.countTimestamps('negative',len(publish_id_set),raw_negatives.values(),self.ttl['negative'],now)
+		return { publish_id  for publish_id, negative_timestamp in raw_negatives.items()  if self._isServable('negative',negative_timestamp,now,publish_id) }
+	
+	def _setNegativeIds_TL(self,publish_ids:Iterator[PublishId],timestamp:datetime.datetime) -> None:
+		cur = self.conn.cursor()
+		cur.executemany("""
+INSERT INTO negative_id(enricher,pub_id,last_fetched) VALUES(:enricher,:pub_id,:last_fetched)
+ON CONFLICT(enricher,pub_id) DO UPDATE SET
+last_fetched = excluded.last_fetched
+""",[
+			{
+				'enricher': self.enricher_name,
+				'pub_id': publish_id,
+				'last_fetched': timestamp
+			}
+			for publish_id in publish_ids
+		])
+	
+	def setNegativeIds(self,publish_id_iter:Iterator[PublishId],timestamp:datetime.datetime = Timestamps.UTCTimestamp()) -> None:
+		"""
+			It records (or refreshes) the publish ids which
+			could not be resolved, in a single batch
+		"""
+		publish_ids = list(set(publish_id_iter))
+		if not publish_ids:
+			return
+		
+		if self._write_queue is not None:
+			self._enqueueWrite(self.WRITE_NEGATIVES,publish_ids,timestamp)
+		else:
+			with self._lock, self.conn:
+				self._setNegativeIds_TL(publish_ids,timestamp)
+	
+	def removeNegativeIdsBulk_TL(self,publish_id_iter:Iterator[PublishId]) -> None:
+		"""
+			It forgets the negative results of the publish ids
+		"""
+		cur = self.conn.cursor()
+		cur.executemany("""
+DELETE FROM negative_id
+WHERE enricher = :enricher
+AND pub_id = :pub_id
+""",[ {'enricher': self.enricher_name,'pub_id': publish_id}  for publish_id in set(publish_id_iter) ])
+	
+	def getRawCachedMappingsFromPartials(self,partial_mappings:List[Mapping]) -> List[List[Mapping]]:
+		"""
+			Bulk version of getRawCachedMappingsFromPartial. It returns,
+			for each partial mapping, the list of cached mappings, using
+			a constant number of SQL statements for the whole list.
+			
+			This method does not invalidate caches
+		"""
+		retval = [ [] for _ in partial_mappings ]
+		mapping_ids_list = [ set() for _ in partial_mappings ]
+		with self._lock, self.conn:
+			# First attempt, using the id
+			qual_ids = [ (partial_mapping.get('source'),partial_mapping.get('id'))  for partial_mapping in partial_mappings  if partial_mapping.get('id') ]
+			raw_mappings = self.getRawCachedMappingsBulk_TL(qual_ids)  if qual_ids  else {}
+			
+			left = []
+			for iPartial, partial_mapping in enumerate(partial_mappings):
+				if partial_mapping.get('id'):
+					_ , mapping = raw_mappings.get((partial_mapping.get('source'),partial_mapping.get('id')),(None, None))
+					if mapping:
+						retval[iPartial].append(mapping)
+						continue
+				left.append(iPartial)
+			
+			# Now, trying with the identifiers of the mapped publications (if it is the case)
+			lower_ids = [ (base_pub.get('enricher'),base_pub.get('source'),base_pub.get('id'))  for iPartial in left  for base_pub in partial_mappings[iPartial].get('base_pubs',[]) ]
+			if lower_ids:
+				meta_ids_hash = self.getRawMetaSourceIdsBulk_TL(lower_ids)
+				for iPartial in left:
+					for base_pub in partial_mappings[iPartial].get('base_pubs',[]):
+						for internal_id in meta_ids_hash.get((base_pub.get('enricher'),base_pub.get('source'),base_pub.get('id')),[]):
+							mapping_ids_list[iPartial].add(internal_id[1])
+			
+			# Then, through the publish ids known by the lower caches
+			lower_ids = [ (base_pub.get('enricher'),base_pub.get('source'),base_pub.get('id'))  for iPartial in left  if not mapping_ids_list[iPartial]  for base_pub in partial_mappings[iPartial].get('base_pubs',[]) ]
+			if lower_ids and self.lower_schemas:
+				lower_source_ids_hash = self.getRawLowerSourceIdsBulk_TL(lower_ids)
+				for iPartial in left:
+					if not mapping_ids_list[iPartial]:
+						for base_pub in partial_mappings[iPartial].get('base_pubs',[]):
+							mapping_ids_list[iPartial].update(lower_source_ids_hash.get((base_pub.get('enricher'),base_pub.get('source'),base_pub.get('id')),[]))
+			
+			# Last resort
+			publish_ids = [ partial_mappings[iPartial].get(field_name)  for iPartial in left  for field_name in ('pmid','pmcid','doi')  if partial_mappings[iPartial].get(field_name) ]
+			if publish_ids:
+				source_ids_hash = self.getRawSourceIdsBulk_TL(publish_ids)
+				for iPartial in left:
+					for field_name in ('pmid','pmcid','doi'):
+						_theId = partial_mappings[iPartial].get(field_name)
+						if _theId:
+							for internal_id in source_ids_hash.get(_theId,[]):
+								mapping_ids_list[iPartial].add(internal_id[1])
+			
+			# Trying to avoid duplicates
+			all_mapping_ids = set().union(*mapping_ids_list)
+			if all_mapping_ids:
+				raw_mappings = self.getRawCachedMappingsBulk_TL(all_mapping_ids)
+				for iPartial in left:
+					for mapping_id in mapping_ids_list[iPartial]:
+						_ , mapping = raw_mappings.get(mapping_id,(None, None))
+						if mapping is not None:
+							retval[iPartial].append(mapping)
+		
+		# These lookups do not expire
+		num_found = sum(1  for mappings in retval  if mappings)
+		self.stats.count('mapping',hits=num_found,misses=len(partial_mappings) - num_found)
+		
+		return retval
+	
+	def getRawCachedMappingsFromPartial(self,partial_mapping:Mapping) -> List[Mapping]:
+		"""
+			This method returns one or more cached mappings, based on the partial
+			mapping provided. First attempt is using the id, then it tries through
+			base_pubs information. Last, it derives	on the pmid, pmcid and doi to
+			rescue, if available.
+			
+			This method does not invalidate caches
+		"""
+		return self.getRawCachedMappingsFromPartials([partial_mapping])[0]
+	
+	def getRawMetaSourceIdsBulk_TL(self,lower_iter:Iterator[MetaQualifiedId]) -> Dict[MetaQualifiedId,List[Tuple[datetime.datetime,QualifiedId]]]:
+		"""
+			Bulk version of getRawMetaSourceIds_TL.
+			This method does not invalidate caches
+		"""
+		lower_list = list(map(tuple,lower_iter))
+		cur = self.conn.cursor()
+		cur.execute("""DELETE FROM temp.bulk_lower""")
+		cur.executemany("""
+INSERT OR IGNORE INTO temp.bulk_lower(lower_enricher,lower_source,lower_id) VALUES(?,?,?)
+""",lower_list)
+		retval = {}
+		# Pending mappings supersede their stored lower ids
+		pending_ids, pending_lowers = self._pendingSourceIds(self._mappingLowerIds)
+		for schema, shadow_cond in self._readSchemas('l'):
+			for res in cur.execute("""
+SELECT l.lower_enricher, l.lower_source, l.lower_id, l.last_fetched, l.source, l.id
+FROM temp.bulk_lower q CROSS JOIN {}.lower_map l
+WHERE
+l.enricher = :enricher
+AND
+l.lower_enricher = q.lower_enricher
+AND
+l.lower_source = q.lower_source
+AND
+l.lower_id = q.lower_id{}
+""".format(schema,shadow_cond),{'enricher': self.enricher_name}).fetchall():
+				if (res[4],res[5]) not in pending_ids:
+					retval.setdefault((res[0],res[1],res[2]),[]).append((Timestamps.UTCTimestamp(res[3]),(res[4],res[5])))
+		
+		for lower in set(lower_list) & pending_lowers.keys():
+			retval.setdefault(lower,[]).extend((mapping_timestamp,qual_id)  for mapping_timestamp, qual_id, _ in pending_lowers[lower])
+		
+		return retval
+	
+	def getRawLowerSourceIdsBulk_TL(self,lower_iter:Iterator[MetaQualifiedId]) -> Dict[MetaQualifiedId,Set[QualifiedId]]:
+		"""
+			It resolves the publications of the lower enrichers joining
+			the publish ids from their attached caches with the
+			correspondences of this cache.
+			This method does not invalidate caches
+		"""
+		lower_list = [ lower  for lower in map(tuple,lower_iter)  if lower[0] in self.lower_schemas ]
+		retval = {}
+		if not lower_list:
+			return retval
+		
+		cur = self.conn.cursor()
+		cur.execute("""DELETE FROM temp.bulk_lower""")
+		cur.executemany("""
+INSERT OR IGNORE INTO temp.bulk_lower(lower_enricher,lower_source,lower_id) VALUES(?,?,?)
+""",lower_list)
+		# Pending mappings supersede their stored correspondences
+		pending_ids, _ = self._pendingSourceIds(self._mappingPublishIds)
+		for lower_enricher, lower_schema in self.lower_schemas.items():
+			for schema, shadow_cond in self._readSchemas('i'):
+				for res in cur.execute("""
+SELECT DISTINCT q.lower_source, q.lower_id, i.source, i.id
+FROM temp.bulk_lower q CROSS JOIN {0}.idmap li CROSS JOIN {1}.idmap i
+WHERE
+q.lower_enricher = :lower_enricher
+AND
+li.enricher = :lower_enricher
+AND
+li.id = q.lower_id
+AND
+li.source = q.lower_source
+AND
+i.enricher = :enricher
+AND
+i.pub_id = li.pub_id{2}
+""".format(lower_schema,schema,shadow_cond),{'enricher': self.enricher_name,'lower_enricher': lower_enricher}).fetchall():
+					if (res[2],res[3]) not in pending_ids:
+						retval.setdefault((lower_enricher,res[0],res[1]),set()).add((res[2],res[3]))
+		
+		return retval
+	
+	def getRawMetaSourceIds_TL(self,lower_iter:Iterator[MetaQualifiedId]) -> Iterator[List[Tuple[datetime.datetime,QualifiedId]]]:
+		"""
+			This method does not invalidate caches
+		"""
+		lower_list = list(lower_iter)
+		meta_ids_hash = self.getRawMetaSourceIdsBulk_TL(lower_list)
+		for lower in lower_list:
+			yield meta_ids_hash.get(tuple(lower),[])
+	
+	def getRawMetaSourceIds(self,lower:MetaQualifiedId) -> List[Tuple[datetime.datetime,QualifiedId]]:
+		"""
+			This method does not invalidate caches
+		"""
+		with self._lock, self.conn:
+			for retval in self.getRawMetaSourceIds_TL([lower]):
+				return retval
+	
+	def getMetaSourceIds(self,lower:MetaQualifiedId) -> List[QualifiedId]:
+		meta_ids = []
+		raw_meta_ids = self.getRawMetaSourceIds(lower)
+		for timestamp_meta_id , meta_id in raw_meta_ids:
+			# Invalidate cache
+			if timestamp_meta_id is not None and (Timestamps.UTCTimestamp(datetime.datetime.utcnow()) - timestamp_meta_id) <= self.ttl['idmap']:
+				meta_ids.append(meta_id)
+		
+		self._countIds(raw_meta_ids,meta_ids)
+		return meta_ids
+	
+	def appendMetaSourceIdsBulk_TL(self,lower_ids_iter:Iterator[Tuple[MetaQualifiedId,QualifiedId]],timestamp:datetime.datetime = Timestamps.UTCTimestamp()) -> None:
+		"""
+			It stores (or refreshes) the lower mappings in a single batch
+		"""
+		params_list = [
+			{
+				'enricher': self.enricher_name,
+				'lower_enricher': lower_enricher,
+				'lower_source': lower_source,
+				'lower_id': lower_id,
+				'source': qual_id[0],
+				'id': qual_id[1],
+				'last_fetched': timestamp
+			}
+			for (lower_enricher, lower_source, lower_id), qual_id in lower_ids_iter
+		]
+		
+		cur = self.conn.cursor()
+		
+		# In case of stale cache, remove all
+		oldest = self._ttlModifier('idmap')
+		cur.executemany("""
+DELETE FROM lower_map
+WHERE enricher = :enricher
+AND id = :id
+AND source = :source
+AND DATETIME('NOW',:oldest) > last_fetched
+""",[ {'enricher': self.enricher_name,'source': source_id,'id': _id,'oldest': oldest}  for source_id, _id in set((params['source'],params['id'])  for params in params_list) ])
+		
+		# Now, try storing specifically these
+		cur.executemany("""
+INSERT INTO lower_map(enricher,id,source,lower_enricher,lower_id,lower_source,last_fetched) VALUES(:enricher,:id,:source,:lower_enricher,:lower_id,:lower_source,:last_fetched)
+ON CONFLICT(enricher,id,source,lower_enricher,lower_id,lower_source) DO UPDATE SET
+last_fetched = excluded.last_fetched
+""",params_list)
+	
+	def appendMetaSourceIds_TL(self,lower_iter:Iterator[MetaQualifiedId],source_id:SourceId,_id:UnqualifiedId,timestamp:datetime.datetime = Timestamps.UTCTimestamp()) -> None:
+		self.appendMetaSourceIdsBulk_TL(map(lambda lower: (lower,(source_id,_id)), lower_iter),timestamp)
+	
+	def removeMetaSourceIdsBulk_TL(self,lower_ids_iter:Iterator[Tuple[MetaQualifiedId,QualifiedId]]) -> None:
+		"""
+			It removes the lower mappings in a single batch
+		"""
+		params_list = [
+			{
+				'enricher': self.enricher_name,
+				'lower_enricher': lower_enricher,
+				'lower_source': lower_source,
+				'lower_id': lower_id,
+				'source': qual_id[0],
+				'id': qual_id[1]
+			}
+			for (lower_enricher, lower_source, lower_id), qual_id in lower_ids_iter
+		]
+		
+		cur = self.conn.cursor()
+		
+		# In case of stale cache, remove all
+		oldest = self._ttlModifier('idmap')
+		cur.executemany("""
+DELETE FROM lower_map
+WHERE enricher = :enricher
+AND id = :id
+AND source = :source
+AND DATETIME('NOW',:oldest) > last_fetched
+""",[ {'enricher': self.enricher_name,'source': source_id,'id': _id,'oldest': oldest}  for source_id, _id in set((params['source'],params['id'])  for params in params_list) ])
+		
+		# Now, try removing specifically these
+		cur.executemany("""
+DELETE FROM lower_map
+WHERE enricher = :enricher
+AND id = :id
+AND source = :source
+AND lower_enricher = :lower_enricher
+AND lower_id = :lower_id
+AND lower_source = :lower_source
+""",params_list)
+	
+	def removeMetaSourceIds_TL(self,lower_iter:Iterator[MetaQualifiedId],source_id:SourceId,_id:UnqualifiedId) -> None:
+		self.removeMetaSourceIdsBulk_TL(map(lambda lower: (lower,(source_id,_id)), lower_iter))
+	
+	def setCachedMappings(self,mapping_iter:Iterator[Mapping],mapping_timestamp:datetime.datetime = Timestamps.UTCTimestamp()) -> None:
+		# Only the last version of each mapping in the batch is kept
+		mappings_hash = {}
+		for mapping in mapping_iter:
+			mappings_hash[(mapping['source'],mapping['id'])] = mapping
+		
+		if not mappings_hash:
+			return
+		
+		if self._write_queue is not None:
+			self._enqueueWrite(self.WRITE_MAPPINGS,list(mappings_hash.values()),mapping_timestamp)
+		else:
+			# Only one transaction for the whole batch
+			with self._lock, self.conn:
+				self._setCachedMappings_TL(mappings_hash,mapping_timestamp)
+	
+	def _setCachedMappings_TL(self,mappings_hash:Dict[QualifiedId,Mapping],mapping_timestamp:datetime.datetime) -> None:
+		# Before anything, get the previous mappings before updating them
+		old_mappings_hash = self.getRawCachedMappingsBulk_TL(mappings_hash.keys())
+		
+		cur = self.conn.cursor()
+		cur.executemany("""
+INSERT INTO pub(enricher,id,source,payload,last_fetched) VALUES(:enricher,:id,:source,:payload,:last_fetched)
+ON CONFLICT(enricher,id,source) DO UPDATE SET
+payload = excluded.payload,
+last_fetched = excluded.last_fetched
+""",[
+			{
+				'enricher': mapping.get('enricher',self.enricher_name),
+				'source': mapping['source'],
+				'id': mapping['id'],
+				'payload': self.codec.encode(mapping),
+				'last_fetched': mapping_timestamp
+			}
+			for mapping in mappings_hash.values()
+		])
+		
+		removable_ids = []
+		appendable_ids = []
+		removable_lowers = []
+		appendable_lowers = []
+		for qual_id, mapping in mappings_hash.items():
+			old_mapping_timestamp , old_mapping = old_mappings_hash.get(qual_id,(None, None))
+			
+			# Then, cleanup of sourceIds cache
+			pubmed_id = mapping.get('pmid')
+			pmc_id = mapping.get('pmcid')
+			pmc_id_norm = pub_common.normalize_pmcid(pmc_id)  if pmc_id else None
+			doi_id = mapping.get('doi')
+			doi_id_norm = self.doi_checker.normalize_doi(doi_id)  if doi_id else None
+			
+			if old_mapping_timestamp is not None:
+				old_pubmed_id = old_mapping.get('pmid')
+				old_doi_id = old_mapping.get('doi')
+				old_pmc_id = old_mapping.get('pmcid')
+			else:
+				old_pubmed_id = None
+				old_doi_id = None
+				old_pmc_id = None
+			old_doi_id_norm = self.doi_checker.normalize_doi(old_doi_id)  if old_doi_id else None
+			old_pmc_id_norm = pub_common.normalize_pmcid(old_pmc_id)  if old_pmc_id else None
+			
+			for old_id, new_id in [(old_pubmed_id,pubmed_id),(old_doi_id_norm,doi_id_norm),(old_pmc_id_norm,pmc_id_norm)]:
+				# Code needed for mismatches
+				if old_id is not None and old_id != new_id:
+					removable_ids.append((old_id,qual_id))
+				
+				# The upsert also refreshes the unchanged ones
+				if new_id is not None:
+					appendable_ids.append((new_id,qual_id))
+			
+			# Let's manage also the lower mappings, from base_pubs
+			
+			# Creating the sets
+			oldLowerSet = set()
+			if old_mapping:
+				old_base_pubs = old_mapping.get('base_pubs',[])
+				for old_lower in old_base_pubs:
+					if old_lower.get('id'):
+						oldLowerSet.add((old_lower['enricher'],old_lower['source'],old_lower['id']))
+			
+			newLowerSet = set()
+			new_base_pubs = mapping.get('base_pubs',[])
+			for new_lower in new_base_pubs:
+				if new_lower.get('id'):
+					newLowerSet.add((new_lower['enricher'],new_lower['source'],new_lower['id']))
+			
+			# This set has the entries to be removed
+			removable_lowers.extend(map(lambda lower: (lower,qual_id), oldLowerSet - newLowerSet))
+			
+			# This set has the entries to be added (or refreshed)
+			appendable_lowers.extend(map(lambda lower: (lower,qual_id), newLowerSet))
+		
+		if removable_ids:
+			self.removeSourceIdsBulk_TL(removable_ids)
+		if appendable_ids:
+			self.appendSourceIdsBulk_TL(appendable_ids,timestamp=mapping_timestamp)
+			# These ones are resolvable now
+			self.removeNegativeIdsBulk_TL(publish_id  for publish_id, _ in appendable_ids)
+		if removable_lowers:
+			self.removeMetaSourceIdsBulk_TL(removable_lowers)
+		if appendable_lowers:
+			self.appendMetaSourceIdsBulk_TL(appendable_lowers,mapping_timestamp)
+		
+		# The years are also looked up on their own
+		self._setYears_TL(((qual_id, mapping['year'])  for qual_id, mapping in mappings_hash.items()  if isinstance(mapping.get('year'),int)),mapping_timestamp)
+	
+		# Keeping the decoded payloads coherent
+		if self.lru is not None:
+			for qual_id in mappings_hash.keys():
+				self.lru.discard(('pub',)+qual_id)
+	
+	def setCachedMapping(self,mapping:Mapping,mapping_timestamp:datetime.datetime = Timestamps.UTCTimestamp()) -> None:
+		self.setCachedMappings([mapping],mapping_timestamp)
@@ -1,6 +1,8 @@
 #!/usr/bin/python
 
+import contextlib
 import datetime, time
+import sqlite3
 from urllib import parse
 
 class Timestamps(object):
@@ -90,3 +92,337 @@ def deprecated(func):
         warnings.simplefilter('default', DeprecationWarning)  # reset filter
         return func(*args, **kwargs)
     return new_func
+
+
+# Rows visited on each committed batch of the long maintenance operations
+DEFAULT_BATCH_SIZE = 50000
+
+def delete_in_batches(conn,table_name:str,condition:str,params:dict=None,batch_size:int=DEFAULT_BATCH_SIZE,label:str=None,lock=None) -> int:
+	"""
+		It deletes the rows of the table fulfilling the condition,
+		walking it through rowid ranges (primary key ranges on
+		WITHOUT ROWID tables). Each batch is committed on
+		its own, so huge tables are not locked for a long time, and
+		an interrupted run is resumed by the next one. When the
+		connection is shared, the lock is held around each batch.
+		It returns the number of deleted rows
+	"""
+	if lock is None:
+		lock = contextlib.nullcontext()
+	
+	with lock:
+		pk_columns = without_rowid_key(conn,table_name)
+	if pk_columns is not None:
+		return _delete_in_key_batches(conn,table_name,pk_columns,condition,params,batch_size,label,lock)
+	
+	with lock:
+		res = conn.execute("""SELECT MIN(rowid), MAX(rowid) FROM {}""".format(table_name)).fetchone()
+	if res[0] is None:
+		return 0
+	
+	min_rowid, max_rowid = res
+	batch_params = dict(params)  if params  else {}
+	deleted = 0
+	for low_rowid in range(min_rowid - 1, max_rowid, batch_size):
+		batch_params['low_rowid'] = low_rowid
+		batch_params['high_rowid'] = low_rowid + batch_size
+		with lock, conn:
+			cur = conn.execute("""
+DELETE FROM {}
+WHERE
+rowid > :low_rowid
+AND
+rowid <= :high_rowid
+AND
+({})
+""".format(table_name,condition),batch_params)
+			deleted += cur.rowcount
+		
+		if label is not None:
+			print("\t{}: {} rows deleted ({:.0%})".format(label,deleted,(min(max_rowid,low_rowid + batch_size) - min_rowid + 1) / (max_rowid - min_rowid + 1)),file=sys.stderr)
+			sys.stderr.flush()
+	
+	return deleted
+
+def without_rowid_key(conn,table_name:str) -> list:
+	"""
+		It returns the primary key columns, in key order, when
+		the table is a WITHOUT ROWID one, and None otherwise
+	"""
+	try:
+		conn.execute("""SELECT rowid FROM {} LIMIT 0""".format(table_name))
+		return None
+	except sqlite3.OperationalError:
+		pass
+	
+	pk_columns = [ (res[5], res[1])  for res in conn.execute("""PRAGMA table_info({})""".format(table_name))  if res[5] > 0 ]
+	pk_columns.sort()
+	return [ column_name  for _, column_name in pk_columns ]
+
+def _delete_in_key_batches(conn,table_name:str,pk_columns:list,condition:str,params:dict,batch_size:int,label:str,lock) -> int:
+	# Each batch spans the next batch_size keys, in clustered order
+	with lock:
+		num_rows = conn.execute("""SELECT COUNT(*) FROM {}""".format(table_name)).fetchone()[0]  if label is not None  else None
+	key_expr = '(' + ','.join(pk_columns) + ')'
+	low_expr = '(' + ','.join(':low_' + str(i_col)  for i_col in range(len(pk_columns))) + ')'
+	high_expr = '(' + ','.join(':high_' + str(i_col)  for i_col in range(len(pk_columns))) + ')'
+	batch_params = dict(params)  if params  else {}
+	deleted = 0
+	visited = 0
+	low_key = None
+	while True:
+		key_conds = []
+		if low_key is not None:
+			key_conds.append(key_expr + ' > ' + low_expr)
+			batch_params.update(('low_' + str(i_col), val)  for i_col, val in enumerate(low_key))
+		
+		with lock:
+			high_key = conn.execute("""
+SELECT {}
+FROM {}
+{}
+ORDER BY {}
+LIMIT 1 OFFSET {}
+""".format(','.join(pk_columns),table_name,'WHERE ' + key_conds[0]  if key_conds  else '',','.join(pk_columns),batch_size - 1),batch_params).fetchone()
+		if high_key is not None:
+			key_conds.append(key_expr + ' <= ' + high_expr)
+			batch_params.update(('high_' + str(i_col), val)  for i_col, val in enumerate(high_key))
+		
+		key_conds.append('(' + condition + ')')
+		with lock, conn:
+			cur = conn.execute("""
+DELETE FROM {}
+WHERE
+{}
+""".format(table_name,'\nAND\n'.join(key_conds)),batch_params)
+			deleted += cur.rowcount
+		
+		visited += batch_size
+		if label is not None:
+			print("\t{}: {} rows deleted ({:.0%})".format(label,deleted,min(1.0,visited / num_rows)  if num_rows > 0  else 1.0),file=sys.stderr)
+			sys.stderr.flush()
+		
+		if high_key is None:
+			break
+		low_key = high_key
+	
+	return deleted
+
+def ensure_unique_index(conn,index_name:str,table_name:str,columns:str) -> None:
+	"""
+		It creates the unique index needed by the upserts, when it
+		does not exist yet. Duplicates in caches created before
+		the index are removed, keeping the latest inserted row.
+		WITHOUT ROWID tables whose key has those columns already
+		are that index
+	"""
+	pk_columns = without_rowid_key(conn,table_name)
+	if pk_columns is not None and set(pk_columns) == set(column.strip()  for column in columns.split(',')):
+		return
+	
+	res = conn.execute("""
+SELECT 1
+FROM sqlite_master
+WHERE
+type = 'index'
+AND
+name = ?
+""",(index_name,)).fetchone()
+	if res is None:
+		with conn:
+			conn.execute("""DROP TABLE IF EXISTS temp.keep_rowids""")
+			conn.execute("""
+CREATE TEMP TABLE keep_rowids AS
+SELECT MAX(rowid) AS keep_rowid
+FROM {}
+GROUP BY {}
+""".format(table_name,columns))
+			conn.execute("""CREATE INDEX temp.keep_rowids_k ON keep_rowids(keep_rowid)""")
+		
+		delete_in_batches(conn,table_name,"NOT EXISTS (SELECT 1 FROM temp.keep_rowids WHERE keep_rowid = {}.rowid)".format(table_name),label="Removing duplicates from "+table_name)
+		with conn:
+			conn.execute("""DROP TABLE temp.keep_rowids""")
+			conn.execute("""
+CREATE UNIQUE INDEX {0} ON {1}({2})
+""".format(index_name,table_name,columns))
+
+def upgrade_schema(conn,migrations,db_label:str) -> int:
+	"""
+		It brings the database schema to the latest version, applying
+		in order the pending (description, migration) pairs. The version
+		is kept in PRAGMA user_version, which is 0 both for new databases
+		and for the ones created before versioning, so migrations receive
+		the connection and they must be idempotent. It returns the version
+	"""
+	version = conn.execute("""PRAGMA user_version""").fetchone()[0]
+	if version > len(migrations):
+		raise Exception("{} has schema version {}, newer than the supported one ({})".format(db_label,version,len(migrations)))
+	
+	for new_version in range(version + 1, len(migrations) + 1):
+		description, migration = migrations[new_version - 1]
+		print("INFO: Upgrading {} to schema version {}: {}".format(db_label,new_version,description),file=sys.stderr)
+		sys.stderr.flush()
+		migration(conn)
+		with conn:
+			conn.execute("""PRAGMA user_version = {}""".format(new_version))
+	
+	return len(migrations)
+
+# Only the temporary tables driving the bulk lookups (always aliased as q)
+# are expected to be scanned. As each cache database usually holds a single
+# enricher, searches only constrained by it are also full scans
+_FULL_SCAN_PATTERN = re.compile(r'^(?:SCAN (?!q\b)|SEARCH .*\(enricher=\?\)$)')
+
+def explain_query_plans(cur,queries) -> list:
+	"""
+		It returns, for each (label, query) pair, the label, the
+		EXPLAIN QUERY PLAN details and whether any cache table
+		is fully scanned. Named parameters are bound to NULL
+	"""
+	plans = []
+	for label, query in queries:
+		params = { param_name: None  for param_name in re.findall(r':(\w+)',query) }
+		details = [ res[3]  for res in cur.execute("EXPLAIN QUERY PLAN " + query,params) ]
+		full_scan = any(_FULL_SCAN_PATTERN.match(detail)  for detail in details)
+		plans.append((label,details,full_scan))
+	
+	return plans
+
+# Upper limits (in days) of the age buckets in the maintenance reports
+AGE_BUCKETS = ((7,'< 1 week'),(28,'1-4 weeks'),(91,'1-3 months'),(365,'3-12 months'),(None,'> 1 year'))
+
+def table_report(conn,maintenance_tables) -> list:
+	"""
+		For each (table name, expiry condition, timestamp column) tuple,
+		it returns the number of rows, the bytes used by the table and
+		its indexes (when dbstat is available), the number of expired
+		rows and the distribution of the rows by age
+	"""
+	table_bytes = {}
+	try:
+		for res in conn.execute("""
+SELECT m.tbl_name, SUM(CASE WHEN m.type = 'table' THEN s.pgsize ELSE 0 END), SUM(CASE WHEN m.type = 'index' THEN s.pgsize ELSE 0 END)
+FROM dbstat s, sqlite_master m
+WHERE s.name = m.name
+GROUP BY m.tbl_name
+"""):
+			table_bytes[res[0]] = (res[1],res[2])
+	except sqlite3.OperationalError:
+		# This SQLite was built without the dbstat virtual table
+		pass
+	
+	report = []
+	for table_name, condition, age_column in maintenance_tables:
+		num_rows = conn.execute("""SELECT COUNT(*) FROM {}""".format(table_name)).fetchone()[0]
+		num_expired = conn.execute("""SELECT COUNT(*) FROM {} WHERE {}""".format(table_name,condition)).fetchone()[0]
+		ages = None
+		if age_column is not None:
+			bucket_cases = []
+			low_days = None
+			for high_days, _ in AGE_BUCKETS:
+				bucket_conds = []
+				if low_days is not None:
+					bucket_conds.append('age >= {}'.format(low_days))
+				if high_days is not None:
+					bucket_conds.append('age < {}'.format(high_days))
+				bucket_cases.append('SUM(CASE WHEN {} THEN 1 ELSE 0 END)'.format(' AND '.join(bucket_conds)))
+				low_days = high_days
+			
+			res = conn.execute("""
+SELECT {}
+FROM (SELECT JULIANDAY('NOW') - JULIANDAY({}) AS age FROM {})
+""".format(', '.join(bucket_cases),age_column,table_name)).fetchone()
+			ages = [ (bucket_label, count  if count is not None  else 0)  for (_, bucket_label), count in zip(AGE_BUCKETS,res) ]
+		
+		data_bytes, index_bytes = table_bytes.get(table_name,(None,None))
+		report.append({
+			'table': table_name,
+			'rows': num_rows,
+			'data_bytes': data_bytes,
+			'index_bytes': index_bytes,
+			'expired': num_expired,
+			'ages': ages
+		})
+	
+	return report
+
+def optimize_database(conn,full_vacuum:bool=False) -> bool:
+	"""
+		It gives back the free pages to the filesystem, it refreshes the
+		statistics used by the query planner, and it checkpoints the WAL.
+		Incremental vacuum is only available in databases created with
+		auto_vacuum = INCREMENTAL, and a full vacuum converts older ones.
+		It returns whether incremental vacuum is available
+	"""
+	conn.execute("""ANALYZE""")
+	
+	auto_vacuum = conn.execute("""PRAGMA auto_vacuum""").fetchone()[0]
+	if full_vacuum:
+		if auto_vacuum != 2:
+			conn.execute("""PRAGMA auto_vacuum = INCREMENTAL""")
+			auto_vacuum = 2
+		conn.execute("""VACUUM""")
+	elif auto_vacuum == 2:
+		# executescript steps the pragma until all the free pages are released
+		conn.executescript("""PRAGMA incremental_vacuum;""")
+	
+	conn.execute("""PRAGMA wal_checkpoint(TRUNCATE)""").fetchall()
+	
+	return auto_vacuum == 2
+
+import gzip
+import json
+import os
+
+# Cache snapshots are gzipped JSON lines files. The first line is the
+# header, and each one of the next ones is a row from a cache table
+SNAPSHOT_FORMAT = 'opeb-enrichers-cache-snapshot'
+SNAPSHOT_VERSION = 1
+
+def snapshot_timestamp(timestamp:datetime.datetime) -> str:
+	return timestamp.isoformat()  if timestamp is not None  else None
+
+def parse_snapshot_timestamp(timestamp:str) -> datetime.datetime:
+	return Timestamps.UTCTimestamp(datetime.datetime.fromisoformat(timestamp))  if timestamp is not None  else None
+
+def write_snapshot(snapshot_file:str,kind:str,since:datetime.datetime,records) -> dict:
+	"""
+		It streams the records to a new snapshot file, which only
+		replaces an existing one when it is complete. It returns
+		the number of records written per table
+	"""
+	je = json.JSONEncoder(separators=(',',':'))
+	counts = {}
+	tmp_snapshot_file = snapshot_file + '.tmp'
+	with gzip.open(tmp_snapshot_file,'wt',encoding='utf-8') as snapshot:
+		snapshot.write(je.encode({
+			'format': SNAPSHOT_FORMAT,
+			'version': SNAPSHOT_VERSION,
+			'kind': kind,
+			'exported': snapshot_timestamp(Timestamps.UTCTimestamp(datetime.datetime.utcnow())),
+			'since': snapshot_timestamp(since)
+		}))
+		snapshot.write('\n')
+		for record in records:
+			snapshot.write(je.encode(record))
+			snapshot.write('\n')
+			counts[record['table']] = counts.get(record['table'],0) + 1
+	
+	os.replace(tmp_snapshot_file,snapshot_file)
+	
+	return counts
+
+def read_snapshot(snapshot_file:str,kind:str):
+	"""
+		It yields the records of a snapshot file, after checking its header
+	"""
+	jd = json.JSONDecoder()
+	with gzip.open(snapshot_file,'rt',encoding='utf-8') as snapshot:
+		header = jd.decode(snapshot.readline())
+		if header.get('format') != SNAPSHOT_FORMAT or header.get('kind') != kind:
+			raise Exception('{} is not a {} cache snapshot'.format(snapshot_file,kind))
+		if header.get('version',0) > SNAPSHOT_VERSION:
+			raise Exception('{} snapshot version {} is newer than the supported one ({})'.format(snapshot_file,header.get('version'),SNAPSHOT_VERSION))
+		
+		for line in snapshot:
+			yield jd.decode(line)
@@ -62,6 +62,13 @@ class PubmedEnricher(AbstractPubEnricher):
 	def Name(cls) -> str:
 		return cls.PUBMED_SOURCE
 	
+	# The id conversion, and the population of the found ones
+	PUB_IDS_REQUESTS_PER_BATCH = 2
+	
+	def estimateCitRefsRequests(self,citref_counts:List[Dict[bool,int]]) -> int:
+		# Both citations and references are linked on each request
+		return (len(citref_counts) + self.elink_step_size - 1) // self.elink_step_size
+	
 	# Documented at: https://www.ncbi.nlm.nih.gov/books/NBK25499/#_chapter4_ESummary_
 	PUB_ID_SUMMARY_URL='https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esummary.fcgi'
 	def populatePubIdsBatch(self,mappings:List[Dict[str,Any]]) -> None:
@@ -15,10 +15,11 @@ import time
 
 from abc import ABC, abstractmethod
 
-from typing import overload, Tuple, List, Dict, Any, Iterator
+from typing import overload, Tuple, List, Dict, Set, Any, Iterator
 
-from .pub_cache import PubDBCache
+from .pub_cache import PubDBCache, citref_year_stats
 from .doi_cache import DOIChecker
+from .cache_stats import merge_reports, format_report
 
 from . import pub_common
 
@@ -59,6 +60,9 @@ class SkeletonPubEnricher(ABC):
 	DEFAULT_STEP_SIZE = 50
 	DEFAULT_NUM_FILES_PER_DIR = 1000
 	DEFAULT_MAX_RETRIES = 5
+	DEFAULT_REVALIDATE_BUDGET = 100
+	DEFAULT_REFRESH_BUDGET = 100
+	DEFAULT_REFRESH_HORIZON_DAYS = 7
 	
 	@overload
 	def __init__(self,cache:str=".",prefix:str=None,config:configparser.ConfigParser=None,debug:bool=False,doi_checker:DOIChecker=None):
@@ -72,6 +76,13 @@ class SkeletonPubEnricher(ABC):
 		# The section name is the symbolic name given to this class
 		section_name = self.Name()
 		
+		# Load at least a config parser
+		self.config = config if config else configparser.ConfigParser()
+		
+		# Adding empty sections, in order to avoid the NoSectionError exception
+		if not self.config.has_section(section_name):
+			self.config.add_section(section_name)
+		
 		if isinstance(cache,PubDBCache):
 			# Try using same checker instance everywhere
 			self.cache_dir = cache.cache_dir
@@ -80,7 +91,7 @@ class SkeletonPubEnricher(ABC):
 			self.cache_dir = doi_checker.cache_dir
 		else:
 			self.cache_dir = cache
-			doi_checker = DOIChecker(self.cache_dir)
+			doi_checker = DOIChecker(self.cache_dir,**DOIChecker.KwargsFromConfig(self.config,section_name))
 		
 		self.doi_checker = doi_checker
 		
@@ -88,23 +99,32 @@ class SkeletonPubEnricher(ABC):
 			cache_prefix = prefix + '_' + section_name  if prefix else section_name
 			cache_prefix += '_'
 			
-			self.pubC = PubDBCache(section_name,cache_dir = self.cache_dir,prefix=cache_prefix,doi_checker=doi_checker)
+			self.pubC = PubDBCache(section_name,cache_dir = self.cache_dir,prefix=cache_prefix,doi_checker=doi_checker,**PubDBCache.KwargsFromConfig(self.config,section_name))
 		else:
 			self.pubC = cache
 		
-		# Load at least a config parser
-		self.config = config if config else configparser.ConfigParser()
-		
-		# Adding empty sections, in order to avoid the NoSectionError exception
-		if not self.config.has_section(section_name):
-			self.config.add_section(section_name)
-		
 		self.step_size = self.config.getint(section_name,'step_size',fallback=self.DEFAULT_STEP_SIZE)
 		self.num_files_per_dir = self.config.getint(section_name,'num_files_per_dir',fallback=self.DEFAULT_NUM_FILES_PER_DIR)
 		
 		# Maximum number of retries
 		self.max_retries = self.config.getint(section_name,'retries',fallback=self.DEFAULT_MAX_RETRIES)
 		
+		# Should the publication ids of all the entries be resolved
+		# before processing them slice by slice?
+		self.prefetch_pub_ids = self.config.getboolean(section_name,'prefetch_pub_ids',fallback=True)
+		
+		# Maximum number of requests spent at the end of each run
+		# revalidating the stale entries which were served
+		self.revalidate_budget = self.config.getint(section_name,'cache_revalidate_budget',fallback=self.DEFAULT_REVALIDATE_BUDGET)
+		
+		# Requests per hour spent by the cache refresher, renewing
+		# the entries which expire within the horizon
+		self.refresh_budget = self.config.getint(section_name,'cache_refresh_budget',fallback=self.DEFAULT_REFRESH_BUDGET)
+		self.refresh_horizon = datetime.timedelta(days=self.config.getfloat(section_name,'cache_refresh_horizon_days',fallback=self.DEFAULT_REFRESH_HORIZON_DAYS))
+		
+		# Should the cache statistics be saved along with the results?
+		self.cache_stats_json = self.config.getboolean(section_name,'cache_stats_json',fallback=False)
+		
 		# Debug flag
 		self._debug = debug
 		
@@ -120,9 +140,23 @@ class SkeletonPubEnricher(ABC):
 	
 	def __enter__(self):
 		self.pubC.__enter__()
+		
+		# Hot queries which are not using the indexes
+		if self._debug:
+			for label, details, full_scan in self.pubC.explainQueryPlans():
+				if full_scan:
+					print("DEBUG: {} cache query '{}' does a full scan: {}".format(self.Name(),label,'; '.join(details)),file=sys.stderr)
+			sys.stderr.flush()
+		
 		return self
 	
 	def __exit__(self, exc_type, exc_val, exc_tb):
+		if self._debug:
+			lru_stats = self.pubC.getLRUStats()
+			if lru_stats is not None:
+				print("DEBUG: {} decoded payloads cache: {} hits, {} misses (hit rate {})".format(self.Name(),lru_stats['hits'],lru_stats['misses'],lru_stats['hit_rate']),file=sys.stderr)
+				sys.stderr.flush()
+		
 		self.pubC.__exit__(exc_type, exc_val, exc_tb)
 	
 	@classmethod
@@ -130,6 +164,34 @@ class SkeletonPubEnricher(ABC):
 	def Name(cls) -> str:
 		return 'skel'
 	
+	def getCacheStats(self) -> List[Dict[str,Any]]:
+		"""
+			The statistics of the caches used by this enricher
+		"""
+		return [ self.pubC.getCacheStats(), self.doi_checker.getCacheStats() ]
+	
+	CACHE_STATS_FILE = 'cache_stats.json'
+	
+	def reportCacheStats(self,results_path:str=None,results_format:str=None) -> List[Dict[str,Any]]:
+		"""
+			It prints the summary of the cache statistics, and it
+			saves them next to the manifest, when it is requested
+		"""
+		reports = merge_reports(self.getCacheStats())
+		for report in reports:
+			for line in format_report(report):
+				print("INFO: " + line,file=sys.stderr)
+		sys.stderr.flush()
+		
+		if self.cache_stats_json and results_path is not None:
+			# The single format results path is a file
+			stats_dir = os.path.dirname(results_path)  if results_format == "single"  else results_path
+			stats_file = os.path.join(stats_dir,self.CACHE_STATS_FILE)
+			with open(stats_file,mode="w",encoding="utf-8") as stats_out:
+				stats_out.write(self.je.encode({'@timestamp': datetime.datetime.now().isoformat(), 'caches': reports}))
+		
+		return reports
+	
 	@abstractmethod
 	def queryPubIdsBatch(self,query_ids:List[Dict[str,str]]) -> List[Dict[str,Any]]:
 		pass
@@ -139,6 +201,22 @@ class SkeletonPubEnricher(ABC):
 			Caching version of queryPubIdsBatch.
 			Order is not guaranteed
 		"""
+		result_array, query_ids, query_pub_ids = self._planPubIdsQueries(query_list)
+		
+		# Now, with the unknown ones, let's ask the server
+		if len(query_ids) > 0:
+			result_array.extend(self._queryPubIdsInBatches(query_ids,query_pub_ids))
+		
+		return result_array
+	
+	def _planPubIdsQueries(self,query_list:List[Dict[str,str]]) -> Tuple[List[Dict[str,Any]],List[Dict[str,str]],List[Set[str]]]:
+		"""
+			It resolves the queries against the cache, in bulk. It returns
+			the cached mappings, the query ids which have to be asked
+			to the server (neither cached nor known as unresolvable),
+			and the publish ids of the publication behind each query id
+			(None when the publication was resolved from the cache)
+		"""
 		# First, gather all the ids on one list, prepared for the query
 		# MED: prefix has been removed because there are some problems
 		# on the server side
@@ -147,14 +225,33 @@ class SkeletonPubEnricher(ABC):
 		r2e = set()
 		result_array = []
 		
+		# All the cache lookups are done in bulk, before the loop
+		publish_ids = set()
+		for query in query_list:
+			pubmed_id = query.get('pmid')
+			if pubmed_id is not None:
+				publish_ids.add(pubmed_id)
+			
+			doi_id = query.get('doi')
+			if doi_id is not None:
+				publish_ids.add(self.doi_checker.normalize_doi(doi_id))
+			
+			pmc_id = query.get('pmcid')
+			if pmc_id is not None:
+				publish_ids.add(pub_common.normalize_pmcid(pmc_id))
+		
+		cached_mappings_hash = self.pubC.getCachedMappingsFromPublishIdsBulk(publish_ids)  if publish_ids  else {}
+		# The ones no backend could resolve are not asked again
+		negative_ids = self.pubC.getNegativeIdsBulk(publish_ids - cached_mappings_hash.keys())  if publish_ids  else set()
+		
 		def _prefetchCaches(publish_id:str) -> bool:
 			# This one tells us the result was already got
 			if publish_id in q2e:
 				return True
 			
 			# This one signals the result is not in the cache
-			internal_ids = self.pubC.getSourceIds(publish_id)
-			if internal_ids is None:
+			internal_mappings = cached_mappings_hash.get(publish_id)
+			if internal_mappings is None:
 				return False
 			
 			# Let's dig in the cached results
@@ -162,14 +259,12 @@ class SkeletonPubEnricher(ABC):
 			mappings = [ ]
 			results = [ ]
 			
-			for source_id_pair in internal_ids:
+			for source_id_pair, mapping in internal_mappings:
 				# If the result is correct, skip
 				if source_id_pair in r2e:
 					validMappings = True
 					continue
 				
-				mapping = self.pubC.getCachedMapping(*source_id_pair)
-				
 				# If some of the mappings has been invalidated,
 				# complain
 				if mapping is None:
@@ -185,29 +280,34 @@ class SkeletonPubEnricher(ABC):
 			if validMappings:
 				q2e.add(publish_id)
 				if len(results) > 0:
-					r2e.union(*results)
+					r2e.update(results)
 					result_array.extend(mappings)
 			
 			return validMappings
 		
 		# Preparing the query ids
 		query_ids = []
+		query_pub_ids = []
 		# This set allows avoiding to issue duplicate queries
 		set_query_ids = set()
 		for query in query_list:
 			query_id = {}
+			pub_ids = set()
 			
 			# This loop avoid resolving twice
 			pubmed_id = query.get('pmid')
-			if pubmed_id is not None and not _prefetchCaches(pubmed_id):
-				pubmed_set_id = (pubmed_id,'pmid')
-				set_query_ids.add(pubmed_set_id)
-				query_id['pmid'] = pubmed_id
+			if pubmed_id is not None:
+				pub_ids.add(pubmed_id)
+				if pubmed_id not in negative_ids and not _prefetchCaches(pubmed_id):
+					pubmed_set_id = (pubmed_id,'pmid')
+					set_query_ids.add(pubmed_set_id)
+					query_id['pmid'] = pubmed_id
 			
 			doi_id = query.get('doi')
 			if doi_id is not None:
 				doi_id_norm = self.doi_checker.normalize_doi(doi_id)
-				if not _prefetchCaches(doi_id_norm):
+				pub_ids.add(doi_id_norm)
+				if doi_id_norm not in negative_ids and not _prefetchCaches(doi_id_norm):
 					doi_set_id = (doi_id_norm,'doi')
 					set_query_ids.add(doi_set_id)
 					query_id['doi'] = doi_id_norm
@@ -215,7 +315,8 @@ class SkeletonPubEnricher(ABC):
 			pmc_id = query.get('pmcid')
 			if pmc_id is not None:
 				pmc_id_norm = pub_common.normalize_pmcid(pmc_id)
-				if not _prefetchCaches(pmc_id_norm):
+				pub_ids.add(pmc_id_norm)
+				if pmc_id_norm not in negative_ids and not _prefetchCaches(pmc_id_norm):
 					pmc_set_id = (pmc_id_norm,'pmcid')
 					set_query_ids.add(pmc_set_id)
 					query_id['pmcid'] = pmc_id_norm
@@ -223,35 +324,371 @@ class SkeletonPubEnricher(ABC):
 			# Add it when there is something to query about
 			if len(query_id) > 0:
 				query_ids.append(query_id)
+				query_pub_ids.append(None  if not q2e.isdisjoint(pub_ids)  else pub_ids)
 		
-		# Now, with the unknown ones, let's ask the server
-		if len(query_ids) > 0:
-			try:
-				# Needed to not overwhelm the underlying implementation
-				for start in range(0,len(query_ids),self.step_size):
-					stop = start+self.step_size
-					query_ids_slice = query_ids[start:stop]
-					
-					gathered_pubmed_pairs = self.queryPubIdsBatch(query_ids_slice)
+		return result_array, query_ids, query_pub_ids
+	
+	def _queryPubIdsInBatches(self,query_ids:List[Dict[str,str]],query_pub_ids:List[Set[str]]=None) -> List[Dict[str,Any]]:
+		"""
+			It asks the server about the query ids, in step_size batches,
+			storing the results (and the unresolved ids) in the cache
+		"""
+		result_array = []
+		try:
+			# Needed to not overwhelm the underlying implementation
+			for start in range(0,len(query_ids),self.step_size):
+				stop = start+self.step_size
+				query_ids_slice = query_ids[start:stop]
+				
+				gathered_pubmed_pairs = self.queryPubIdsBatch(query_ids_slice)
+				
+				if gathered_pubmed_pairs:
+					# Cache management, the whole batch at once
+					self.pubC.setCachedMappings(gathered_pubmed_pairs)
 					
-					if gathered_pubmed_pairs:
-						for mapping in gathered_pubmed_pairs:
-							# Cache management
-							self.pubC.setCachedMapping(mapping)
-							
-						# Result management
-						result_array.extend(gathered_pubmed_pairs)
-			except Exception as anyEx:
-				print("Something unexpected happened in cachedQueryPubIds",file=sys.stderr)
-				print(anyEx,file=sys.stderr)
-				import traceback
-				traceback.print_exc(file=sys.stderr)
-				sys.stderr.flush()
-				raise anyEx
+					# Result management
+					result_array.extend(gathered_pubmed_pairs)
+				
+				self._storeNegativeIds(query_ids_slice,gathered_pubmed_pairs,query_pub_ids[start:stop]  if query_pub_ids is not None  else None)
+		except Exception as anyEx:
+			print("Something unexpected happened in cachedQueryPubIds",file=sys.stderr)
+			print(anyEx,file=sys.stderr)
+			import traceback
+			traceback.print_exc(file=sys.stderr)
+			sys.stderr.flush()
+			raise anyEx
 		
 		return result_array
+	
+	def prefetchPubIds(self,entries:List[Dict[str,Any]]) -> int:
+		"""
+			Planning phase of reconcilePubIds. The publication ids of all
+			the entries are resolved against the cache at once, and only
+			the global set of misses is asked to the server, packed in
+			full size batches. So, the reconciliation of each slice of
+			entries runs from a warm cache. It returns the number of batches
+		"""
+		query_list = [ entry_pub  for entry in entries  for entry_pub in entry['entry_pubs'] ]
+		_, query_ids, query_pub_ids = self._planPubIdsQueries(query_list)
+		
+		num_batches = (len(query_ids) + self.step_size - 1) // self.step_size
+		print("INFO: {} prefetch: {} publication queries, {} not cached, asked in {} batches".format(self.Name(),len(query_list),len(query_ids),num_batches),file=sys.stderr)
+		sys.stderr.flush()
 		
+		if len(query_ids) > 0:
+			self._queryPubIdsInBatches(query_ids,query_pub_ids)
+			self.pubC.sync()
 		
+		return num_batches
+	
+	# Number of requests issued on each queryPubIdsBatch call
+	PUB_IDS_REQUESTS_PER_BATCH = 1
+	
+	def estimatePubIdsRequests(self,num_queries:int) -> int:
+		return ((num_queries + self.step_size - 1) // self.step_size) * self.PUB_IDS_REQUESTS_PER_BATCH
+	
+	def estimateCitRefsRequests(self,citref_counts:List[Dict[bool,int]]) -> int:
+		"""
+			The requests needed to fetch the citations and references of
+			the publications. Each element tells, for each list to fetch
+			(is_cit), its count when it is known from an expired entry
+		"""
+		return (len(citref_counts) + self.step_size - 1) // self.step_size
+	
+	def estimatePopulationRequests(self,num_mappings:int) -> int:
+		return (num_mappings + self.step_size - 1) // self.step_size
+	
+	def estimateSeconds(self,num_requests:int) -> float:
+		"""
+			Lower bound of the time needed by the requests
+		"""
+		return 0.0
+	
+	def planCosts(self,entries:List[Dict[str,Any]],verbosityLevel:float=0,mode:int=3) -> List[Dict[str,Any]]:
+		"""
+			Dry run of reconcilePubIds, without any network access. For
+			each crawl level it tells how many lookups are cached, expired
+			or missing in the cache, along with the estimated number of
+			requests and time. Level 0 resolves the publication ids of the
+			entries, and the next ones fetch the citations and references
+			(and their metadata, depending on the verbosity level). Only
+			the lists known by the cache are followed, so the deeper
+			levels are lower bounds
+		"""
+		plan = []
+		def _addLevel(level:int,stage:str,cached:int,expired:int,missing:int,requests:int) -> None:
+			plan.append({
+				'backend': self.Name(),
+				'level': level,
+				'stage': stage,
+				'cached': cached,
+				'expired': expired,
+				'missing': missing,
+				'requests': requests,
+				'seconds': self.estimateSeconds(requests),
+			})
+		
+		# Level 0: the publication ids
+		query_list = [ entry_pub  for entry in entries  for entry_pub in entry['entry_pubs'] ]
+		publish_ids = set()
+		for query in query_list:
+			pubmed_id = query.get('pmid')
+			if pubmed_id is not None:
+				publish_ids.add(pubmed_id)
+			
+			doi_id = query.get('doi')
+			if doi_id is not None:
+				publish_ids.add(self.doi_checker.normalize_doi(doi_id))
+			
+			pmc_id = query.get('pmcid')
+			if pmc_id is not None:
+				publish_ids.add(pub_common.normalize_pmcid(pmc_id))
+		
+		cached_ids, expired_ids, missing_ids = self.pubC.planPublishIdsBulk(publish_ids)
+		_, query_ids, _ = self._planPubIdsQueries(query_list)
+		_addLevel(0,'pub_ids',len(cached_ids),len(expired_ids),len(missing_ids),self.estimatePubIdsRequests(len(query_ids)))
+		
+		# Each query is expected to resolve a single publication,
+		# whose lists are not cached
+		pubs = set(internal_id  for internal_ids in cached_ids.values()  for internal_id in internal_ids)
+		unknown_pubs = len(query_ids)
+		citref_modes = [ is_cit  for is_cit, mode_bit in ((True,2),(False,1))  if (mode & mode_bit) != 0 ]
+		level = 1
+		while pubs or unknown_pubs > 0:
+			num_cached = 0
+			num_expired = 0
+			num_missing = unknown_pubs * len(citref_modes)
+			to_fetch = {}
+			known_citrefs = {}
+			for is_cit in citref_modes:
+				cached_citrefs, expired_citrefs, missing_citrefs = self.pubC.planCitRefsBulk(pubs,is_cit)
+				num_cached += len(cached_citrefs)
+				num_expired += len(expired_citrefs)
+				num_missing += len(missing_citrefs)
+				for qual_id, citrefs in expired_citrefs.items():
+					to_fetch.setdefault(qual_id,{})[is_cit] = len(citrefs)
+				for qual_id in missing_citrefs:
+					to_fetch.setdefault(qual_id,{})[is_cit] = None
+				known_citrefs[is_cit] = [ citref  for citrefs_hash in (cached_citrefs,expired_citrefs)  for citrefs in citrefs_hash.values()  for citref in citrefs ]
+			
+			citref_counts = list(to_fetch.values()) + [ { is_cit: None  for is_cit in citref_modes } ] * unknown_pubs
+			_addLevel(level,'citrefs',num_cached,num_expired,num_missing,self.estimateCitRefsRequests(citref_counts))
+			
+			# Only the stats are computed
+			if verbosityLevel <= 1:
+				break
+			
+			populables = set((citref['source'],citref['id'])  for citrefs in known_citrefs.values()  for citref in citrefs  if citref.get('id') is not None and citref.get('source') is not None)
+			cached_mappings, expired_mappings, missing_mappings = self.pubC.planMappingsBulk(populables)
+			_addLevel(level,'population',len(cached_mappings),len(expired_mappings),len(missing_mappings),self.estimatePopulationRequests(len(expired_mappings) + len(missing_mappings)))
+			
+			# Next level, the citations of the citations
+			if verbosityLevel < 2:
+				break
+			pubs = set((citref['source'],citref['id'])  for citref in known_citrefs.get(True,[])  if citref.get('id') is not None and citref.get('source') is not None)
+			unknown_pubs = 0
+			verbosityLevel -= 1
+			level += 1
+		
+		return plan
+	
+	@classmethod
+	def _publishIdQuery(cls,publish_id:str) -> Dict[str,str]:
+		# The cached publish ids are normalized, so their kind is guessed
+		if pub_common.PMC_PATTERN.search(publish_id):
+			return {'pmcid': publish_id}
+		
+		if publish_id.isdigit():
+			return {'pmid': publish_id}
+		
+		return {'doi': publish_id}
+	
+	def _renewPublishIds(self,publish_ids:List[str]) -> None:
+		self._queryPubIdsInBatches([ self._publishIdQuery(publish_id)  for publish_id in publish_ids ])
+	
+	def _renewMappings(self,qual_ids:List[Tuple[str,str]]) -> None:
+		old_mappings = list(self.pubC.getRawCachedMappings(qual_ids))
+		partial_mappings = [ { 'id': _id, 'source': source_id }  for source_id, _id in qual_ids ]
+		self.populatePubIdsBatch(partial_mappings)
+		
+		cacheable_mappings = []
+		for (_, old_mapping), partial_mapping in zip(old_mappings,partial_mappings):
+			# It is a kind of indicator the 'year' flag
+			if partial_mapping.get('year') is not None:
+				mapping = dict(old_mapping)  if old_mapping is not None  else {}
+				mapping.update(partial_mapping)
+				cacheable_mappings.append(mapping)
+		
+		self.pubC.setCachedMappings(cacheable_mappings)
+	
+	def _renewCitRefs(self,qual_ids:List[Tuple[str,str]],is_cit:bool) -> None:
+		query_citations_data = [ { 'source': source_id, 'id': _id }  for source_id, _id in qual_ids ]
+		query_hash = { (_id,source_id): []  for source_id, _id in qual_ids }
+		self.clusteredSearchCitRefsBatch(query_citations_data,query_hash,False,2  if is_cit  else 1)
+	
+	def revalidateStale(self,budget:int=None) -> int:
+		"""
+			It refetches the stale entries served since the last call,
+			spending up to budget requests (by default, the configured
+			one). The ones left out are served stale again on next runs,
+			until they are renewed or they leave the grace window.
+			It returns the estimated number of issued requests
+		"""
+		if budget is None:
+			budget = self.revalidate_budget
+		
+		stale = self.pubC.popStaleEntries()
+		if not any(stale.values()):
+			return 0
+		
+		spent = 0
+		def _inBatches(label:str,keys:List[Any],cost_fn,renew_fn) -> None:
+			nonlocal spent
+			num_done = 0
+			for start in range(0,len(keys),self.step_size):
+				keys_slice = keys[start:start+self.step_size]
+				cost = cost_fn(keys_slice)
+				if spent + cost > budget:
+					break
+				
+				renew_fn(keys_slice)
+				spent += cost
+				num_done += len(keys_slice)
+			
+			# Entries renewed meanwhile are not fetched again
+			self.pubC.sync()
+			if len(keys) > 0:
+				print("INFO: {} revalidated {} of {} stale {}".format(self.Name(),num_done,len(keys),label),file=sys.stderr)
+		
+		# The publication ids first, as they change the results the most
+		self.pubC.sync()
+		_, expired_ids, _ = self.pubC.planPublishIdsBulk(stale['idmap'] | stale['negative'])
+		_inBatches(
+			'publication ids',
+			sorted(expired_ids),
+			lambda publish_ids: self.estimatePubIdsRequests(len(publish_ids)),
+			self._renewPublishIds
+		)
+		
+		_, expired_mappings, _ = self.pubC.planMappingsBulk(stale['mapping'])
+		_inBatches(
+			'mappings',
+			sorted(expired_mappings),
+			lambda qual_ids: self.estimatePopulationRequests(len(qual_ids)),
+			self._renewMappings
+		)
+		
+		for is_cit, kind in ((True,'citations'),(False,'references')):
+			_, expired_citrefs, _ = self.pubC.planCitRefsBulk(stale[kind],is_cit)
+			_inBatches(
+				kind,
+				sorted(expired_citrefs.keys()),
+				lambda qual_ids: self.estimateCitRefsRequests([ { is_cit: len(expired_citrefs[qual_id]) }  for qual_id in qual_ids ]),
+				lambda qual_ids: self._renewCitRefs(qual_ids,is_cit)
+			)
+		
+		sys.stderr.flush()
+		
+		return spent
+	
+	def refreshCache(self,budget:int=None) -> int:
+		"""
+			A pass of the cache refresher, meant to be run hourly. It
+			renews the cached entries expiring within the refresh horizon,
+			closest to expiry first, spending up to budget requests (by
+			default, the configured hourly one). So, the entries fetched
+			together do not expire together. It returns the estimated
+			number of issued requests
+		"""
+		if budget is None:
+			budget = self.refresh_budget
+		
+		renewals = (
+			('idmap', lambda publish_ids: self.estimatePubIdsRequests(len(publish_ids)), self._renewPublishIds),
+			('mapping', lambda qual_ids: self.estimatePopulationRequests(len(qual_ids)), self._renewMappings),
+			('citations', lambda qual_ids: self.estimateCitRefsRequests([ { True: None } ] * len(qual_ids)), lambda qual_ids: self._renewCitRefs(qual_ids,True)),
+			('references', lambda qual_ids: self.estimateCitRefsRequests([ { False: None } ] * len(qual_ids)), lambda qual_ids: self._renewCitRefs(qual_ids,False)),
+		)
+		
+		# The candidates of all the kinds, closest to expiry first
+		self.pubC.sync()
+		limit = max(budget,1) * self.step_size
+		candidates = sorted(
+			(expiry, kind_idx, key)
+			for kind_idx, (kind, _, _) in enumerate(renewals)
+			for expiry, key in self.pubC.getRefreshCandidates(kind,self.refresh_horizon,limit)
+		)
+		
+		spent = 0
+		batches = [ []  for _ in renewals ]
+		num_renewed = [ 0 ] * len(renewals)
+		def _renew(kind_idx:int) -> bool:
+			nonlocal spent
+			_, cost_fn, renew_fn = renewals[kind_idx]
+			batch = batches[kind_idx]
+			cost = cost_fn(batch)
+			if spent + cost > budget:
+				return False
+			
+			renew_fn(batch)
+			spent += cost
+			num_renewed[kind_idx] += len(batch)
+			batches[kind_idx] = []
+			return True
+		
+		within_budget = True
+		for _, kind_idx, key in candidates:
+			batches[kind_idx].append(key)
+			if len(batches[kind_idx]) >= self.step_size:
+				within_budget = _renew(kind_idx)
+				if not within_budget:
+					break
+		
+		# The last, partial batches
+		if within_budget:
+			for kind_idx, batch in enumerate(batches):
+				if batch and not _renew(kind_idx):
+					break
+		
+		self.pubC.sync()
+		print("INFO: {} refresher: {} candidates, {} requests. Renewed ".format(self.Name(),len(candidates),spent) + ', '.join("{}: {}".format(kind,num)  for (kind, _, _), num in zip(renewals,num_renewed)),file=sys.stderr)
+		sys.stderr.flush()
+		
+		return spent
+	
+	def _storeNegativeIds(self,query_ids:List[Dict[str,str]],mappings:List[Dict[str,Any]],query_pub_ids:List[Set[str]]=None) -> None:
+		"""
+			It records the queried publish ids which were not resolved,
+			so they are not asked again until their negative result expires.
+			A query only counts as unresolved when none of the publish ids
+			of its publication (query_pub_ids, where None means it was
+			resolved from the cache) were resolved. Failed queries raise
+			an exception before reaching here, so an empty answer
+			means that none of them was resolved
+		"""
+		resolved_ids = set()
+		for mapping in mappings:
+			pubmed_id = mapping.get('pmid')
+			if pubmed_id is not None:
+				resolved_ids.add(pubmed_id)
+			
+			doi_id = mapping.get('doi')
+			if doi_id is not None:
+				resolved_ids.add(self.doi_checker.normalize_doi(doi_id))
+			
+			pmc_id = mapping.get('pmcid')
+			if pmc_id is not None:
+				resolved_ids.add(pub_common.normalize_pmcid(pmc_id))
+		
+		negative_ids = set()
+		for i_query, query_id in enumerate(query_ids):
+			pub_ids = query_pub_ids[i_query]  if query_pub_ids is not None  else set(query_id.values())
+			if pub_ids is not None and resolved_ids.isdisjoint(pub_ids):
+				negative_ids.update(query_id.values())
+		
+		if negative_ids:
+			self.pubC.setNegativeIds(negative_ids)
+	
 	def reconcilePubIdsBatch(self,entries:List[Any]) -> None:
 		# First, gather all the ids on one list, prepared for the query
 		# MED: prefix has been removed because there are some problems
@@ -262,12 +699,31 @@ class SkeletonPubEnricher(ABC):
 		d2e = {}
 		pubmed_pairs = []
 		
+		# All the cache lookups are done in bulk, before the loop
+		publish_ids = set()
+		for entry_pubs in map(lambda entry: entry['entry_pubs'],entries):
+			for entry_pub in entry_pubs:
+				pubmed_id = entry_pub.get('pmid')
+				if pubmed_id is not None:
+					publish_ids.add(pubmed_id)
+				
+				doi_id = entry_pub.get('doi')
+				if doi_id is not None:
+					publish_ids.add(self.doi_checker.normalize_doi(doi_id))
+				
+				pmc_id = entry_pub.get('pmcid')
+				if pmc_id is not None:
+					publish_ids.add(pub_common.normalize_pmcid(pmc_id))
+		
+		cached_mappings_hash = self.pubC.getCachedMappingsFromPublishIdsBulk(publish_ids)  if publish_ids  else {}
+		# The ones no backend could resolve are not asked again
+		negative_ids = self.pubC.getNegativeIdsBulk(publish_ids - cached_mappings_hash.keys())  if publish_ids  else set()
+		
 		def _updateCaches(publish_id:str) -> bool:
-			internal_ids = self.pubC.getSourceIds(publish_id)
-			if internal_ids is not None:
+			internal_mappings = cached_mappings_hash.get(publish_id)
+			if internal_mappings is not None:
 				validMappings = 0
-				for source_id,_id in internal_ids:
-					mapping = self.pubC.getCachedMapping(source_id,_id)
+				for (source_id,_id), mapping in internal_mappings:
 					# If the mapping did not expire, register it!
 					if mapping is not None:
 						validMappings += 1
@@ -293,50 +749,65 @@ class SkeletonPubEnricher(ABC):
 		
 		# Preparing the query ids
 		query_ids = []
+		query_pub_ids = []
 		# This set allows avoiding to issue duplicate queries
 		set_query_ids = set()
 		for entry_pubs in map(lambda entry: entry['entry_pubs'],entries):
 			for entry_pub in entry_pubs:
 				query_id = {}
+				pub_ids = set()
+				resolved_pub = False
 				# This loop avoid resolving twice
 				pubmed_id = entry_pub.get('pmid')
-				pubmed_set_id = (pubmed_id,'pmid')
-				if pubmed_id is not None and pubmed_set_id not in set_query_ids and pubmed_id not in p2e:
-					if not _updateCaches(pubmed_id):
+				if pubmed_id is not None:
+					pub_ids.add(pubmed_id)
+					pubmed_set_id = (pubmed_id,'pmid')
+					if pubmed_set_id not in set_query_ids and pubmed_id not in p2e and pubmed_id not in negative_ids and not _updateCaches(pubmed_id):
 						set_query_ids.add(pubmed_set_id)
 						query_id['pmid'] = pubmed_id
-						
+					if pubmed_id in p2e:
+						resolved_pub = True
 				
 				doi_id = entry_pub.get('doi')
 				if doi_id is not None:
 					doi_id_norm = self.doi_checker.normalize_doi(doi_id)
+					pub_ids.add(doi_id_norm)
 					doi_set_id = (doi_id_norm,'doi')
-					if doi_set_id not in set_query_ids and doi_id_norm not in d2e and not _updateCaches(doi_id_norm):
+					if doi_set_id not in set_query_ids and doi_id_norm not in d2e and doi_id_norm not in negative_ids and not _updateCaches(doi_id_norm):
 						set_query_ids.add(doi_set_id)
 						query_id['doi'] = doi_id_norm
+					if doi_id_norm in d2e:
+						resolved_pub = True
 				
 				pmc_id = entry_pub.get('pmcid')
 				if pmc_id is not None:
 					pmc_id_norm = pub_common.normalize_pmcid(pmc_id)
+					pub_ids.add(pmc_id_norm)
 					pmc_set_id = (pmc_id_norm,'pmcid')
-					if pmc_set_id not in set_query_ids and pmc_id_norm not in pmc2e and not _updateCaches(pmc_id_norm):
+					if pmc_set_id not in set_query_ids and pmc_id_norm not in pmc2e and pmc_id_norm not in negative_ids and not _updateCaches(pmc_id_norm):
 						set_query_ids.add(pmc_set_id)
 						query_id['pmcid'] = pmc_id_norm
+					if pmc_id_norm in pmc2e:
+						resolved_pub = True
 				
 				# Add it when there is something to query about
 				if len(query_id) > 0:
 					query_ids.append(query_id)
+					# Publications resolved from the cache have no unresolved ids
+					query_pub_ids.append(None  if resolved_pub  else pub_ids)
 		
 		# Now, with the unknown ones, let's ask the server
 		if len(query_ids) > 0:
 			try:
 				gathered_pubmed_pairs = self.queryPubIdsBatch(query_ids)
 				
-				# Cache management
+				# Cache management, the whole batch at once
+				self.pubC.setCachedMappings(gathered_pubmed_pairs)
+				self._storeNegativeIds(query_ids,gathered_pubmed_pairs,query_pub_ids)
+				
 				for mapping in gathered_pubmed_pairs:
 					_id = mapping['id']
 					source_id = mapping['source']
-					self.pubC.setCachedMapping(mapping)
 					
 					pubmed_id = mapping.get('pmid')
 					if pubmed_id is not None:
@@ -479,6 +950,7 @@ class SkeletonPubEnricher(ABC):
 				print(anyEx,file=sys.stderr)
 				raise anyEx
 			
+			citref_list = []
 			for new_citref in new_citrefs:
 				source_id = new_citref['source']
 				_id = new_citref['id']
@@ -489,7 +961,7 @@ class SkeletonPubEnricher(ABC):
 						citation_count = new_citref['citation_count']
 						# There are cases where no citation could be fetched
 						# but it should also be cached
-						self.pubC.setCitationsAndCount(source_id,_id,citations,citation_count)
+						citref_list.append(((source_id,_id),citations,True))
 						for pub_field in query_hash[(_id,source_id)]:
 							pub_field['citation_count'] = citation_count
 							pub_field['citations'] = citations
@@ -500,10 +972,13 @@ class SkeletonPubEnricher(ABC):
 						reference_count = new_citref['reference_count']
 						# There are cases where no reference could be fetched
 						# but it should also be cached
-						self.pubC.setReferencesAndCount(source_id,_id,references,reference_count)
+						citref_list.append(((source_id,_id),references,False))
 						for pub_field in query_hash[(_id,source_id)]:
 							pub_field['reference_count'] = reference_count
 							pub_field['references'] = references
+			
+			# Cache management, the whole batch at once
+			self.pubC.setCitRefs(citref_list)
 	
 	def listReconcileCitRefMetricsBatch(self,pub_list:List[Dict[str,Any]],verbosityLevel:float=0,mode:int=3) -> List[Dict[str,Any]]:
 		"""
@@ -518,24 +993,49 @@ class SkeletonPubEnricher(ABC):
 		
 		query_citations_data = []
 		query_hash = {}
+		
+		# When only the stats are returned, the cached lists are not fetched,
+		# just their counts and histograms by year
+		statsOnly = verbosityLevel > -1 and verbosityLevel<=0
+		
+		# All the cache lookups are done in bulk, before the loop
+		qual_ids = [ (pub_field['source'],pub_field['id'])  for pub_field in pub_list  if pub_field.get('id') is not None ]
+		getCitRefsBulk = self.pubC.getCitRefsSummaryBulk  if statsOnly  else self.pubC.getCitRefsBulk
+		citations_hash = getCitRefsBulk(qual_ids,True)  if qual_ids and (mode & 2) != 0  else {}
+		references_hash = getCitRefsBulk(qual_ids,False)  if qual_ids and (mode & 1) != 0  else {}
+		
 		for pub_field in pub_list:
 			_id = pub_field.get('id') #11932250
 			if _id is not None:
 				source_id = pub_field['source']
 				
 				if ( mode & 2 ) != 0:
-					citations, citation_count = self.pubC.getCitationsAndCount(source_id,_id)
-					if citation_count is not None:
-						# Save now
-						pub_field['citation_count'] = citation_count
-						pub_field['citations'] = citations
+					citations = citations_hash.get((source_id,_id))
+					if statsOnly:
+						citation_count = citations[0]  if citations is not None  else None
+						if citation_count is not None:
+							pub_field['citation_count'] = citation_count
+							pub_field['citation_stats'] = citations[1]
+					else:
+						citation_count = len(citations)  if citations is not None  else None
+						if citation_count is not None:
+							# Save now
+							pub_field['citation_count'] = citation_count
+							pub_field['citations'] = citations
 
 				if ( mode & 1 ) != 0:
-					references, reference_count = self.pubC.getReferencesAndCount(source_id,_id)
-					if reference_count is not None:
-						# Save now
-						pub_field['reference_count'] = reference_count
-						pub_field['references'] = references
+					references = references_hash.get((source_id,_id))
+					if statsOnly:
+						reference_count = references[0]  if references is not None  else None
+						if reference_count is not None:
+							pub_field['reference_count'] = reference_count
+							pub_field['reference_stats'] = references[1]
+					else:
+						reference_count = len(references)  if references is not None  else None
+						if reference_count is not None:
+							# Save now
+							pub_field['reference_count'] = reference_count
+							pub_field['references'] = references
 				
 				# Query later, without repetitions
 				if ((mode & 2) != 0 and (citation_count is None)) or ((mode & 1) != 0 and (reference_count is None)):
@@ -549,14 +1049,15 @@ class SkeletonPubEnricher(ABC):
 		self.clusteredSearchCitRefsBatch(query_citations_data,query_hash,minimal,mode)
 		
 		# If we have to return the digested stats, compute them here
-		if verbosityLevel > -1 and verbosityLevel<=0:
+		if statsOnly:
 			for pub_field in pub_list:
-				if (mode & 2) != 0:
+				# Those from the cache already have their stats
+				if (mode & 2) != 0 and ('citations' in pub_field or 'citation_stats' not in pub_field):
 					citations = pub_field.pop('citations',None)
 					# Computing the stats
 					pub_field['citation_stats'] = None  if citations is None else self._citrefStats(citations)
 				
-				if (mode & 1) != 0:
+				if (mode & 1) != 0 and ('references' in pub_field or 'reference_stats' not in pub_field):
 					references = pub_field.pop('references',None)
 					# Computing the stats
 					pub_field['reference_stats'] = None  if references is None else self._citrefStats(references)
@@ -587,7 +1088,7 @@ class SkeletonPubEnricher(ABC):
 			#			self.populatePubIds(references)
 			
 			if populables:
-				self.populatePubIds(populables)
+				self.populatePubIds(populables,fields=self.LISTING_FIELDS)
 			
 			if nextLevelPop:
 				self.listReconcileCitRefMetricsBatch(nextLevelPop,verbosityLevel-1,mode)
@@ -689,17 +1190,7 @@ class SkeletonPubEnricher(ABC):
 	
 	def _citrefStats(self,citrefs:Iterator[Dict[str,Any]]) -> List[Dict[str,Any]]:
 		# Computing the stats
-		citref_stats = {}
-		for citref in citrefs:
-			year = citref.get('year',-1)
-			if year is None:
-				year = -1
-			if year in citref_stats:
-				citref_stats[year] += 1
-			else:
-				citref_stats[year] = 1
-		
-		return [ {'year':year,'count':citref_stats[year]} for year in sorted(citref_stats.keys()) ]
+		return citref_year_stats(citrefs)
 	
 	def flattenPubs(self,opeb_entries:List[Dict[str,Any]]) -> None:
 		"""
@@ -787,25 +1278,56 @@ class SkeletonPubEnricher(ABC):
 	def populatePubIdsBatch(self,partial_mappings:List[Dict[str,Any]]) -> None:
 		pass
 	
-	def populatePubIds(self,partial_mappings:List[Dict[str,Any]],onlyYear:bool=False) -> None:
+	# The fields needed to annotate the listed publications,
+	# which the partial mappings from the lists usually have
+	LISTING_FIELDS = ('title','journal','year','authors')
+	
+	def populatePubIds(self,partial_mappings:List[Dict[str,Any]],onlyYear:bool=False,fields:Tuple[str]=None) -> None:
+		"""
+			When the needed fields are given, the cached partial mappings
+			having all of them are used, instead of searching the whole ones
+		"""
 		populable_mappings = []
 		
-		for partial_mapping in partial_mappings:
-			# We are interested only in the year facet
-			# as it is a kind of indicator
-			pubYear = partial_mapping.get('year')
-			_id = partial_mapping.get('id')
-			# There can be corrupted or incomplete entries
-			# in the source
-			source_id = partial_mapping.get('source')
-			if _id is not None and source_id is not None and (pubYear is None or not onlyYear):
-				mapping = self.pubC.getCachedMapping(source_id,_id)
-				
-				# Not found or expired mapping?
-				if mapping is None:
-					populable_mappings.append(partial_mapping)
+		# We are interested only in the year facet
+		# as it is a kind of indicator.
+		# There can be corrupted or incomplete entries
+		# in the source
+		cacheable_mappings = list(filter(lambda p_m: p_m.get('id') is not None and p_m.get('source') is not None and (p_m.get('year') is None or not onlyYear), partial_mappings))
+		
+		# The known years are enough, without the whole mappings
+		if onlyYear and cacheable_mappings:
+			years_hash = self.pubC.getYearsBulk(map(lambda p_m: (p_m['source'],p_m['id']), cacheable_mappings))
+			unknown_year_mappings = []
+			for partial_mapping in cacheable_mappings:
+				year = years_hash.get((partial_mapping['source'],partial_mapping['id']))
+				if year is None:
+					unknown_year_mappings.append(partial_mapping)
 				else:
-					self.populateMapping(mapping,partial_mapping,onlyYear)
+					partial_mapping['year'] = year
+			cacheable_mappings = unknown_year_mappings
+		
+		cached_mappings_hash = self.pubC.getCachedMappingsBulk(map(lambda p_m: (p_m['source'],p_m['id']), cacheable_mappings))  if cacheable_mappings  else {}
+		
+		for partial_mapping in cacheable_mappings:
+			mapping = cached_mappings_hash.get((partial_mapping['source'],partial_mapping['id']))
+			
+			# Not found or expired mapping?
+			if mapping is None:
+				populable_mappings.append(partial_mapping)
+			else:
+				self.populateMapping(mapping,partial_mapping,onlyYear)
+		
+		if fields is not None and len(populable_mappings) > 0:
+			partials_hash = self.pubC.getPartialMappingsBulk(map(lambda p_m: (p_m['source'],p_m['id']), populable_mappings))
+			unknown_field_mappings = []
+			for partial_mapping in populable_mappings:
+				cached_partial = partials_hash.get((partial_mapping['source'],partial_mapping['id']))
+				if cached_partial is not None and all(field in cached_partial  for field in fields):
+					self.populateMapping(cached_partial,partial_mapping,onlyYear)
+				else:
+					unknown_field_mappings.append(partial_mapping)
+			populable_mappings = unknown_field_mappings
 		
 		if len(populable_mappings) > 0:
 			for start in range(0,len(populable_mappings),self.step_size):
@@ -813,12 +1335,16 @@ class SkeletonPubEnricher(ABC):
 				populable_mappings_slice = populable_mappings[start:stop]
 				populable_mappings_clone_slice = list(map(lambda p_m: { 'id': p_m['id'], 'source': p_m['source'] } , populable_mappings_slice))
 				self.populatePubIdsBatch(populable_mappings_clone_slice)
-			
+				
+				cacheable_mappings_slice = []
 				for p_m,p_m_c in zip(populable_mappings_slice,populable_mappings_clone_slice):
 					# It is a kind of indicator the 'year' flag
 					if p_m_c.get('year') is not None:
-						self.pubC.setCachedMapping(p_m_c)
+						cacheable_mappings_slice.append(p_m_c)
 						self.populateMapping(p_m_c,p_m,onlyYear)
+				
+				# Cache management, the whole batch at once
+				self.pubC.setCachedMappings(cacheable_mappings_slice)
 	
 	KEEP_REFS_KEYS=('source', 'id', 'base_pubs')
 	def _tidyCitRefRefs(self,citrefs:List[Dict[str,Any]]) -> List[Dict[str,Any]]:
@@ -964,8 +1490,9 @@ class SkeletonPubEnricher(ABC):
 				# This unlinks the input from the output
 				unique_to_ref_populate_slice = copy.deepcopy(unique_to_ref_populate[start:stop])
 				
-				# Obtaining the publication data
-				self.populatePubIds(unique_to_ref_populate_slice)
+				# Obtaining the publication data. The last level ones
+				# are only annotated, as their lists are not followed
+				self.populatePubIds(unique_to_ref_populate_slice,fields=None  if not_last  else self.LISTING_FIELDS)
 				
 				# The list of ONLY references to dig in later (as soft as possible)
 				self.listReconcileRefMetricsBatch(unique_to_ref_populate_slice,-1)
@@ -1014,9 +1541,12 @@ class SkeletonPubEnricher(ABC):
 			parameter as input
 		"""
 		
+		if self.prefetch_pub_ids:
+			self.prefetchPubIds(entries)
+		
 		# As flat format is so different from the previous ones, use a separate codepath
 		if results_format == "flat":
-			return self.reconcilePubIdsFlatFormat(entries,results_path,verbosityLevel)
+			retval = self.reconcilePubIdsFlatFormat(entries,results_path,verbosityLevel)
 		else:
 			#print(len(fetchedEntries))
 			#print(json.dumps(fetchedEntries,indent=4))
@@ -1062,5 +1592,17 @@ class SkeletonPubEnricher(ABC):
 				manifest_file = os.path.join(results_path,'manifest.json')
 				with open(manifest_file,mode="w",encoding="utf-8") as manifile:
 					manifile.write(self.je.encode({'@timestamp': datetime.datetime.now().isoformat(), 'results': saved_results}))
+			
+			retval = entries
 		
-		return entries
+		# The output is already written, so the stale entries
+		# are renewed without delaying it
+		try:
+			self.revalidateStale()
+		except Exception as anyEx:
+			print("ERROR: Stale entries could not be revalidated",file=sys.stderr)
+			print(anyEx,file=sys.stderr)
+		
+		self.reportCacheStats(results_path,results_format)
+		
+		return retval
@@ -58,6 +58,13 @@ class WikidataEnricher(AbstractPubEnricher):
 	def Name(cls) -> str:
 		return cls.WIKIDATA_SOURCE
 	
+	# The id query, and the population of the found ones
+	PUB_IDS_REQUESTS_PER_BATCH = 2
+	
+	def estimateCitRefsRequests(self,citref_counts:List[Dict[bool,int]]) -> int:
+		# One query for the references and another for the citations
+		return ((len(citref_counts) + self.wikidata_step_size - 1) // self.wikidata_step_size) * 2
+	
 	def _retriableSPARQLQuery(self,theQuery,theDelay:float = None) -> dict:
 		if self._debug:
 			print("[{}] {}".format(datetime.datetime.now().isoformat(),theQuery),file=sys.stderr)
@@ -15,6 +15,19 @@ from libs.opeb_queries import OpenEBenchQueries
 from libs.europepmc_enricher import EuropePMCEnricher
 from libs.meta_pub_enricher import MetaEnricher, DEFAULT_BACKEND, RECOGNIZED_BACKENDS_HASH
 
+def print_plan(plan):
+	totals = {}
+	print("backend\tlevel\tstage\tcached\texpired\tmissing\trequests\tseconds")
+	for row in plan:
+		print("{}\t{}\t{}\t{}\t{}\t{}\t{}\t{:.1f}".format(row['backend'],row['level'],row['stage'],row['cached'],row['expired'],row['missing'],row['requests'],row['seconds']))
+		backend_totals = totals.setdefault(row['backend'],[0, 0.0])
+		backend_totals[0] += row['requests']
+		backend_totals[1] += row['seconds']
+	
+	for backend, (num_requests, seconds) in totals.items():
+		print("* {}: {} requests, at least {:.1f}s".format(backend,num_requests,seconds))
+	sys.stdout.flush()
+
 #############
 # Main code #
 #############
@@ -29,7 +42,10 @@ if __name__ == "__main__":
 	parser.add_argument("--save-opeb", help="Save the OpenEBench content to a file", nargs=1, dest="save_opeb_filename")
 	parser.add_argument("--use-opeb", help="Use the OpenEBench content from a file instead of network", nargs=1, dest="load_opeb_filename")
 	
-	dof_group = parser.add_mutually_exclusive_group(required=True)
+	parser.add_argument("--refresh", help="Only renew the cached entries closest to expiry, within the hourly request budget. Meant to be run hourly", action="store_true", default=False)
+	parser.add_argument("--plan-only", help="Only estimate, from the current cache contents, the requests needed by each backend, without querying them nor writing results", action="store_true", dest="plan_only", default=False)
+	
+	dof_group = parser.add_mutually_exclusive_group()
 	dof_group.add_argument("-D", "--directory", help="Store each separated result in the given directory", nargs=1, dest="results_dir")
 	dof_group.add_argument("-f", "--file", help="The results file, in JSON format", nargs=1, dest="results_file")
 	dof_group.add_argument("-p", "--path", help="The path to the results. Depending on the format, it may be a file or a directory", nargs=1, dest="results_path")
@@ -39,9 +55,14 @@ if __name__ == "__main__":
 	parser.add_argument("cacheDir", help="The optional cache directory, to be reused", nargs="?", default=os.path.join(os.getcwd(), "cacheDir"))
 	args = parser.parse_args()
 	
+	if not args.plan_only and not args.refresh and args.results_dir is None and args.results_file is None and args.results_path is None:
+		parser.error("one of the arguments -D/--directory -f/--file -p/--path is required")
+	
 	# Now, let's work!
 	verbosity_level = args.verbosity_level
 	
+	results_path = None
+	results_format = None
 	if args.results_path is not None:
 		results_path = args.results_path[0]
 		results_format = args.results_format[0]
@@ -83,10 +104,21 @@ if __name__ == "__main__":
 	
 	# Creating the cache directory, in case it does not exist
 	os.makedirs(os.path.abspath(cache_dir), exist_ok=True)
-	if results_format != "single":
+	if results_path is not None and results_format != "single":
 		os.makedirs(os.path.abspath(results_path), exist_ok=True)
 	
+	if args.plan_only and load_opeb_filename is None:
+		print("WARNING: The plan needs the tools from OpenEBench, which are going to be fetched. Use --use-opeb to avoid it", file=sys.stderr)
+	
 	ChosenEnricher = RECOGNIZED_BACKENDS_HASH.get(args.backend, DEFAULT_BACKEND)
+	if args.refresh:
+		with ChosenEnricher(cache_dir, config=config, debug=debug) as pub:
+			print("[{}] Refreshing the {} cache".format(datetime.datetime.now().isoformat(),args.backend))
+			sys.stdout.flush()
+			pub.refreshCache()
+			print("[{}] Finished!".format(datetime.datetime.now().isoformat()))
+		sys.exit(0)
+	
 	with ChosenEnricher(cache_dir, config=config, debug=debug) as pub:
 		# Step 1: fetch the entries with associated pubmed
 		opeb_q = OpenEBenchQueries(load_opeb_filename, save_opeb_filename)
@@ -95,6 +127,12 @@ if __name__ == "__main__":
 		# Step 2: reconcile the DOI <-> PubMed id of the entries
 		
 		try:
+			if args.plan_only:
+				print("[{}] Number of tools to plan: {}".format(datetime.datetime.now().isoformat(),len(fetchedEntries)))
+				sys.stdout.flush()
+				print_plan(pub.planCosts(fetchedEntries, verbosityLevel=verbosity_level))
+				sys.exit(0)
+			
 			print("[{}] Output format: {} Path: {}".format(datetime.datetime.now().isoformat(),results_format, results_path))
 			print("[{}] Number of tools to query about: {}".format(datetime.datetime.now().isoformat(),len(fetchedEntries)))
 			sys.stdout.flush()
@@ -0,0 +1,135 @@
+#!/usr/bin/python
+
+import sys
+import os
+import datetime
+import glob
+import configparser
+
+import argparse
+
+from libs.pub_common import DEFAULT_BATCH_SIZE, parse_snapshot_timestamp
+from libs.pub_cache import PubDBCache
+from libs.doi_cache import DOIChecker
+
+def _human_bytes(num_bytes):
+	if num_bytes is None:
+		return 'n/a'
+	
+	for unit in ('B','KiB','MiB','GiB'):
+		if num_bytes < 1024:
+			break
+		num_bytes /= 1024
+	else:
+		unit = 'TiB'
+	
+	return "{:.1f} {}".format(num_bytes,unit)
+
+def print_report(report):
+	for table_stats in report:
+		print("\t{}: {} rows ({} expired), {} data, {} indexes".format(table_stats['table'],table_stats['rows'],table_stats['expired'],_human_bytes(table_stats['data_bytes']),_human_bytes(table_stats['index_bytes'])))
+		if table_stats['ages'] is not None:
+			print("\t\tBy age: " + ', '.join("{}: {}".format(bucket_label,count)  for bucket_label, count in table_stats['ages']))
+
+def maintain(cache,cache_filename,args):
+	print("[{}] {}".format(datetime.datetime.now().isoformat(),cache_filename))
+	sys.stdout.flush()
+	
+	if not args.report_only:
+		deleted = cache.sweepExpired(batch_size=args.batch_size,verbose=args.verbose)
+		print("\tExpired rows removed: " + ', '.join("{}: {}".format(table_name,num_deleted)  for table_name, num_deleted in deleted.items()))
+		
+		incremental = cache.optimize(full_vacuum=args.full_vacuum)
+		if not incremental:
+			print("\tWARNING: incremental vacuum is not enabled in this database. Run once with --full-vacuum to enable it")
+	
+	print_report(cache.getTableReport())
+	
+	if args.explain:
+		for label, details, full_scan in cache.explainQueryPlans():
+			print("\t{} {}: {}".format('SCAN' if full_scan else 'ok  ',label,'; '.join(details)))
+	
+	sys.stdout.flush()
+
+SNAPSHOT_SUFFIX = '.jsonl.gz'
+
+def export_snapshot(cache,cache_db_file,args):
+	snapshot_file = os.path.join(args.export_dir,os.path.basename(cache_db_file) + SNAPSHOT_SUFFIX)
+	counts = cache.exportSnapshot(snapshot_file,since=args.since)
+	print("\tExported to {}: ".format(snapshot_file) + (', '.join("{}: {}".format(table_name,num_rows)  for table_name, num_rows in counts.items())  or 'nothing'))
+	sys.stdout.flush()
+
+def import_snapshots(cache,cache_db_file,args):
+	for import_dir in args.import_dirs:
+		snapshot_file = os.path.join(import_dir,os.path.basename(cache_db_file) + SNAPSHOT_SUFFIX)
+		if os.path.exists(snapshot_file):
+			counts = cache.importSnapshot(snapshot_file)
+			print("\tMerged {}: ".format(snapshot_file) + ', '.join("{}: {}".format(table_name,num_rows)  for table_name, num_rows in counts.items()))
+			sys.stdout.flush()
+
+#############
+# Main code #
+#############
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Maintenance of the cache databases, to be run between enrichment runs")
+	parser.add_argument("--report-only", help="Only report the cache contents, without sweeping nor vacuuming", action="store_true", dest="report_only", default=False)
+	parser.add_argument("--full-vacuum", help="Rebuild the databases, enabling incremental vacuum in the ones created without it", action="store_true", dest="full_vacuum", default=False)
+	parser.add_argument("--batch-size", help="Number of rows visited on each committed batch of the expiry sweep", type=int, dest="batch_size", default=DEFAULT_BATCH_SIZE)
+	parser.add_argument("--explain", help="Show the query plans of the hot queries, telling the ones doing full scans", action="store_true", default=False)
+	parser.add_argument("-C", "--config", help="Config file of the enrichment runs, where the time to live of the cached entries is set", nargs=1, dest="config_filename")
+	parser.add_argument("--export", help="Export a snapshot of each cache database to this directory, instead of the maintenance", dest="export_dir")
+	parser.add_argument("--since", help="Only export the entries fetched since this ISO timestamp (UTC), for incremental snapshots", dest="since")
+	parser.add_argument("--import", help="Merge the snapshots from this directory into the caches (newest entries win), instead of the maintenance. It can be repeated", action="append", dest="import_dirs")
+	parser.add_argument("-v", "--verbose", help="Show the progress of the expiry sweep", action="store_true", default=False)
+	
+	parser.add_argument("cacheDir", help="The cache directory", nargs="?", default=os.path.join(os.getcwd(), "cacheDir"))
+	args = parser.parse_args()
+	
+	cache_dir = args.cacheDir
+	if args.import_dirs:
+		# New nodes start from the snapshots
+		os.makedirs(cache_dir,exist_ok=True)
+	elif not os.path.isdir(cache_dir):
+		print("ERROR: Cache directory {} does not exist".format(cache_dir), file=sys.stderr)
+		sys.exit(1)
+	
+	if args.since is not None:
+		args.since = parse_snapshot_timestamp(args.since)
+	
+	# The databases to be processed, and what to do with them
+	cache_db_basenames = set(map(os.path.basename,glob.glob(os.path.join(cache_dir,'*' + PubDBCache.DEFAULT_CACHE_DB_FILE))))
+	if args.export_dir is not None:
+		os.makedirs(args.export_dir,exist_ok=True)
+		action = export_snapshot
+		print("* Exporting {}. Use --since {} on the next incremental export".format("the entries fetched since " + args.since.isoformat()  if args.since is not None  else "whole snapshots",datetime.datetime.utcnow().isoformat()))
+	elif args.import_dirs:
+		for import_dir in args.import_dirs:
+			cache_db_basenames.update(os.path.basename(snapshot_file)[:-len(SNAPSHOT_SUFFIX)]  for snapshot_file in glob.glob(os.path.join(import_dir,'*' + PubDBCache.DEFAULT_CACHE_DB_FILE + SNAPSHOT_SUFFIX)))
+		action = import_snapshots
+	else:
+		action = maintain
+	
+	config = configparser.ConfigParser()
+	if args.config_filename is not None:
+		config.read(args.config_filename[0])
+	
+	doi_checker = DOIChecker(cache_dir)
+	if os.path.exists(doi_checker.check_db_file) or (args.import_dirs and any(os.path.exists(os.path.join(import_dir,DOIChecker.DEFAULT_CHECK_DB_FILE + SNAPSHOT_SUFFIX))  for import_dir in args.import_dirs)):
+		with doi_checker:
+			action(doi_checker,doi_checker.check_db_file,args)
+	
+	for cache_db_basename in sorted(cache_db_basenames):
+		cache_db_file = os.path.join(cache_dir,cache_db_basename)
+		prefix = cache_db_basename[:-len(PubDBCache.DEFAULT_CACHE_DB_FILE)]
+		# The last component of the prefix with a configuration
+		# section tells the enricher, and so its time to live values
+		section_name = configparser.DEFAULTSECT
+		for prefix_part in reversed(prefix.rstrip('_').split('_')):
+			if config.has_section(prefix_part):
+				section_name = prefix_part
+				break
+		
+		# The enricher name is not used by the maintenance
+		with PubDBCache(prefix.rstrip('_'),cache_dir=cache_dir,prefix=prefix,doi_checker=doi_checker,lru_size=0,ttl_days=PubDBCache.TTLDaysFromConfig(config,section_name)) as pubC:
+			action(pubC,cache_db_file,args)
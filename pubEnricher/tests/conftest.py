@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The libs package is imported from the pubEnricher directory
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,80 @@
+import configparser
+import json
+
+import pytest
+
+from libs.europepmc_enricher import EuropePMCEnricher
+
+LISTING = [
+	{'id': str(1000 + i), 'source': 'MED', 'pubYear': str(2000 + i), 'title': 'T{}'.format(i), 'authorString': 'Doe J, Roe R.', 'journalAbbreviation': 'J Abbr'}
+	for i in range(5)
+] + [{'id': None, 'source': None, 'pubYear': None}]
+
+class FakeEuropePMC(EuropePMCEnricher):
+	"""
+		EuropePMC with a canned listing, and no search results
+	"""
+	def retriable_full_http_read(self,req,debug_url=None):
+		self.urls.append(req.full_url)
+		if 'search' in req.full_url:
+			return json.dumps({'resultList': {'result': []}}).encode()
+		
+		parts = req.full_url.split('/')
+		page = int(parts[-3])
+		size = int(parts[-2])
+		chunk = LISTING[(page-1)*size:page*size]
+		return json.dumps({'hitCount': len(LISTING), 'citationList': {'citation': chunk}}).encode()
+
+def _enricher(tmp_path,extra_config=""):
+	config = configparser.ConfigParser()
+	config.read_string("[europepmc]\nrequest_delay=0\ncitref_step_size=4\n" + extra_config)
+	enricher = FakeEuropePMC(str(tmp_path),config=config)
+	enricher.urls = []
+	return enricher
+
+QUAL_IDS = [ ('MED',citref['id'])  for citref in LISTING  if citref['id'] is not None ]
+
+def _list(enricher):
+	query_hash = {('1','MED'): [{'id': '1', 'source': 'MED'}]}
+	enricher.clusteredSearchCitRefsBatch([{'id': '1', 'source': 'MED'}],query_hash,False,2)
+	enricher.pubC.sync()
+
+def test_listed_publications_are_partial_mappings(tmp_path):
+	with _enricher(tmp_path) as enricher:
+		_list(enricher)
+		
+		# The listings lack the DOIs, so they are not mappings
+		assert enricher.pubC.getCachedMappingsBulk(QUAL_IDS) == {}
+		assert enricher.pubC.getSourceIds('1000') == []
+		partials_hash = enricher.pubC.getPartialMappingsBulk(QUAL_IDS)
+		assert partials_hash[('MED','1000')] == {'id': '1000', 'source': 'MED', 'year': 2000, 'title': 'T0', 'journal': 'J Abbr', 'authors': ['Doe J', 'Roe R'], 'pmid': '1000'}
+		assert len(partials_hash) == len(QUAL_IDS)
+		
+		# The years are enough for the year lookups
+		enricher.urls.clear()
+		partial_mappings = [ {'id': _id, 'source': source_id}  for source_id, _id in QUAL_IDS ]
+		enricher.populatePubIds(partial_mappings,onlyYear=True)
+		assert enricher.urls == []
+		assert [ partial_mapping['year']  for partial_mapping in partial_mappings ] == [2000, 2001, 2002, 2003, 2004]
+		
+		# and the partial mappings for the listing fields
+		partial_mappings = [ {'id': _id, 'source': source_id}  for source_id, _id in QUAL_IDS ]
+		enricher.populatePubIds(partial_mappings,fields=enricher.LISTING_FIELDS)
+		assert enricher.urls == []
+		assert partial_mappings[1]['title'] == 'T1'
+		assert 'doi' not in partial_mappings[1]
+		
+		# but the whole metadata is still searched
+		enricher.populatePubIds([{'id': '1000', 'source': 'MED'}])
+		assert len(enricher.urls) == 1
+		enricher.populatePubIds([{'id': '1000', 'source': 'MED'}],fields=('title','doi'))
+		assert len(enricher.urls) == 2
+
+def test_partial_mappings_can_be_disabled(tmp_path):
+	with _enricher(tmp_path,"citref_partial_mappings=false\n") as enricher:
+		_list(enricher)
+		assert enricher.pubC.getPartialMappingsBulk(QUAL_IDS) == {}
+		
+		enricher.urls.clear()
+		enricher.populatePubIds([{'id': '1000', 'source': 'MED'}],fields=enricher.LISTING_FIELDS)
+		assert len(enricher.urls) == 1
@@ -0,0 +1,40 @@
+import datetime
+
+import pytest
+
+from libs.doi_cache import DOIChecker
+
+@pytest.fixture
+def checker(tmp_path,monkeypatch):
+	resolved = {'10.1000/ABC', '10.1000/DOT.'}
+	asked = []
+	def resolveDOI(doi):
+		asked.append(doi)
+		return {'doi': doi, 'responseCode': 1  if doi in resolved  else 100, 'handle': doi}
+	
+	with DOIChecker(str(tmp_path),pos_cache_days=30,neg_cache_days=2) as checker:
+		monkeypatch.setattr(checker,'resolveDOI',resolveDOI)
+		checker.asked = asked
+		yield checker
+
+def _valid_days(checker,doi):
+	valid_until, _ = checker.getRawCachedResolution(doi)
+	return (valid_until - datetime.datetime.now(datetime.timezone.utc)).total_seconds() / 86400
+
+def test_resolved_doi_is_cached(checker):
+	assert checker.check_normalize_doi('doi:10.1000/abc') == '10.1000/ABC'
+	assert checker.check_normalize_doi('https://doi.org/10.1000/abc') == '10.1000/ABC'
+	assert checker.asked == ['10.1000/ABC']
+	assert 29.9 < _valid_days(checker,'10.1000/ABC') <= 30
+
+def test_unresolved_doi_uses_negative_ttl(checker):
+	assert checker.check_normalize_doi('10.1000/missing') is None
+	assert checker.check_normalize_doi('10.1000/missing') is None
+	# Both forms are tried only once
+	assert checker.asked == ['10.1000/MISSING', '10.1000/MISSING.']
+	assert 1.9 < _valid_days(checker,'10.1000/MISSING') <= 2
+
+def test_alternate_form(checker):
+	assert checker.check_normalize_doi('10.1000/dot') == '10.1000/DOT.'
+	assert checker.check_normalize_doi('10.1000/dot.') == '10.1000/DOT.'
+	assert checker.asked == ['10.1000/DOT', '10.1000/DOT.']
@@ -0,0 +1,45 @@
+import datetime
+
+from libs.pub_common import Timestamps
+from libs.pub_cache import PubDBCache
+
+NOW = Timestamps.UTCTimestamp(datetime.datetime.utcnow())
+
+def test_sweep_expired_by_kind(tmp_path):
+	ttl_days = {'mapping': 10, 'citations': 10, 'references': 100, 'idmap': 10, 'negative': 1, 'year': 10, 'partial': 10}
+	old = NOW - datetime.timedelta(days=20)
+	long_list = [ {'id': str(i), 'source': 'MED', 'year': 2000}  for i in range(PubDBCache.CITREF_PAGE_SIZE + 1) ]
+	with PubDBCache('europepmc',str(tmp_path),ttl_days=ttl_days,lru_size=0) as cache:
+		cache.setCachedMappings([{'id': '1', 'source': 'MED', 'pmid': '1'}],old)
+		cache.setCachedMappings([{'id': '2', 'source': 'MED', 'pmid': '2'}],NOW)
+		# The expired citations take their pages with them, but
+		# the references of the same age are still valid
+		cache.setCitRefs([(('MED','1'),long_list,True),(('MED','1'),long_list,False)],old)
+		cache.setNegativeIds(['pmid:3'],old)
+		cache.setPartialMappings([{'id': '4', 'source': 'MED', 'year': 2000}],old)
+		
+		deleted = cache.sweepExpired(batch_size=1)
+		assert deleted['pub'] == 1
+		assert deleted['idmap'] == 1
+		assert deleted['citref'] == 1
+		assert deleted['citref_page'] > 0
+		assert deleted['negative_id'] == 1
+		assert deleted['pub_year'] == len(long_list)
+		assert deleted['pub_partial'] == 1
+		
+		assert cache.getCachedMappingsBulk([('MED','1'),('MED','2')]) == {('MED','2'): {'id': '2', 'source': 'MED', 'pmid': '2'}}
+		assert cache.getCitRefsBulk([('MED','1')],True) == {}
+		assert cache.getCitRefsBulk([('MED','1')],False) == {('MED','1'): long_list}
+		
+		report = { table['table']: table  for table in cache.getTableReport() }
+		assert report['pub']['rows'] == 1
+		assert report['pub']['expired'] == 0
+
+def test_sweep_expired_commits_the_queued_writes(tmp_path):
+	old = NOW - datetime.timedelta(days=20)
+	with PubDBCache('europepmc',str(tmp_path),ttl_days={'mapping': 10, 'idmap': 10, 'year': 10},lru_size=0,write_behind=True,write_behind_interval=0.5) as cache:
+		cache.setCachedMappings([{'id': '1', 'source': 'MED', 'pmid': '1', 'year': 2000}],old)
+		# Still queued, but swept
+		deleted = cache.sweepExpired()
+		assert (deleted['pub'], deleted['idmap'], deleted['pub_year']) == (1, 1, 1)
+		assert cache.getRawCachedMappingsBulk_TL([('MED','1')]) == {}
@@ -0,0 +1,67 @@
+import configparser
+
+import pytest
+
+from libs.skeleton_pub_enricher import SkeletonPubEnricher
+
+class FakeEnricher(SkeletonPubEnricher):
+	"""
+		Backend which only knows some pmids, and never echoes DOIs
+	"""
+	known_pmids = {'1', '2'}
+	
+	@classmethod
+	def Name(cls):
+		return 'fake'
+	
+	def queryPubIdsBatch(self,query_ids):
+		self.queries.append(query_ids)
+		if self.failing:
+			raise IOError('Transient failure')
+		return [
+			{'id': query_id['pmid'], 'source': 'MED', 'pmid': query_id['pmid'], 'doi': None, 'pmcid': None}
+			for query_id in query_ids
+			if query_id.get('pmid') in self.known_pmids
+		]
+	
+	def queryCitRefsBatch(self,query_citations_data,minimal=False,mode=3):
+		raise NotImplementedError()
+	
+	def populatePubIdsBatch(self,partial_mappings):
+		raise NotImplementedError()
+
+@pytest.fixture
+def enricher(tmp_path):
+	config = configparser.ConfigParser()
+	config.read_string("[DEFAULT]\nstep_size=10\n")
+	with FakeEnricher(str(tmp_path),config=config) as enricher:
+		enricher.queries = []
+		enricher.failing = False
+		yield enricher
+
+def test_ids_of_resolved_publications_are_not_negative(enricher):
+	enricher.cachedQueryPubIds([{'pmid': '1', 'doi': '10.1000/one'},{'pmid': '3', 'doi': '10.1000/three'}])
+	assert enricher.pubC.getNegativeIdsBulk(['1','10.1000/ONE','3','10.1000/THREE']) == {'3','10.1000/THREE'}
+
+def test_ids_of_publications_resolved_from_the_cache_are_not_negative(enricher):
+	enricher.cachedQueryPubIds([{'pmid': '2'}])
+	# Only the DOI is asked, as the pmid is cached
+	enricher.cachedQueryPubIds([{'pmid': '2', 'doi': '10.1000/two'},{'pmid': '3'},{'pmid': '1'}])
+	assert enricher.queries[-1] == [{'doi': '10.1000/TWO'},{'pmid': '3'},{'pmid': '1'}]
+	assert enricher.pubC.getNegativeIdsBulk(['10.1000/TWO','3','1']) == {'3'}
+
+def test_reconcile_ids_of_resolved_publications_are_not_negative(enricher):
+	enricher.cachedQueryPubIds([{'pmid': '2'}])
+	entries = [{'@id': 'tool', 'entry_pubs': [{'pmid': '2', 'doi': '10.1000/two', 'found_pubs': []},{'pmid': '1', 'doi': '10.1000/one', 'found_pubs': []},{'pmid': '4', 'found_pubs': []}]}]
+	enricher.reconcilePubIdsBatch(entries)
+	assert enricher.pubC.getNegativeIdsBulk(['10.1000/TWO','1','10.1000/ONE','4']) == {'4'}
+
+def test_empty_answers_are_negative(enricher):
+	enricher.cachedQueryPubIds([{'pmid': '3'},{'pmid': '4'}])
+	assert enricher.pubC.getNegativeIdsBulk(['3','4']) == {'3','4'}
+
+def test_failed_queries_are_not_negative(enricher):
+	enricher.failing = True
+	with pytest.raises(IOError):
+		enricher.cachedQueryPubIds([{'pmid': '1'},{'pmid': '3'}])
+	assert enricher.pubC.getNegativeIdsBulk(['1','3']) == set()
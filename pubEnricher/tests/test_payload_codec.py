@@ -0,0 +1,129 @@
+import configparser
+import sqlite3
+import sys
+import zlib
+
+import pytest
+
+from libs.doi_cache import DOIChecker
+from libs.payload_codec import PayloadCodec
+from libs.pub_cache import PubDBCache
+
+MAPPING = {
+	'id': '11932250',
+	'title': 'A title with unicode: áéí',
+	'journal': 'Journal',
+	'source': 'MED',
+	'year': 2001,
+	'authors': ['Doe J', 'Roe R'],
+	'pmid': '11932250',
+	'doi': '10.1093/bioinformatics/18.2.207',
+	'pmcid': None,
+}
+
+CITREF_LISTS = [
+	[],
+	[{'id': '1', 'source': 'MED', 'year': 2001}],
+	# Descending, repeated and huge numeric ids
+	[{'id': '30000000', 'source': 'MED', 'year': 2019},{'id': '12', 'source': 'MED', 'year': 1990},{'id': '12', 'source': 'MED', 'year': 1990},{'id': '999999999999999999', 'source': 'MED', 'year': 2020}],
+	# Mixed sources, string ids, missing and null years
+	[{'id': 'PMC123', 'source': 'PMC'},{'id': '42', 'source': 'MED', 'year': None},{'id': 'AGR:AGR123', 'source': 'AGR', 'year': 2005},{'id': '0042', 'source': 'MED'},{'id': '7', 'source': 'MED', 'year': 2010}],
+	# Only string ids
+	[{'id': 'PPR1', 'source': 'PPR'},{'id': 'PPR2', 'source': 'PPR', 'year': 2021}],
+	[{'id': str(1000 + 3*i), 'source': 'MED', 'year': 1950 + i % 70}  for i in range(5000)],
+]
+
+# Lists which do not fit in the binary layout
+FALLBACK_LISTS = [
+	[{'id': '1', 'source': 'MED', 'year': 2001, 'extra': True}],
+	[{'id': 1, 'source': 'MED'}],
+	[{'id': '1', 'source': None}],
+	[{'id': '1', 'source': 'MED', 'year': '2001'}],
+	[{'id': '1', 'source': 'MED', 'year': 100000}],
+	[{'id': 'a\0b', 'source': 'MED'}],
+	[{'id': str(i), 'source': 'S{}'.format(i)}  for i in range(200)],
+]
+
+@pytest.mark.parametrize('codec_name',PayloadCodec.CODECS)
+def test_mapping_roundtrip(codec_name):
+	codec = PayloadCodec(codec_name)
+	assert codec.decode(codec.encode(MAPPING)) == MAPPING
+
+@pytest.mark.parametrize('citrefs',CITREF_LISTS)
+def test_binary_citrefs_roundtrip(citrefs):
+	codec = PayloadCodec()
+	payload = codec.encodeCitRefs(citrefs)
+	assert payload[0] == PayloadCodec.TAG_CITREFS
+	assert codec.decode(payload) == citrefs
+	assert codec.jd.decode(codec.decodeRaw(payload).decode('utf-8')) == citrefs
+
+@pytest.mark.parametrize('citrefs',CITREF_LISTS)
+def test_binary_citrefs_arrays(citrefs):
+	arrays = PayloadCodec().decodeCitRefsArrays(PayloadCodec().encodeCitRefs(citrefs))
+	assert list(arrays.ids) == [ citref['id']  for citref in citrefs ]
+	assert [ arrays.sources[code]  for code in arrays.source_codes ] == [ citref['source']  for citref in citrefs ]
+	assert len(arrays.years) == len(citrefs)
+
+@pytest.mark.parametrize('citrefs',CITREF_LISTS)
+def test_binary_citrefs_big_endian(monkeypatch,citrefs):
+	# Both sides swap the bytes of the arrays the same way
+	monkeypatch.setattr(sys,'byteorder','big')
+	codec = PayloadCodec()
+	assert codec.decode(codec.encodeCitRefs(citrefs)) == citrefs
+
+@pytest.mark.parametrize('citrefs',FALLBACK_LISTS)
+def test_citrefs_fallback(citrefs):
+	codec = PayloadCodec()
+	payload = codec.encodeCitRefs(citrefs)
+	assert payload[0] != PayloadCodec.TAG_CITREFS
+	assert codec.decode(payload) == citrefs
+
+def test_binary_citrefs_disabled():
+	codec = PayloadCodec(binary_citrefs=False)
+	payload = codec.encodeCitRefs(CITREF_LISTS[1])
+	assert payload[0] == PayloadCodec.TAG_DEFLATE
+	assert codec.decode(payload) == CITREF_LISTS[1]
+
+def test_legacy_payloads_are_readable():
+	raw = PayloadCodec().encodeRaw(MAPPING)
+	for codec_name in PayloadCodec.CODECS:
+		assert PayloadCodec(codec_name).decode(zlib.compress(raw,zlib.Z_BEST_COMPRESSION)) == MAPPING
+
+def test_dictionary_roundtrip():
+	conn = sqlite3.connect(':memory:',detect_types=sqlite3.PARSE_DECLTYPES)
+	cur = conn.cursor()
+	cur.execute("""CREATE TABLE pub (payload BLOB)""")
+	plain_codec = PayloadCodec(PayloadCodec.CODEC_DEFLATE)
+	mappings = [ dict(MAPPING,id=str(i),pmid=str(i),title='Title number {}'.format(i))  for i in range(PayloadCodec.ZDICT_MIN_SAMPLES * 2) ]
+	cur.executemany("""INSERT INTO pub(payload) VALUES(?)""",[ (plain_codec.encode(mapping),)  for mapping in mappings ])
+	# Binary citref lists are skipped on training
+	cur.execute("""INSERT INTO pub(payload) VALUES(?)""",(plain_codec.encodeCitRefs(CITREF_LISTS[2]),))
+	
+	codec = PayloadCodec(PayloadCodec.CODEC_ZDICT)
+	codec.initDictionaries_TL(cur)
+	assert codec.needsDictionary
+	dict_id = codec.trainDictionary_TL(cur,['pub'])
+	assert dict_id is not None and not codec.needsDictionary
+	
+	payload = codec.encode(mappings[0])
+	assert payload[0] == PayloadCodec.TAG_DEFLATE_ZDICT
+	
+	# Another instance reads it from the stored dictionaries
+	other_codec = PayloadCodec(PayloadCodec.CODEC_ZDICT)
+	other_codec.initDictionaries_TL(cur)
+	assert other_codec.decode(payload) == mappings[0]
+
+def test_unknown_codec():
+	with pytest.raises(ValueError):
+		PayloadCodec('lz4')
+
+def test_codec_from_config():
+	config = configparser.ConfigParser()
+	config.read_string("[europepmc]\ncache_codec=deflate\ncache_codec_level=3\ncache_binary_citrefs=false\ncache_ttl_doi=5\n")
+	kwargs = PubDBCache.KwargsFromConfig(config,'europepmc')
+	assert (kwargs['codec'], kwargs['codec_level'], kwargs['binary_citrefs']) == ('deflate', 3, False)
+	assert kwargs['lru_size'] == PubDBCache.DEFAULT_LRU_SIZE
+	doi_kwargs = DOIChecker.KwargsFromConfig(config,'europepmc')
+	assert (doi_kwargs['codec'], doi_kwargs['codec_level'], doi_kwargs['pos_cache_days']) == ('deflate', 3, 5)
+	# Missing sections get the defaults
+	assert PubDBCache.KwargsFromConfig(config,'pubmed')['codec'] == PayloadCodec.DEFAULT_CODEC
@@ -0,0 +1,33 @@
+import pytest
+
+from libs import pub_common
+from libs.doi_cache import DOIChecker
+from libs.pub_cache import PubDBCache
+
+@pytest.fixture
+def doi_checker(tmp_path):
+	with DOIChecker(str(tmp_path)) as checker:
+		yield checker
+
+@pytest.fixture
+def pub_cache(tmp_path,doi_checker):
+	with PubDBCache('europepmc',str(tmp_path),doi_checker=doi_checker) as cache:
+		yield cache
+
+def _assert_no_full_scan(plans):
+	assert plans
+	full_scans = [ (label, details)  for label, details, full_scan in plans  if full_scan ]
+	assert full_scans == []
+
+def test_pub_cache_hot_queries_use_indexes(pub_cache):
+	_assert_no_full_scan(pub_cache.explainQueryPlans())
+
+def test_doi_checker_hot_queries_use_indexes(doi_checker):
+	_assert_no_full_scan(doi_checker.explainQueryPlans())
+
+def test_full_scans_are_detected(pub_cache):
+	plans = pub_common.explain_query_plans(pub_cache.conn.cursor(),[
+		('pub by payload', """SELECT id FROM pub WHERE payload = :payload"""),
+		('pub by enricher', """SELECT id FROM pub WHERE enricher = :enricher"""),
+	])
+	assert [ full_scan  for _, _, full_scan in plans ] == [True, True]
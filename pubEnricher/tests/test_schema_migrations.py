@@ -0,0 +1,161 @@
+import datetime
+import json
+import os
+import sqlite3
+import zlib
+
+import pytest
+
+from libs import pub_common
+from libs.doi_cache import DOIChecker
+from libs.pub_cache import PubDBCache
+
+# The schema of the caches created before the versioned migrations
+LEGACY_PUB_SCHEMA = """
+CREATE TABLE pub (
+	enricher VARCHAR(32) NOT NULL,
+	id VARCHAR(4096) NOT NULL,
+	source VARCHAR(32) NOT NULL,
+	payload BLOB NOT NULL,
+	last_fetched TIMESTAMP NOT NULL,
+	PRIMARY KEY (enricher,id,source)
+);
+CREATE TABLE idmap (
+	pub_id VARCHAR(4096) NOT NULL,
+	enricher VARCHAR(32) NOT NULL,
+	id VARCHAR(4096) NOT NULL,
+	source VARCHAR(32) NOT NULL,
+	last_fetched TIMESTAMP NOT NULL,
+	PRIMARY KEY (pub_id,id,enricher,source)
+);
+CREATE TABLE citref (
+	enricher VARCHAR(32) NOT NULL,
+	id VARCHAR(4096) NOT NULL,
+	source VARCHAR(32) NOT NULL,
+	is_cit BOOLEAN NOT NULL,
+	payload BLOB,
+	last_fetched TIMESTAMP NOT NULL
+);
+CREATE INDEX citref_e_i_s ON citref(enricher,id,source);
+CREATE TABLE lower_map (
+	enricher VARCHAR(32) NOT NULL,
+	id VARCHAR(4096) NOT NULL,
+	source VARCHAR(32) NOT NULL,
+	lower_enricher VARCHAR(32) NOT NULL,
+	lower_id VARCHAR(4096) NOT NULL,
+	lower_source VARCHAR(32) NOT NULL,
+	last_fetched TIMESTAMP NOT NULL
+);
+CREATE INDEX lower_map_e_i_s ON lower_map(lower_enricher,lower_id,lower_source);
+"""
+
+LEGACY_DOI_SCHEMA = """
+CREATE TABLE doi_check (
+	doi VARCHAR(4096) NOT NULL,
+	payload BLOB NOT NULL,
+	valid_until TIMESTAMP NOT NULL
+);
+CREATE INDEX doi_check_doi ON doi_check(doi COLLATE NOCASE);
+"""
+
+MAPPING = {'id': '11932250', 'source': 'MED', 'title': 'A title', 'journal': 'J', 'year': 2001, 'authors': ['Doe J'], 'pmid': '11932250', 'doi': '10.1093/BIOINFORMATICS/18.2.207', 'pmcid': None}
+CITATIONS = [{'id': '1', 'source': 'MED', 'year': 2010},{'id': 'PMC2', 'source': 'PMC', 'year': 2012}]
+
+def _legacy_payload(obj):
+	return zlib.compress(json.dumps(obj).encode('utf-8'),zlib.Z_BEST_COMPRESSION)
+
+def _user_version(db_file):
+	conn = sqlite3.connect(db_file)
+	try:
+		return conn.execute("""PRAGMA user_version""").fetchone()[0]
+	finally:
+		conn.close()
+
+def _create_legacy_pub_cache(cache_dir):
+	now = datetime.datetime.utcnow()
+	older = now - datetime.timedelta(days=1)
+	conn = sqlite3.connect(os.path.join(cache_dir,PubDBCache.DEFAULT_CACHE_DB_FILE),detect_types=sqlite3.PARSE_DECLTYPES)
+	with conn:
+		conn.executescript(LEGACY_PUB_SCHEMA)
+		conn.execute("""INSERT INTO pub VALUES(?,?,?,?,?)""",('europepmc',MAPPING['id'],MAPPING['source'],_legacy_payload(MAPPING),now))
+		conn.executemany("""INSERT INTO idmap VALUES(?,?,?,?,?)""",[
+			('11932250','europepmc',MAPPING['id'],MAPPING['source'],now),
+			('10.1093/BIOINFORMATICS/18.2.207','europepmc',MAPPING['id'],MAPPING['source'],now),
+		])
+		# Duplicated rows, which the unique indexes cannot hold
+		conn.executemany("""INSERT INTO citref VALUES(?,?,?,?,?,?)""",[
+			('europepmc',MAPPING['id'],MAPPING['source'],True,_legacy_payload(CITATIONS[:1]),older),
+			('europepmc',MAPPING['id'],MAPPING['source'],True,_legacy_payload(CITATIONS),now),
+		])
+		conn.executemany("""INSERT INTO lower_map VALUES(?,?,?,?,?,?,?)""",[
+			('europepmc',MAPPING['id'],MAPPING['source'],'pubmed','11932250','pubmed',older),
+			('europepmc',MAPPING['id'],MAPPING['source'],'pubmed','11932250','pubmed',now),
+		])
+	conn.close()
+
+def test_new_pub_cache_reaches_latest_version(tmp_path):
+	with PubDBCache('europepmc',str(tmp_path)) as cache:
+		pass
+	assert _user_version(cache.cache_db_file) == len(PubDBCache.SCHEMA_MIGRATIONS)
+
+def test_legacy_pub_cache_upgrade_keeps_entries(tmp_path):
+	_create_legacy_pub_cache(str(tmp_path))
+	with PubDBCache('europepmc',str(tmp_path)) as cache:
+		assert cache.getCachedMappingsBulk([('MED','11932250')]) == {('MED','11932250'): MAPPING}
+		assert sorted(cache.getSourceIds('11932250')) == [('MED','11932250')]
+		# The newest duplicate is the one kept
+		assert cache.getCitRefsBulk([('MED','11932250')],True) == {('MED','11932250'): CITATIONS}
+		assert cache.conn.execute("""SELECT COUNT(*) FROM lower_map""").fetchone()[0] == 1
+		# Years are gathered from the upgraded rows on the next writes
+		cache.setCitRefs([(('MED','11932250'),CITATIONS,True)])
+		assert cache.getYearsBulk([('MED','1'),('PMC','PMC2')]) == {('MED','1'): 2010, ('PMC','PMC2'): 2012}
+	
+	assert _user_version(cache.cache_db_file) == len(PubDBCache.SCHEMA_MIGRATIONS)
+	for table_name in ('pub','citref','idmap','lower_map','negative_id','pub_year','pub_partial'):
+		conn = sqlite3.connect(cache.cache_db_file)
+		assert pub_common.without_rowid_key(conn,table_name) is not None
+		conn.close()
+
+@pytest.mark.parametrize('checker_class',[PubDBCache, DOIChecker])
+def test_migrations_are_idempotent(tmp_path,checker_class):
+	if checker_class is PubDBCache:
+		_create_legacy_pub_cache(str(tmp_path))
+		db_file = os.path.join(str(tmp_path),PubDBCache.DEFAULT_CACHE_DB_FILE)
+	else:
+		db_file = os.path.join(str(tmp_path),DOIChecker.DEFAULT_CHECK_DB_FILE)
+		conn = sqlite3.connect(db_file)
+		conn.executescript(LEGACY_DOI_SCHEMA)
+		conn.close()
+	
+	conn = sqlite3.connect(db_file,detect_types=sqlite3.PARSE_DECLTYPES)
+	try:
+		pub_common.upgrade_schema(conn,checker_class.SCHEMA_MIGRATIONS,db_file)
+		schema = conn.execute("""SELECT type, name, sql FROM sqlite_master ORDER BY name""").fetchall()
+		# Databases created before versioning are also at version 0
+		conn.execute("""PRAGMA user_version = 0""")
+		assert pub_common.upgrade_schema(conn,checker_class.SCHEMA_MIGRATIONS,db_file) == len(checker_class.SCHEMA_MIGRATIONS)
+		assert conn.execute("""SELECT type, name, sql FROM sqlite_master ORDER BY name""").fetchall() == schema
+	finally:
+		conn.close()
+
+def test_legacy_doi_checker_upgrade(tmp_path):
+	db_file = os.path.join(str(tmp_path),DOIChecker.DEFAULT_CHECK_DB_FILE)
+	resolution = {'doi': '10.1000/ABC', 'responseCode': 1}
+	conn = sqlite3.connect(db_file,detect_types=sqlite3.PARSE_DECLTYPES)
+	with conn:
+		conn.executescript(LEGACY_DOI_SCHEMA)
+		conn.execute("""INSERT INTO doi_check VALUES(?,?,?)""",(resolution['doi'],_legacy_payload(resolution),datetime.datetime.utcnow() + datetime.timedelta(days=1)))
+	conn.close()
+	
+	with DOIChecker(str(tmp_path)) as checker:
+		assert checker.getCachedResolution('10.1000/abc') == resolution
+	assert _user_version(db_file) == len(DOIChecker.SCHEMA_MIGRATIONS)
+
+def test_newer_schema_is_rejected(tmp_path):
+	db_file = os.path.join(str(tmp_path),PubDBCache.DEFAULT_CACHE_DB_FILE)
+	conn = sqlite3.connect(db_file)
+	conn.execute("""PRAGMA user_version = {}""".format(len(PubDBCache.SCHEMA_MIGRATIONS) + 1))
+	conn.close()
+	with pytest.raises(Exception,match='newer than the supported'):
+		with PubDBCache('europepmc',str(tmp_path)):
+			pass
@@ -0,0 +1,116 @@
+import datetime
+import os
+
+from libs.pub_common import Timestamps
+from libs.doi_cache import DOIChecker
+from libs.pub_cache import PubDBCache
+
+NOW = Timestamps.UTCTimestamp(datetime.datetime.utcnow())
+
+MAPPINGS = [
+	{'id': str(i), 'source': 'MED', 'title': 'Title {}'.format(i), 'year': 2000 + i, 'pmid': str(i), 'doi': '10.1000/{}'.format(i), 'pmcid': 'PMC{}'.format(i)}
+	for i in range(1,6)
+]
+# Longer than a page, so it is stored paged
+LONG_CITATIONS = [ {'id': str(100000 + i), 'source': 'MED', 'year': 1990 + i % 30}  for i in range(PubDBCache.CITREF_PAGE_SIZE * 2 + 17) ]
+REFERENCES = [{'id': 'PMC7', 'source': 'PMC', 'year': 2001},{'id': '8', 'source': 'MED'}]
+PARTIALS = [{'id': 'PMC7', 'source': 'PMC', 'year': 2001, 'title': 'Listed', 'pmcid': 'PMC7'}]
+
+def _fill(cache):
+	cache.setCachedMappings(MAPPINGS,NOW)
+	cache.setCitRefs([(('MED','1'),LONG_CITATIONS,True),(('MED','1'),REFERENCES,False),(('MED','2'),[],True)],NOW)
+	cache.setNegativeIds(['pmid:999'],NOW)
+	cache.setPartialMappings(PARTIALS,NOW)
+
+def test_pub_snapshot_roundtrip(tmp_path):
+	snapshot_file = str(tmp_path / 'pub.jsonl.gz')
+	src_dir = tmp_path / 'src'
+	dst_dir = tmp_path / 'dst'
+	os.makedirs(str(src_dir))
+	os.makedirs(str(dst_dir))
+	with PubDBCache('europepmc',str(src_dir)) as cache:
+		_fill(cache)
+		exported = cache.exportSnapshot(snapshot_file)
+	
+	with PubDBCache('europepmc',str(dst_dir)) as cache:
+		imported = cache.importSnapshot(snapshot_file)
+		assert imported == exported
+		qual_ids = [ (mapping['source'],mapping['id'])  for mapping in MAPPINGS ]
+		assert cache.getCachedMappingsBulk(qual_ids) == { qual_id: mapping  for qual_id, mapping in zip(qual_ids,MAPPINGS) }
+		assert cache.getSourceIds('3') == [('MED','3')]
+		assert cache.getCitRefsBulk([('MED','1'),('MED','2')],True) == {('MED','1'): LONG_CITATIONS, ('MED','2'): []}
+		assert cache.getCitRefsBulk([('MED','1')],False) == {('MED','1'): REFERENCES}
+		assert cache.getNegativeIdsBulk(['pmid:999','pmid:1']) == {'pmid:999'}
+		assert cache.getYearsBulk([('PMC','PMC7'),('MED','8')]) == {('PMC','PMC7'): 2001}
+		assert cache.getPartialMappingsBulk([('PMC','PMC7')]) == {('PMC','PMC7'): PARTIALS[0]}
+
+def test_pub_snapshot_newest_wins(tmp_path):
+	snapshot_file = str(tmp_path / 'pub.jsonl.gz')
+	older = NOW - datetime.timedelta(days=1)
+	with PubDBCache('europepmc',str(tmp_path)) as cache:
+		cache.setCachedMappings([dict(MAPPINGS[0],title='Old')],older)
+		cache.exportSnapshot(snapshot_file)
+		cache.setCachedMappings([dict(MAPPINGS[0],title='New')],NOW)
+		cache.importSnapshot(snapshot_file)
+		assert cache.getCachedMapping('MED','1')['title'] == 'New'
+
+def test_doi_snapshot_roundtrip(tmp_path):
+	snapshot_file = str(tmp_path / 'doi.jsonl.gz')
+	resolution = {'doi': '10.1000/ABC', 'responseCode': 1}
+	os.makedirs(str(tmp_path / 'src'))
+	os.makedirs(str(tmp_path / 'dst'))
+	with DOIChecker(str(tmp_path / 'src')) as checker:
+		checker.setCachedResolutions([resolution],NOW + datetime.timedelta(days=1))
+		assert checker.exportSnapshot(snapshot_file) == {'doi_check': 1}
+	
+	with DOIChecker(str(tmp_path / 'dst')) as checker:
+		assert checker.importSnapshot(snapshot_file) == {'doi_check': 1}
+		assert checker.getCachedResolution('10.1000/abc') == resolution
+
+def _deadPid():
+	pid = 4194303
+	while PubDBCache._isProcessAlive(pid):
+		pid -= 1
+	return pid
+
+def test_snapshot_mode_merges_on_exit(tmp_path):
+	with PubDBCache('europepmc',str(tmp_path)) as cache:
+		cache.setNegativeIds(['3','999'],NOW)
+	
+	with PubDBCache('europepmc',str(tmp_path),snapshot_mode=True) as cache:
+		cache.setCachedMappings(MAPPINGS,NOW)
+		cache.setPartialMappings(PARTIALS,NOW)
+		# Other instances must not merge a delta in use
+		with PubDBCache('europepmc',str(tmp_path)):
+			pass
+		assert os.path.exists(cache.delta_db_file)
+	
+	assert not os.path.exists(cache.delta_db_file)
+	with PubDBCache('europepmc',str(tmp_path)) as cache:
+		assert cache.getSourceIds('3') == [('MED','3')]
+		# Resolved in the delta, so it is no longer negative
+		assert cache.getNegativeIdsBulk(['3','999']) == {'999'}
+		assert cache.getPartialMappingsBulk([('PMC','PMC7')]) == {('PMC','PMC7'): PARTIALS[0]}
+
+def test_only_orphan_deltas_are_merged(tmp_path):
+	delta_dir = tmp_path / 'delta'
+	os.makedirs(str(delta_dir))
+	with PubDBCache('europepmc',str(delta_dir)) as delta:
+		delta.setCachedMappings(MAPPINGS,NOW)
+	
+	with PubDBCache('europepmc',str(tmp_path)) as cache:
+		pass
+	
+	# A delta of a live process is left alone
+	live_delta = cache.cache_db_file + PubDBCache.DELTA_SUFFIX + str(os.getppid())
+	os.rename(delta.cache_db_file,live_delta)
+	with PubDBCache('europepmc',str(tmp_path)) as cache:
+		assert cache.getSourceIds('3') == []
+	assert os.path.exists(live_delta)
+	
+	dead_delta = cache.cache_db_file + PubDBCache.DELTA_SUFFIX + str(_deadPid())
+	os.rename(live_delta,dead_delta)
+	with PubDBCache('europepmc',str(tmp_path)) as cache:
+		assert cache.getSourceIds('3') == [('MED','3')]
+	assert not os.path.exists(dead_delta)
+	assert [ name  for name in os.listdir(str(tmp_path))  if PubDBCache.DELTA_SUFFIX in name ] == []
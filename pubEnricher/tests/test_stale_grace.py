@@ -0,0 +1,27 @@
+import datetime
+
+from libs.pub_common import Timestamps
+from libs.pub_cache import PubDBCache
+
+MAPPING = {'id': '1', 'source': 'MED', 'pmid': '1', 'year': 2000}
+
+def _ago(**kwargs):
+	return Timestamps.UTCTimestamp(datetime.datetime.utcnow() - datetime.timedelta(**kwargs))
+
+def test_expired_entries_within_the_grace_are_stale(tmp_path):
+	with PubDBCache('europepmc',str(tmp_path),ttl_days={'mapping': 1},stale_grace_days=2,lru_size=0) as cache:
+		cache.setCachedMappings([MAPPING],_ago(days=2))
+		cache.setCachedMappings([dict(MAPPING,id='2',pmid='2')],_ago(days=4))
+		assert cache.getCachedMappingsBulk([('MED','1'),('MED','2')]) == {('MED','1'): MAPPING}
+		assert cache.popStaleEntries()['mapping'] == {('MED','1')}
+
+def test_entries_expire_against_the_current_time(tmp_path):
+	# Just stored entries are already expired with no time to live,
+	# as they are compared with the time of the lookup
+	with PubDBCache('europepmc',str(tmp_path),ttl_days={'mapping': 0, 'year': 0},stale_grace_days=1,lru_size=0) as cache:
+		cache.setCachedMappings([MAPPING],_ago(milliseconds=1))
+		assert cache.getCachedMappingsBulk([('MED','1')]) == {('MED','1'): MAPPING}
+		assert cache.getYearsBulk([('MED','1')]) == {('MED','1'): 2000}
+		stale = cache.popStaleEntries()
+		assert stale['mapping'] == {('MED','1')}
+		assert stale['year'] == {('MED','1')}
@@ -0,0 +1,60 @@
+import datetime
+
+import pytest
+
+from libs.pub_common import Timestamps
+from libs.payload_codec import PayloadCodec
+from libs.pub_cache import PubDBCache
+
+NOW = Timestamps.UTCTimestamp(datetime.datetime.utcnow())
+
+MAPPING = {'id': '1', 'source': 'MED', 'title': 'Title', 'year': 2001, 'pmid': '1', 'doi': '10.1000/1', 'pmcid': None}
+CITATIONS = [{'id': '2', 'source': 'MED', 'year': 2002},{'id': 'PMC3', 'source': 'PMC', 'year': 2003}]
+
+@pytest.fixture
+def cache(tmp_path):
+	with PubDBCache('europepmc',str(tmp_path),lru_size=0,write_behind=True,write_behind_interval=0.5) as cache:
+		yield cache
+
+def _tamper(mapping,citations):
+	mapping['title'] = 'Changed'
+	mapping['extra'] = True
+	citations[0]['title'] = 'Changed'
+	citations.append({'id': '4', 'source': 'MED', 'year': 2004})
+
+def test_queued_writes_are_copies(cache):
+	mapping = dict(MAPPING)
+	citations = [ dict(citation)  for citation in CITATIONS ]
+	cache.setCachedMappings([mapping],NOW)
+	cache.setCitRefs([(('MED','1'),citations,True)],NOW)
+	_tamper(mapping,citations)
+	
+	# Served from the overlay of pending writes, or already committed
+	cached_mapping = cache.getCachedMapping('MED','1')
+	cached_citations = cache.getCitRefsBulk([('MED','1')],True)[('MED','1')]
+	assert cached_mapping == MAPPING
+	assert cached_citations == CITATIONS
+	
+	# which also hands out copies
+	_tamper(cached_mapping,cached_citations)
+	assert cache.getCachedMapping('MED','1') == MAPPING
+	assert cache.getCitRefsBulk([('MED','1')],True) == {('MED','1'): CITATIONS}
+	
+	# and the committed entries are the original ones
+	cache.sync()
+	assert cache.getCachedMapping('MED','1') == MAPPING
+	assert cache.getCitRefsBulk([('MED','1')],True) == {('MED','1'): CITATIONS}
+	payload = cache.conn.execute("""SELECT payload FROM citref WHERE id = '1'""").fetchone()[0]
+	assert payload[0] == PayloadCodec.TAG_CITREFS
+
+def test_queued_writes_are_committed_on_exit(tmp_path):
+	with PubDBCache('europepmc',str(tmp_path),write_behind=True,write_behind_interval=0.5) as cache:
+		cache.setCachedMappings([dict(MAPPING)],NOW)
+		cache.setNegativeIds(['999'],NOW)
+		cache.setYears([(('MED','2'),2002)],NOW)
+	
+	with PubDBCache('europepmc',str(tmp_path)) as cache:
+		assert cache.getCachedMapping('MED','1') == MAPPING
+		assert cache.getSourceIds('1') == [('MED','1')]
+		assert cache.getNegativeIdsBulk(['999','1']) == {'999'}
+		assert cache.getYearsBulk([('MED','2')]) == {('MED','2'): 2002}